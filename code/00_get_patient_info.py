@@ -9,7 +9,12 @@ This allows us to build a processing pipeline that runs at the patient level
 and can be fully parallelized in the future.
 
 !!!! This function runs in parallel and uses all threads. To change the 
-number of threads, see the variable "n_jobs" @config.py
+number of threads, see the variable "n_jobs" @config.py. The patients can also
+be split between several machines, e.g:
+    python 00_get_patient_info.py --shard 0/2   # machine 1
+    python 00_get_patient_info.py --shard 1/2   # machine 2
+    python 00_get_patient_info.py --merge       # once both are done
+(see @executors.py)
 
 @author: Christos
 """
@@ -18,18 +23,26 @@ number of threads, see the variable "n_jobs" @config.py
 # IMPORT MODULES
 # =============================================================================
 import os
+import argparse
 import pandas as pd
 import numpy as np
-from scipy import signal
-from mne.parallel import parallel_func
 import wfdb
 import config as c
+import executors
+import feature_store
+from features import compute_signal_features, SIGNAL_FEATURES
+from features import StreamingSignalFeatures
+from signal_io import iter_record_chunks, RawRecord
+from ingest import tranform_metadata_to_dataframe, ingest_record_job
+from ingest import plan_patient, record_jobs, save_manifests, build_index
+from profiling import profile
+from artifact_writer import ArtifactWriter
 
 
 # =============================================================================
 # UTILITY FUNCTIONS
 # =============================================================================
-def list_patients():
+def list_patients(save=True):
     '''
 
     Based on the 'raw' directory, list the number of patients
@@ -37,7 +50,9 @@ def list_patients():
 
     Parameters
     ----------
-    None
+    save : Bool
+        Save the list in the info directory (patients.tsv). The shards do
+        not save it, the merge does.
 
     Returns
     -------
@@ -56,55 +71,16 @@ def list_patients():
     c.logging.info(
         f'Data from {len(patients)} patients available in this dataset')
     # save the patients list as a .csv
-    fname = c.join(path.to_info(),'patients.tsv')
-    np.savetxt(fname, patients, delimiter=",", fmt='%s')
+    if save:
+        fname = c.join(path.to_info(),'patients.tsv')
+        np.savetxt(fname, patients, delimiter=",", fmt='%s')
 
     
 
     return patients
 
 
-def tranform_metadata_to_dataframe(metadata, patient, record, path):
-    '''
-    Transform the metadata extracted from the header into a pandas dataframe
-    and store this information in the info derivative. Each metadata file
-    corresponds to a record of a given patient.
-
-    Additionally, strip the whitespace of each entry and set the empty
-    to the string "empty_value"
-
-    Parameters
-    ----------
-    metadata : List
-        The original metadata file extracted from the header for a given
-        patient and record.
-    record : String
-        The corresponfing record of the current patient.
-    patient: String
-        The current patient.
-    path : Class
-        The path constructor.
-
-    Returns
-    -------
-    None
-    '''
-    # get the features (e.g age)
-    columns = [metadata[i].split(':')[0].strip() for i in range(len(metadata))]
-    # get and preprocess the values
-    values = ["no_entry" if metadata[i].split(':')[1].strip(
-    ) == '' else metadata[i].split(':')[1].strip() for i in range(len(metadata))]
-    # transform into a dataframe
-    metadata_df = pd.DataFrame(list(zip(columns, values)), columns=['feature', 'value'])
-    # store into the info derivative dir
-    path2metadata = c.join(path.to_info(), patient, record, 'patient_metadata')
-    if not c.exists(path2metadata):
-        c.make(path2metadata)
-    fname = c.join(path2metadata, f'{patient}_{record}_header_metadata.csv')
-    metadata_df.to_csv(fname)
-
-
-def extract_signal_metadata(data, patient, record, info, path):
+def extract_signal_metadata(data, patient, record, info):
     '''
     Extract metadata from the recorded data and for all 15 leads for a
     given patient and record. The metadata correspond to one value per channel
@@ -127,108 +103,127 @@ def extract_signal_metadata(data, patient, record, info, path):
         The corresponfing record of the current patient.
     patient: String
         The current patient.
-    info :
-
-        DESCRIPTION.
-    path : TYPE
-        DESCRIPTION.
+    info : wfdb Record
+        The record object (used for the channel names).
 
     Returns
     -------
-    None.
+    rows : Numpy structured array (len = #leads)
+        The signal metadata as rows of the consolidated store
+        (see @feature_store.py).
 
     '''
 
     # get the channel names
     channel_names = info.sig_name
-    # EXTRACT METRICS
-    # 1. Variance
-    channel_variance = np.var(data, axis=0)
-    # 2. Mean amplitude
-    mean_amplitude = np.mean(data, axis=0)
-    # 3. Median amplitude
-    median_amplitude = np.median(data, axis=0)
-    # 4. Mean value of the derivative (1st)
-    mean_der_value = np.mean(np.gradient(data, 1, axis=0), axis=0)
-    # 5. Median value of the derivative
-    median_der_value = np.median(np.gradient(data, 1, axis=0), axis=0)
-    # 6. Peak of the power-spectrum (in Hz)
-    peaks = [np.max(signal.welch(data[:, sig], 1000, 'flattop', 1024, scaling='spectrum')[
-                    1] * 1e3) for sig in range(0, data.shape[1])]
-
-    columns = ['channel_variance', 'mean_amplitude', 'median_amplitude',
-               'mean_derivative_value', 'median_derivative_value',
-               'power_spectral_density_max']
-
-    signal_metadata = pd.DataFrame(list(zip(channel_variance, mean_amplitude,
-                               median_amplitude, mean_der_value,
-                               median_der_value, peaks)), index=channel_names,
-                      columns=columns)
-
-    # store into the info derivative dir
-    path2metadata = c.join(path.to_info(), patient, record, 'signal_metadata')
-
-    if not c.exists(path2metadata):
-        c.make(path2metadata)
-    fname = c.join(path2metadata, f'{patient}_{record}_signal_metadata.csv')
-    signal_metadata.to_csv(fname)
+    # EXTRACT METRICS (all leads in one pass, see @features.py)
+    features = compute_signal_features(data, info.fs)
+    signal_metadata = pd.DataFrame(features, index=channel_names,
+                                   columns=SIGNAL_FEATURES)
+
+    # return as rows of the consolidated store (saved @__main__)
+    return feature_store.to_store_rows(signal_metadata, patient, record)
+
+
+def stream_signal_metadata(record_path, patient, record, info):
+    '''
+    Same as @extract_signal_metadata, but the record is read in blocks of
+    "chunk_size" samples (see @config.py), so that the memory needed does not
+    depend on the length of the record (see @features.StreamingSignalFeatures).
+
+    Parameters
+    ----------
+    record_path : String
+        The path of the record (without extension).
+    patient : String
+        The current patient.
+    record : String
+        The corresponfing record of the current patient.
+    info : wfdb Record or RawRecord
+        The header of the record (channel names, ADC gain and baseline).
+
+    Returns
+    -------
+    rows : Numpy structured array (len = #leads)
+        The signal metadata as rows of the consolidated store.
+
+    '''
+    accumulator = StreamingSignalFeatures(info.adc_gain, info.baseline, info.fs)
+    for _, digital in iter_record_chunks(record_path, physical=False):
+        accumulator.update(digital)
+    signal_metadata = pd.DataFrame(accumulator.result(), index=info.sig_name,
+                                   columns=SIGNAL_FEATURES)
+
+    return feature_store.to_store_rows(signal_metadata, patient, record)
 
 
 # =============================================================================
 # MAIN FUNCTION (WRAPPER))
 # =============================================================================
 
-def extract_patient_and_signal_info(patient):
+def extract_patient_and_signal_info(patient, record):
     '''
     The main function of this analysis stage. This function calls all the utility
-    functions defined above and performs the following steps:
-        1. Identify the number of different records per patient
-        2. Load the data from all leads and the header metadata
-        3. Store the header metadata in the info directory
-        4. Extract descriptive measures for each lead and store this info into
-        the info directory for post-processing (these include the power spectral
-                                                density peak for each lead,
-                                                the variance of each channel and
-                                                others.)
+    functions defined above and performs the following steps for a given
+    record of a patient:
+        1. Load the data from all leads and the header metadata
+        2. Store the header metadata in the info directory
+        3. Extract descriptive measures for each lead and return them as rows
+        of the signal metadata store for post-processing (these include the
+                                                power spectral density peak
+                                                for each lead, the variance
+                                                of each channel and others.)
+
+    Each record is a separate job. The records of the patients whose raw
+    data did not change since the previous run are skipped (see
+    @ingest.plan_patient and @incremental.py).
 
     Parameters
     ----------
     patient : string
         The current patient (e.g: patient001, constructed with @list_patients)
+    record : string
+        The current record (e.g: s0010_re).
 
     Returns
     -------
-    None.
+    Numpy structured array
+        The signal metadata of all leads of the record.
 
     '''
-
-    # call the path constructor
-    path = c.FetchPaths(c.PROJECTS_PATH, c.PROJECT_NAME)
-    # construct the path for the given
-    curr_patient = c.join(path.to_data_raw(), patient)
-    # now, see how many segments (recordings) each patient has
-    records = os.listdir(curr_patient)
-    # each recording is identified by a prefix, to get the number
-    # of records, we need the number of distinct prefices
-    # isolate the unique .dat files
-    unq_dat_files = list(filter(lambda x: '.dat' in x, records))
-    # from this, extract the unq record names
-    record_names = [
-        unq_dat_files[i].split('.dat')[0] for i in range(
-            len(unq_dat_files))]
-    # now, loop over the records and read the data and the metadata
-    for record in record_names:
-        # read the record
-        info = wfdb.rdrecord(c.join(curr_patient, record))
-        # get the metadata
-        metadata = info.comments
-        # convert metadata to df and store in the info directory
-        tranform_metadata_to_dataframe(metadata, patient, record, path)
-
-        # get the data from all leads
-        data = info.p_signal
-        # extract descriptive metrics for all leads and store into a dataframe
-        extract_signal_metadata(data, patient, record, info, path)
+    # set up the logging of the worker (see @config.init)
+    c.init(worker=True)
+    with profile('00_get_patient_info', patient=patient, record=record):
+        # call the path constructor
+        path = c.FetchPaths(c.PROJECTS_PATH, c.PROJECT_NAME)
+        # construct the path for the given record
+        record_path = c.join(path.to_data_raw(), patient, record)
+        # read the data and the metadata (the header metadata are written in
+        # the background, see @artifact_writer.py)
+        with ArtifactWriter() as writer:
+            if c.raw_reader == 'memmap':
+                # memory-map the digital samples, the features are computed on
+                # them directly (no conversion of the whole record)
+                info = RawRecord(record_path)
+            elif c.streaming:
+                # read only the header, the data are streamed in blocks
+                info = wfdb.rdheader(record_path)
+            else:
+                # read the record
+                info = wfdb.rdrecord(record_path)
+            # get the metadata
+            metadata = info.comments
+            # convert metadata to df and store in the info directory
+            tranform_metadata_to_dataframe(metadata, patient, record, path,
+                                           writer)
+
+            if c.streaming or c.raw_reader == 'memmap':
+                return stream_signal_metadata(record_path, patient, record,
+                                              info)
+            # get the data from all leads
+            data = info.p_signal
+            # extract descriptive metrics for all leads
+            return extract_signal_metadata(data, patient, record, info)
 
 
 # %%
@@ -238,10 +233,75 @@ def extract_patient_and_signal_info(patient):
 # =============================================================================
 
 if __name__ == "__main__":
-    # get the number of patients 
-    patient_list = list_patients()
-    # parallelize the main function
-    parallel, run_func, _ = parallel_func(extract_patient_and_signal_info,
-                                          n_jobs=c.n_jobs)
-    # run for all patients
-    parallel(run_func(patient) for patient in patient_list)
+    parser = argparse.ArgumentParser(description='Patient info and signal '
+                                     'metadata')
+    executors.add_arguments(parser, merge=True)
+    args = parser.parse_args()
+    # make the dirs of the project and set up the logging (see @config.init)
+    c.init()
+    # call the path constructor
+    path = c.FetchPaths(c.PROJECTS_PATH, c.PROJECT_NAME)
+    store_fname = c.join(path.to_info(), feature_store.STORE_FNAME)
+    # record the resources used by the stage (see @profiling.py)
+    with profile('00_get_patient_info', path):
+        # get the number of patients 
+        patient_list = list_patients(save=args.shard is None)
+        if args.merge:
+            # merge the stores of the shards into the store of the cohort
+            shard_fnames = executors.find_shards(store_fname)
+            fname = feature_store.merge_stores(shard_fnames, path)
+            c.logging.info(f'{len(shard_fnames)} shards merged @{fname}')
+            for shard_fname in shard_fnames:
+                os.remove(shard_fname)
+        else:
+            # the patients of this machine (all, unless "--shard i/N")
+            patients = executors.select_shard(patient_list, args.shard)
+            # load the signal metadata of the previous run (if any), these
+            # are reused for the patients that are up to date
+            previous = {}
+            if os.path.isfile(store_fname):
+                store = feature_store.SignalMetadataStore(path, mmap_mode=None)
+                previous = {patient: store.select(patient) for patient in
+                            store.patients()}
+            # the work left for each patient (with the fused ingest, the
+            # records are also preprocessed, see @ingest.py)
+            plans = executors.run(plan_patient, [
+                (patient, True, c.fused_ingest, patient not in previous) for
+                patient in patients])
+            plans = [plan for plan in plans if plan is not None]
+            # run the main function in parallel, one job per record (the
+            # longest records first)
+            jobs, costs = record_jobs(plans)
+            if c.fused_ingest:
+                flags = {plan['patient']: (plan['extract'], plan['preprocess'])
+                         for plan in plans}
+                results = executors.run(ingest_record_job, [
+                    (patient, record, *flags[patient]) for patient, record in
+                    jobs], costs)
+            else:
+                results = executors.run(extract_patient_and_signal_info, jobs,
+                                        costs)
+            # all records of the patients are done
+            save_manifests(plans)
+            c.logging.info(f'{len(plans)} of {len(patients)} patients '
+                           f'({len(jobs)} records) processed (the rest are up '
+                           f'to date)')
+            # the rows of the processed patients, in the order of the records
+            processed = {}
+            for (patient, _), record_rows in zip(jobs, results):
+                if record_rows is not None:
+                    processed.setdefault(patient, []).append(record_rows)
+            rows = [np.concatenate(processed[patient]) if patient in processed
+                    else previous[patient] for patient in patients]
+            if args.shard is None:
+                # store the signal metadata of all patients in a single file
+                fname = feature_store.save_store(rows, path)
+            else:
+                # the store of the shard (merged with "--merge")
+                fname = feature_store.save_store(
+                    rows, path, executors.shard_fname(store_fname, args.shard))
+            c.logging.info(f'Signal metadata store saved @{fname}')
+        if args.shard is None:
+            # index the records and the artifacts of all patients
+            fname = build_index(path, patient_list)
+            c.logging.info(f'Index saved @{fname}')
@@ -10,32 +10,128 @@ extract statistical properties at the cohort level (age, different diagnosis,
 # =============================================================================
 # IMPORT MODULES
 # =============================================================================
-import os
 import itertools
 import pandas as pd
 import pickle
 import config as c
+from ingest import read_header_comments, parse_header_comments
+from profiling import profile
+
+
+# =============================================================================
+# SCHEMA OF THE HEADER METADATA
+# =============================================================================
+# dates and their format (e.g: 'ECG date: 01/10/1990', 'Admission date:
+# 29-Sep-90'). Values in another format are set to NaT.
+DATE_FEATURES = {'ECG date': '%d/%m/%Y',
+                 'Infarction date (acute)': '%d-%b-%y',
+                 'Previous infarction (1) date': '%d-%b-%y',
+                 'Previous infarction (2) date': '%d-%b-%y',
+                 'Catheterization date': '%d-%b-%y',
+                 'Infarction date': '%d-%b-%y',
+                 'Admission date': '%d-%b-%y'}
+# numeric features (the other values are set to NaN)
+NUMERIC_FEATURES = ['age', 'Number of coronary vessels involved']
+# features with empty values
+EMPTY_FEATURES = ['Hemodynamics', 'Diagnose']
+# missing values of the headers
+NA_VALUES = ['n/a', 'N/A', 'NA', 'nan', 'NaN', 'null', 'NULL', 'None']
 
 
 # =============================================================================
 # UTILITY FUNCTIONS
 # =============================================================================
-# convert dates from object to pandas.datetime
-def dt_inplace(df):
+def align_to_template(features, values, template):
+    '''
+    Returns the values of a header in the order of the features of the
+    template (the first header of the cohort). The features are matched by
+    name and occurrence (e.g: the 2nd "Catheterization date"), the missing
+    ones are set to "no_entry" and the unknown ones are dropped.
     '''
-    Automatically detect and convert (in place!) each
-    dataframe column of datatype 'object' to a datetime just
-    when ALL of its non-NaN values can be successfully parsed
-    by pd.to_datetime().  Also returns a ref. to df for
-    convenient use in an expression.
+    def keys(names):
+        occurrences = {}
+        for name in names:
+            occurrences[name] = occurrences.get(name, 0) + 1
+            yield name, occurrences[name]
+
+    record = dict(zip(keys(features), values))
+
+    return [record.get(key, 'no_entry') for key in keys(template)]
+
+
+def read_cohort_metadata(path, patients):
     '''
-    from pandas.errors import ParserError
-    for col in df.columns[df.dtypes=='object']: #don't cnvt num
-        try:
-            df[col]=pd.to_datetime(df[col])
-        except (ParserError,ValueError): #Can't cnvrt some
-            pass # ...so leave whole column as-is unconverted
-    return df
+    Read the header comments of all patients directly from the raw .hea
+    files, in a single pass (see @ingest.parse_header_comments).
+
+    Parameters
+    ----------
+    path : Class
+        The path constructor.
+    patients : List
+        The sorted list of patients (e.g: patient001,...).
+
+    Returns
+    -------
+    cohort_dataframe : Pandas Dataframe
+        One row per patient and one column per feature of the first header,
+        as strings (a feature repeated in the headers, e.g: "Catheterization
+        date", gives as many columns).
+
+    '''
+    template = None
+    collector = []
+    for patient in patients:
+        # the records of the patient (see the index @00_get_patient_info)
+        if c.record_aggregation == 'first':
+            records = [path.first_record(patient)]
+        else:
+            records = path.records(patient)
+
+        values = None
+        for record in records:
+            fname = path.to_artifact(patient, record, 'raw') + '.hea'
+            features, record_values = parse_header_comments(
+                read_header_comments(fname))
+            if template is None:
+                template = features
+            elif features != template:
+                # only needed if the headers do not share the same fields
+                record_values = align_to_template(features, record_values,
+                                                  template)
+            if values is None:
+                values = record_values
+                continue
+            # fill the empty fields from the next records
+            values = [value if value != 'no_entry' else other for value, other
+                      in zip(values, record_values)]
+
+        collector.append(values)
+
+    return pd.DataFrame(collector, index=patients, columns=template,
+                        dtype=object)
+
+
+def apply_schema(cohort_dataframe):
+    '''
+    Convert the columns of the cohort dataframe with an explicit schema (see
+    DATE_FEATURES and NUMERIC_FEATURES): one vectorized conversion per
+    column, instead of trying to parse every column as a date.
+    '''
+    # the missing values
+    cohort_dataframe = cohort_dataframe.mask(
+        cohort_dataframe.isin(NA_VALUES))
+    for idx, feature in enumerate(cohort_dataframe.columns):
+        if feature in DATE_FEATURES:
+            cohort_dataframe.isetitem(idx, pd.to_datetime(
+                cohort_dataframe.iloc[:, idx], format=DATE_FEATURES[feature],
+                errors='coerce'))
+        elif feature in NUMERIC_FEATURES:
+            cohort_dataframe.isetitem(idx, pd.to_numeric(
+                cohort_dataframe.iloc[:, idx], errors='coerce'))
+
+    return cohort_dataframe
+
 
 # read patient metadata and build the cohort dataframe
 def build_cohort_dataframe(path, patients):
@@ -59,46 +155,25 @@ def build_cohort_dataframe(path, patients):
     * ----------------------
     !!! **Important** !!! 
     * ----------------------
-    In this version, only the first of the available records is utilized. 
-    I will revisit this issue and make a final decision in the future. 
-    I chose this to continue with the analysis.     
+    The header metadata describe the patient (one row per patient). With
+    "record_aggregation" = 'first' (@config.py) only the first of the
+    available records is utilized. Otherwise, the headers of all records are
+    read and each field takes the first value that is not empty
+    ("no_entry") across the records.
     
     '''
-    collector = []
-    for idx, patient in enumerate(patients):
-        # get the available records per patient
-        records = [f for f in os.listdir(c.join(path.to_info(),patient)) if not f.startswith('.')]
-        # for this stage of the analysis, use only the first record
-        record =records[0]
-    
-        
-        header_metadata = pd.read_csv(c.join(path.to_info(),patient,
-                                             record, 'patient_metadata',
-                                             f'{patient}_{record}_header_metadata.csv'),
-                                      index_col=0)  
-        if idx ==0:
-            features = header_metadata.feature.values.tolist()
-        
-        collector.append(header_metadata.value.values.tolist())
-        
-    # construct the dataframe and index it by the patient name
-    cohort_dataframe = pd.DataFrame(collector, columns=features)
-    cohort_dataframe=cohort_dataframe.set_axis(patients)
+    # one row per patient, read from the headers in a single pass
+    cohort_dataframe = read_cohort_metadata(path, patients)
     
     
     #* ----------------------#
     # PREPROCESS THE DATAFRAME
     #* ----------------------#
-    # convert automatically all available dates from object to string
-    cohort_dataframe = dt_inplace(cohort_dataframe)
-    # covert features to numeric
-    num_features = ['age','Number of coronary vessels involved']
-    for f in num_features:
-        cohort_dataframe[f] = pd.to_numeric(cohort_dataframe[f], errors='coerce')
+    # convert the dates and the numeric features (see the schema above)
+    cohort_dataframe = apply_schema(cohort_dataframe)
     
     # drop features with empty values
-    empty_features = ['Hemodynamics','Diagnose']
-    cohort_dataframe.drop(columns = empty_features, inplace = True)    
+    cohort_dataframe.drop(columns = EMPTY_FEATURES, inplace = True)    
 
     
     #* ----------------------#
@@ -132,17 +207,20 @@ def build_cohort_dataframe(path, patients):
 # EXECUTE
 # =============================================================================
 if __name__ == "__main__":
+    # make the dirs of the project and set up the logging (see @config.init)
+    c.init()
     # call the path constructor
     path = c.FetchPaths(c.PROJECTS_PATH, c.PROJECT_NAME)
-    # available patients
-    patient_list = pd.read_csv(
-        c.join(
-            path.to_info(),
-            'patients.tsv'),
-        header=None).values.tolist()
-    # unpack the list of lists
-    patients = list(itertools.chain(*patient_list))
-    
-    # run the function
-    build_cohort_dataframe(path, patients)
+    # record the resources used by the stage (see @profiling.py)
+    with profile('01_get_cohort_statistics', path):
+        # available patients
+        patient_list = pd.read_csv(
+            c.join(
+                path.to_info(),
+                'patients.tsv'),
+            header=None).values.tolist()
+        # unpack the list of lists
+        patients = list(itertools.chain(*patient_list))
 
+        # run the function
+        build_cohort_dataframe(path, patients)
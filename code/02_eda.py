@@ -3,19 +3,29 @@
 """
 Exploratory Data Analysis based on the signal metadata. 
 
+The Mann-Whitney U tests of all pairs of classes, leads and features are
+computed at once and stored in the info directory (see @eda_stats.py), the
+figures only annotate them. The figures are drawn headless, in parallel, and
+only if their data changed (see @rendering.py). To compute the statistics
+without the figures:
+    python 02_eda.py --stats-only
+
 @author: Christos
 """
 
 # =============================================================================
 # IMPORT MODULES
 # =============================================================================
-import os
+import argparse
+from collections import OrderedDict
+import numpy as np
 import pandas as pd
-import matplotlib.pyplot as plt
-import seaborn as sns
-from statannot import add_stat_annotation
 import config as c
+import eda_stats
+import rendering
+from feature_store import SignalMetadataStore, SIGNAL_FEATURES
 from utils import snake_case, load_the_cohort_class_info
+from profiling import profile
 
 
 # =============================================================================
@@ -23,11 +33,96 @@ from utils import snake_case, load_the_cohort_class_info
 # =============================================================================
 
 
-def collect_signal_metadata(patients, electrode, path):
+class CohortSignalMetadata():
+    '''
+    Cohort-level cache of the signal metadata. The table of each patient
+    (#leads X #features of the records selected by "record_aggregation"
+    @config.py) is read from the store once and
+    kept in memory, so that any (class, electrode, feature) slice is served
+    without reading the data again. At most "maxsize" patients are kept in
+    memory (the least recently used are dropped first).
+    Attributes:
+        1. store (the memory-mapped store, see @feature_store.py)
+        2. maxsize
+    '''
+
+    def __init__(self, path, maxsize=c.eda_cache_size):
+        self.path = path
+        self.store = SignalMetadataStore(path)
+        self.maxsize = maxsize
+        self._tables = OrderedDict()
+        if c.record_aggregation in ('separate', 'concatenate'):
+            # the records of a patient are not independent samples
+            c.logging.warning(f"record_aggregation='{c.record_aggregation}': "
+                              f"the signal metadata of the records of each "
+                              f"patient are averaged @02_eda (one sample per "
+                              f"patient)")
+
+    def patient_table(self, patient):
+        '''
+        Returns the signal metadata (#leads X #features) of a given patient:
+        a single row per lead, i.e: the first record ('first'), or the
+        records reduced with the "record_aggregation" @config.py ('mean',
+        'median') or averaged ('separate', 'concatenate': the tests
+        @eda_stats.py need a single sample per patient, and the features of
+        the concatenated records are not stored).
+        '''
+        if patient in self._tables:
+            self._tables.move_to_end(patient)
+            return self._tables[patient]
+
+        # the records of the patient (see "record_aggregation" @config.py)
+        if c.record_aggregation == 'first':
+            record = self.path.first_record(patient)
+            rows = np.asarray(self.store.select(patient, record))
+        else:
+            rows = np.asarray(self.store.select(patient))
+        table = pd.DataFrame({feature: rows[feature] for feature in
+                              SIGNAL_FEATURES}, index=rows['lead'])
+        if c.record_aggregation != 'first':
+            # reduce the features of all records per lead
+            reduce = (c.record_aggregation if c.record_aggregation in
+                      ('mean', 'median') else 'mean')
+            table = getattr(table.groupby(level=0, sort=False), reduce)()
+
+        self._tables[patient] = table
+        if len(self._tables) > self.maxsize:
+            self._tables.popitem(last=False)
+
+        return table
+
+    def collect(self, patients, electrode):
+        '''
+        Returns the signal metadata (#patients X #features) of a given
+        electrode and a selected sub-cohort.
+        '''
+        # one row per patient (see @patient_table)
+        return pd.DataFrame(np.concatenate([
+            self.patient_table(patient).loc[[electrode]].values for patient
+            in patients]), index=patients, columns=SIGNAL_FEATURES)
+
+    def class_array(self, patients, leads=None):
+        '''
+        Returns the signal metadata of a selected sub-cohort as an array
+        (#patients X #leads X #features, one sample per patient whatever the
+        "record_aggregation", see @patient_table), e.g: for the tests
+        @eda_stats.test_class_pairs. The default leads are the "electrodes"
+        @config.py.
+        '''
+        leads = c.electrodes if leads is None else leads
+        if not patients:
+            return np.zeros((0, len(leads), len(SIGNAL_FEATURES)))
+
+        return np.stack([self.collect(patients, lead).values for lead in
+                         leads], axis=1)
+
+
+def collect_signal_metadata(patients, electrode, path, cohort=None):
     '''
     Return a concatenated dataframe  of signal metadata for a given electrode
     and a selected sub-cohort. The signal metadata are extracted
-    @00_get_patient_info.py
+    @00_get_patient_info.py and read from the consolidated store
+    (see @feature_store.py).
 
     Parameters
     ----------
@@ -37,41 +132,30 @@ def collect_signal_metadata(patients, electrode, path):
     electrode : string
         The lead for which to pull data (e.g 'i'). The full list of available
         leads can be found in the config file. 
+    path : Class
+        The path constructor.
+    cohort : CohortSignalMetadata, optional
+        The cohort-level cache to serve the data from. If None, a new one
+        is created (and the data are read from the store).
 
     Returns
     -------
     The concatenated dataframe
 
     '''
+    if cohort is None:
+        cohort = CohortSignalMetadata(path)
     
-    # collect the signal metadata 
-    collector = []
-    for idx, patient in enumerate(patients):
-        # get the available records per patient
-        records = [f for f in os.listdir(c.join(path.to_info(),patient)) if not f.startswith('.')]
-        # for this stage of the analysis, use only the first record
-        record =records[0]
-    
-        
-        signal_metadata = pd.read_csv(c.join(path.to_info(),patient,
-                                             record, 'signal_metadata',
-                                             f'{patient}_{record}_signal_metadata.csv'),
-                                      index_col=0).loc[electrode]      
-        collector.append(signal_metadata)
-    
-    # construct the dataframe and index it by the patient name
-    sub_cohort_dataframe = pd.concat(collector, axis=1)
-    sub_cohort_dataframe.columns=patients
-    
-    return sub_cohort_dataframe.T    
+    return cohort.collect(patients, electrode)
 
 
 
 
 
-def plot_eda(features_of_interest, class_1, class_2, cohort_classes, path):
+def plot_eda(features_of_interest, class_1, class_2, data, pvalues):
     '''
-    
+    Draw the boxplots of the signal metadata of two classes, per feature
+    (rows) and lead (columns), annotated with the p-values of the tests.
 
     Parameters
     ----------
@@ -82,29 +166,37 @@ def plot_eda(features_of_interest, class_1, class_2, cohort_classes, path):
         e.g: 'Healthy control'.
     class_2 : String
         e.g: Myocardial infarction.
-    cohort_classes : Dict, created @collect_signal_metadata
-        Contains the list of patients that correspond to each class
-    
+    data : Dict
+        class --> the signal metadata of its patients (#patients X #leads X
+        #features, see @CohortSignalMetadata.class_array).
+    pvalues : Dict
+        (lead, feature) --> the (corrected) p-value of the pair (see
+        @eda_stats.pair_pvalues). Only annotated, no test is run here.
 
     Returns
     -------
-    None.
+    fig : Figure
+        The figure (saved @rendering.py).
 
     '''
+    # the plotting libraries are only imported when plotting (e.g: not when
+    # the cohort cache is used @benchmarks.py)
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+    from statannot import add_stat_annotation
     fig=plt.figure(dpi=100, facecolor='w', edgecolor='w')
     fig.set_size_inches(36,10)        
     counter = 0
     for idx, feature in enumerate(features_of_interest):
-        for electrode in c.electrodes:
+        column = SIGNAL_FEATURES.index(feature)
+        for lead, electrode in enumerate(c.electrodes):
             counter=counter+1
             
-            # pool data for a given electrode
-            class_1_data = collect_signal_metadata(cohort_classes[class_1], electrode, path)
-            class_2_data = collect_signal_metadata(cohort_classes[class_2], electrode, path)
-            # aggregate data
-            data = [class_1_data[feature].values, class_2_data[feature].values]
+            # the data of both classes for a given electrode
+            values = [data[class_1][:, lead, column],
+                      data[class_2][:, lead, column]]
             # tranform into a dataframe
-            df=pd.DataFrame(data).T
+            df=pd.DataFrame(values).T
             df.columns=[class_1,class_2]
             
             # plotting
@@ -112,9 +204,12 @@ def plot_eda(features_of_interest, class_1, class_2, cohort_classes, path):
             # plot
             ax = sns.boxplot(data=df)
     
+            # annotate the precomputed p-value (see @eda_stats.py)
             add_stat_annotation(ax, data=df,box_pairs=[(class_1, class_2)],
-                                               test='Mann-Whitney', text_format='star',
-                                               loc='outside', verbose=0)
+                                perform_stat_test=False,
+                                pvalues=[pvalues[electrode, feature]],
+                                test_short_name='M.W.W.', text_format='star',
+                                loc='outside', verbose=0)
             if idx <2:
                 plt.xticks([])
             plt.xticks(rotation = 45)
@@ -136,9 +231,43 @@ def plot_eda(features_of_interest, class_1, class_2, cohort_classes, path):
     plt.suptitle(f'{class_1} VS {class_2} \n Features: {features_of_interest}',
                  y=1.05, fontweight='bold', fontsize=14)
     fig.tight_layout()
-    fname = c.join(path.to_images(),f'{snake_case(class_1)}_{snake_case(class_2)}.png')
-    fig.savefig(fname, bbox_inches='tight',orientation='landscape')
-    plt.show()
+
+    return fig
+
+
+def eda_figures(features_of_interest, classes, data, statistics):
+    '''
+    Describe the EDA figures (see @rendering.figure): the first class VS each
+    of the others. Each figure only carries the data of its two classes and
+    its p-values.
+
+    Parameters
+    ----------
+    features_of_interest : List
+        The features to plot (see @plot_eda).
+    classes : List
+        e.g: ['Healthy control', 'Myocardial infarction', ...].
+    data : Dict
+        class --> Array (#patients X #leads X #features).
+    statistics : Pandas Dataframe
+        The tests of all class pairs (see @eda_stats.test_class_pairs).
+
+    Returns
+    -------
+    figures : List
+
+    '''
+    class_1 = classes[0]
+    figures = []
+    for class_2 in classes[1:]:
+        pvalues = eda_stats.pair_pvalues(statistics, class_1, class_2)
+        figures.append(rendering.figure(
+            f'{snake_case(class_1)}_{snake_case(class_2)}', plot_eda,
+            features_of_interest, class_1, class_2,
+            {class_1: data[class_1], class_2: data[class_2]}, pvalues,
+            orientation='landscape'))
+
+    return figures
 
 
 # %%        
@@ -147,17 +276,35 @@ def plot_eda(features_of_interest, class_1, class_2, cohort_classes, path):
 # =============================================================================
 
 if __name__=='__main__':
+    parser = argparse.ArgumentParser(description='Exploratory data analysis')
+    parser.add_argument('--stats-only', action='store_true',
+                        help='compute and store the statistics, without the '
+                        'figures')
+    args = parser.parse_args()
+    # make the dirs of the project and set up the logging (see @config.init)
+    c.init()
     # call the path constructor
     path = c.FetchPaths(c.PROJECTS_PATH, c.PROJECT_NAME)
-    cohort_classes = load_the_cohort_class_info(path)
-    features_of_interest = ['channel_variance','mean_amplitude',
-                            'power_spectral_density_max']
-    
-    for class_2 in c.classes:
-        if class_2 =='Healthy control':
-            continue
-        print(f'{snake_case("Healthy control")}_{snake_case(class_2)}')
-        plot_eda(features_of_interest, 'Healthy control', class_2, cohort_classes, path)
-
-
+    # record the resources used by the stage (see @profiling.py)
+    with profile('02_eda', path):
+        cohort_classes = load_the_cohort_class_info(path)
+        # load the signal metadata of each patient once for all figures
+        cohort = CohortSignalMetadata(path)
+        classes = ['Healthy control'] + [class_ for class_ in c.classes if
+                                         class_ != 'Healthy control']
+        data = {class_: cohort.class_array(cohort_classes[class_]) for class_
+                in classes}
+        # test all pairs of classes, leads and features at once
+        statistics = eda_stats.test_class_pairs(data, c.electrodes,
+                                                SIGNAL_FEATURES)
+        fname = eda_stats.save_statistics(statistics, path)
+        c.logging.info(f'{len(statistics)} Mann-Whitney U tests saved @{fname}')
+        features_of_interest = ['channel_variance','mean_amplitude',
+                                'power_spectral_density_max']
 
+        if not args.stats_only:
+            # draw the figures in parallel, headless (see @rendering.py)
+            fnames = rendering.render(eda_figures(features_of_interest,
+                                                  classes, data, statistics),
+                                      path)
+            print('\n'.join(fnames))
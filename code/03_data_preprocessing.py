@@ -1,6 +1,8 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 """
+Preprocess the time series of all patients. The patients can be split
+between several machines with "--shard i/N" (see @executors.py).
 
 @author: Christos
 """
@@ -9,20 +11,20 @@
 # IMPORT MODULES
 # =============================================================================
 
-import os
-from sklearn.preprocessing import StandardScaler
-from sklearnex import patch_sklearn
-patch_sklearn()
-import numpy as np
+import argparse
 import pandas as pd
 import itertools
-from scipy.ndimage import gaussian_filter1d
-from mne.parallel import parallel_func
 import wfdb
 import config as c
+import executors
+from signal_io import save_preprocessed, RawRecord
+from artifact_writer import ArtifactWriter
+from ingest import plan_patient, record_jobs, save_manifests
+from profiling import profile
+from preprocessing import preprocess_record_streaming, smooth_and_standardize
 
 
-def collect_recordings(patient, path):
+def collect_recordings(patient, path, records=None):
     '''
     Return the recording for a given patient and all electrodes. 
 
@@ -32,69 +34,81 @@ def collect_recordings(patient, path):
         e.g 'patient001'
     path : Class
         The path constructor
+    records : List, optional
+        The records to return. The default is all records of the patient.
 
-    Returns
+    Yields
     ----------
-    collector: Dict
-        Keys are records, values are the signal as numpy array for all elecs
+    record: String
+        The current record.
+    data: Numpy Array
+        The signal for all elecs (one record at a time is kept in memory)
     '''
     
-    # get the available records per patient
-    records = [f for f in os.listdir(c.join(path.to_info(),patient)) if not f.startswith('.')]
+    # get the available records per patient (see the index @00_)
+    if records is None:
+        records = path.records(patient)
     curr_patient = c.join(path.to_data_raw(), patient)
     
-    collector = {}
     for record in records:
+        if c.raw_reader == 'memmap':
+            # memory-mapped digital samples, converted in "raw_dtype"
+            yield record, RawRecord(c.join(curr_patient, record)).physical()
+            continue
         # read the record
         info = wfdb.rdrecord(c.join(curr_patient, record))
         # get the data from all leads
-        data = info.p_signal
-        # gather data for all records
-        collector[record] = data        
-    
-    return collector
+        yield record, info.p_signal
 
 
-def preprocess_signal(patient, path, collector):
+def preprocess_signal(patient, path, collector, writer=None):
     '''
     The following steps are applied to the signal coming from a 
     given recording:
-        1. Smoothing with a Gaussian kernel (width=10ms)
+        1. Smoothing with a Gaussian kernel (width=10ms, see
+                                             "kernel_width_sec" @config.py)
         2. Scaling (z-tranformation) of the time series
 
+    All leads are filtered at once and standardized in place (see
+    @preprocessing.smooth_and_standardize and the variables
+    "smoothing_method", "preprocessed_dtype" @config.py). If a writer is
+    given, each record is saved in the background while the next one is read
+    and preprocessed (see @artifact_writer.py).
     '''
     
-    scale= StandardScaler()    
-    for record in collector.keys():
-        data = collector[record] 
+    for record, data in collector:
 
-        width_sec = 0.01 # Gaussian-kernal width in [sec]
-        sr = 1000
-        for ch in range(data.shape[1]): # Loop over channels
-            time_series = data[:, ch]
-            data[:, ch] = gaussian_filter1d(time_series, width_sec*sr)
-  
-        
-        # standardize the data (z-tranform)
-        scaled_data = scale.fit_transform(data)
+        width_sec = c.kernel_width_sec # Gaussian-kernal width in [sec]
+        sr = c.sampling_rate
+        # smooth and standardize the data (z-tranform)
+        scaled_data = smooth_and_standardize(data, width_sec*sr)
         
         # save the scaled reording per segment in a separate directory 
-        # in the preprocessed folder
-        path2data=c.join(path.to_data_preprocessed(), patient, record)
-        if not c.exists(path2data):
-            c.make(path2data)
-        fname =  c.join(path2data, f'{patient}_{record}.npy')
-        np.save(fname, scaled_data)
+        # in the preprocessed folder (lead-major, see @signal_io.py)
+        save_preprocessed(scaled_data, path, patient, record, writer=writer)
         
-def main(patient):
+def main(patient, record):
     '''
     The main function that loads and preprocesses the 
-    data for all recordings of a given patient.
+    data of a given record of a patient. Each record is a separate job. The
+    records of the patients whose raw data and preprocessing settings did not
+    change since the previous run are skipped (see @ingest.plan_patient and
+    @incremental.py).
     '''
-    # return the data for all records     
-    collector = collect_recordings(patient, path) 
-    # preprocess and save the data
-    preprocess_signal(patient, path, collector)
+    # set up the logging of the worker (see @config.init)
+    c.init(worker=True)
+    with profile('03_data_preprocessing', patient=patient, record=record):
+        path = c.FetchPaths(c.PROJECTS_PATH, c.PROJECT_NAME)
+        if c.streaming:
+            # read, preprocess and save the record block by block
+            preprocess_record_streaming(c.join(path.to_data_raw(), patient,
+                                               record), patient, record, path)
+            return
+        # preprocess and save the data (the record is written at the end of
+        # the "with" block)
+        with ArtifactWriter() as writer:
+            preprocess_signal(patient, path, collect_recordings(
+                patient, path, [record]), writer)
     
 
 # %%        
@@ -103,21 +117,40 @@ def main(patient):
 # =============================================================================
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Preprocessing')
+    executors.add_arguments(parser)
+    args = parser.parse_args()
+    # make the dirs of the project and set up the logging (see @config.init)
+    c.init()
     # call the path constructor
     path = c.FetchPaths(c.PROJECTS_PATH, c.PROJECT_NAME)
-    # available patients
-    patient_list = pd.read_csv(
-        c.join(
-            path.to_info(),
-            'patients.tsv'),
-        header=None).values.tolist()
-    # unpack the list of lists
-    patients = list(itertools.chain(*patient_list))
-    # parallelize the main function
-    parallel, run_func, _ = parallel_func(main,n_jobs=c.n_jobs)
-    # run for all patients
-    parallel(run_func(patient) for patient in patients)
-    
-    
-        
-        
+    # record the resources used by the stage (see @profiling.py)
+    with profile('03_data_preprocessing', path):
+        # available patients
+        patient_list = pd.read_csv(
+            c.join(
+                path.to_info(),
+                'patients.tsv'),
+            header=None).values.tolist()
+        # unpack the list of lists (the patients of this machine, all
+        # unless "--shard i/N")
+        patients = executors.select_shard(itertools.chain(*patient_list),
+                                          args.shard)
+        if c.fused_ingest:
+            # the records were preprocessed @00_get_patient_info (see
+            # @ingest.py), while reading them for the signal metadata
+            c.logging.info('Preprocessing done by the fused ingest')
+        else:
+            # the work left for each patient
+            plans = executors.run(plan_patient, [
+                (patient, False, True, False, True) for patient in patients])
+            plans = [plan for plan in plans if plan is not None]
+            # run the main function in parallel, one job per record (the
+            # longest records first)
+            jobs, costs = record_jobs(plans)
+            executors.run(main, jobs, costs)
+            # all records of the patients are done
+            save_manifests(plans)
+            c.logging.info(f'{len(plans)} of {len(patients)} patients '
+                           f'({len(jobs)} records) preprocessed (the rest are '
+                           f'up to date)')
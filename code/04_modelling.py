@@ -11,17 +11,21 @@
 
 import os
 from sklearn.model_selection import StratifiedKFold, RandomizedSearchCV
+from sklearn.experimental import enable_halving_search_cv # noqa
+from sklearn.model_selection import HalvingRandomSearchCV
+from sklearn.model_selection import StratifiedGroupKFold
 from sklearn.model_selection import cross_val_score
-from sklearnex import patch_sklearn
-patch_sklearn()
 from lightgbm import LGBMClassifier
 import numpy as np
-import matplotlib.pyplot as plt
 import time
-import seaborn as sns
 import pickle
 import config as c
+from signal_io import load_preprocessed
+from features import compute_window_features
+from incremental import Manifest, load_digest
 from utils import snake_case, load_the_cohort_class_info
+from profiling import profile
+import lgbm_native
 
 
 # =============================================================================
@@ -34,8 +38,10 @@ def collect_data(patient_list, path, electrode):
     population, and for a given electrode (e.g: "avl"), load the PREPROCESSED
     data to be used for time-series classification. 
     
-    !!! At this stage, the function calls only data from the first record 
-    of each patient. 
+    The records of each patient are selected by the variable
+    "record_aggregation" @config.py: only the first record ('first') or all
+    of them (the other modes, see @make_sample_dataset and
+    @make_windowed_dataset).
 
     Parameters
     ----------
@@ -51,83 +57,290 @@ def collect_data(patient_list, path, electrode):
     Returns
     -------
     collector : List
-        Contains preprocessed data of the first recording of each patient.
+        One list per patient with the preprocessed data of its selected
+        records (memory-mapped views, see @signal_io.py: nothing is read
+        until the data are used).
 
     '''
     
-    elec_index = c.electrodes.index(electrode)
-    
     collector = []
     for patient in patient_list:
-        # get the available records per patient
-        records = [f for f in os.listdir(c.join(path.to_info(),patient)) if not f.startswith('.')]
-        record = records[0]
-        fname=c.join(path.to_data_preprocessed(), patient, record, f'{patient}_{record}.npy')
-        data = np.load(fname)[:,elec_index]    
-        collector.append(data)
+        # the sorted records of the patient (see the index @00_)
+        records = path.records(patient)
+        if c.record_aggregation == 'first':
+            records = records[:1]
+        collector.append([load_preprocessed(path, patient, record, electrode)
+                          for record in records])
         
     return collector
 
-def make_sklearn_compatible(class_1, class_2):
+def make_sample_dataset(class_1, class_2, fname=None, groups_fname=None):
     '''
-    Given two arrays that correspond to two selected classes, transform the 
-    data into the standard SKLEARN format. 
+    Given the recordings of two selected classes, transform the data into the
+    standard SKLEARN format (one row per sample). The feature matrix is
+    allocated once and filled from the memory-mapped recordings, so that no
+    intermediate copy of the data is made. In the out-of-core mode (see the
+    variable "out_of_core" @config.py), the feature matrix and the groups are
+    memory-mapped .npy files, so that the samples of both classes do not have
+    to fit in RAM (the targets take a single byte per sample).
     
     The lists are created @collect_data
 
     Parameters
     ----------
-    class_1 : Array
-        E.g: Data from the "healthy control" population.
-    class_2 : Array
-        E.g: Data from the "heart failure" population.
+    class_1 : List
+        E.g: The recordings of the "healthy control" population.
+    class_2 : List
+        E.g: The recordings of the "heart failure" population.
+    fname : String, optional
+        The .npy file of the feature matrix (out-of-core mode). If None, the
+        feature matrix is kept in memory.
+    groups_fname : String, optional
+        The .npy file of the groups (out-of-core mode). If None, the groups
+        are kept in memory.
 
     Returns
     -------
-    X : Array
+    X : Array (#samples X 1)
         The feature matrix (in this case, all the samples corresponding to both 
                             classes of interest).
-    y : 1D Array (len = LEN(SAMPLES(class 1 & class2)))
+    y : 1D Array (len = LEN(SAMPLES(class 1 & class2)), int8)
         The target array is the concatenation of the samples belonging to each
         class. Since we framed this as a univariate, binary classification problem,
         this is a vector containg ones and zeros
+    groups : 1D Array (len = #samples) or None
+        The index of the patient each sample belongs to, when the records are
+        kept as separate recordings (record_aggregation='separate'
+        @config.py), so that the CV folds are grouped by patient.
 
     '''
+    if c.record_aggregation in ('mean', 'median'):
+        raise ValueError(f"record_aggregation='{c.record_aggregation}' "
+                         f"reduces the features of the records and requires "
+                         f"modelling_input='windowed'")
     # Keep the seed constant (42)
     np.random.seed(42)
+    patients = [(label, records) for label, class_data in
+                ((1, class_1), (0, class_2)) for records in class_data]
+    recordings = [(label, patient, time_series) for patient, (label, records)
+                  in enumerate(patients) for time_series in records]
+    n_samples = sum(len(time_series) for _, _, time_series in recordings)
     # Make the data compatible with sklearn
-    X = np.concatenate((class_1, class_2))
-    y = np.concatenate((np.ones(class_1.shape[0]), np.zeros(class_2.shape[0])))  
+    if fname is None:
+        X = np.empty((n_samples, 1), dtype=recordings[0][2].dtype)
+    else:
+        X = np.lib.format.open_memmap(fname, mode='w+',
+                                      dtype=c.out_of_core_dtype,
+                                      shape=(n_samples, 1))
+    y = np.empty(n_samples, dtype=np.int8)
+    # the groups are only needed if the records are kept separate
+    groups = None
+    if c.record_aggregation == 'separate':
+        if groups_fname is None:
+            groups = np.empty(n_samples, dtype=np.int32)
+        else:
+            groups = np.lib.format.open_memmap(groups_fname, mode='w+',
+                                               dtype=np.int32,
+                                               shape=(n_samples,))
+    position = 0
+    for label, patient, time_series in recordings:
+        X[position:position + len(time_series), 0] = time_series
+        y[position:position + len(time_series)] = label
+        if groups is not None:
+            groups[position:position + len(time_series)] = patient
+        position += len(time_series)
+    if fname is not None:
+        # the pages are written to the file (and can be dropped from memory)
+        X.flush()
+    if groups_fname is not None and groups is not None:
+        groups.flush()
+
+    return X, y, groups
+
+def make_windowed_dataset(class_1, class_2):
+    '''
+    Segment each recording into fixed-length windows and describe each window
+    with a feature vector (see @features.compute_window_features). Used
+    instead of @make_sample_dataset when modelling_input='windowed'
+    @config.py
+
+    Parameters
+    ----------
+    class_1 : List
+        E.g: The recordings of the "healthy control" population
+        (created @collect_data).
+    class_2 : List
+        E.g: The recordings of the "heart failure" population.
 
-    return X,y
+    The records of each patient are windowed separately, or concatenated
+    first ('concatenate'), or the features of all windows are reduced to a
+    single vector per patient ('mean', 'median'), see "record_aggregation"
+    @config.py
 
-def plot_target_distribution(y, path, class_1, class_2):
+    Returns
+    -------
+    X : Array (#windows X #features)
+        The feature matrix (the windows of both classes).
+    y : 1D Array (len = #windows)
+        Ones for the windows of class_1 and zeros for those of class_2.
+    groups : 1D Array (len = #windows)
+        The index of the patient each window belongs to (used to group the
+        CV folds).
+
+    '''
+    window_size = int(c.window_length_sec * c.sampling_rate)
+    step = int(c.window_step_sec * c.sampling_rate)
+
+    X, y, groups = [], [], []
+    for label, class_data in ((1, class_1), (0, class_2)):
+        for records in class_data:
+            if c.record_aggregation == 'concatenate':
+                # a single recording per patient (one patient at a time)
+                records = [np.concatenate(records)]
+            features = np.concatenate([compute_window_features(
+                time_series, window_size, step, c.sampling_rate)
+                for time_series in records])
+            if c.record_aggregation in ('mean', 'median'):
+                # a single feature vector per patient
+                reduce = getattr(np, c.record_aggregation)
+                features = reduce(features, axis=0, keepdims=True)
+            X.append(features)
+            y.append(np.full(len(features), label))
+            groups.append(np.full(len(features), len(groups)))
+
+    return np.concatenate(X), np.concatenate(y), np.concatenate(groups)
+
+class CVSplits():
+    '''
+    The (train, test) indices of the CV folds, generated one fold at a time
+    from the fold of each sample (a single byte per sample), instead of
+    keeping the indices of all folds in memory. It can be iterated several
+    times (e.g: by each candidate of the search) and is accepted as the "cv"
+    of sklearn.
+    Attributes:
+        1. folds (the test fold of each sample)
+        2. n_splits
+    '''
+
+    def __init__(self, folds, n_splits):
+        self.folds = folds
+        self.n_splits = n_splits
+
+    def __len__(self):
+        return self.n_splits
+
+    def __iter__(self):
+        for fold in range(self.n_splits):
+            yield (np.flatnonzero(self.folds != fold),
+                   np.flatnonzero(self.folds == fold))
+
+
+def make_cv_splits(X, y, groups=None, n_splits=5):
+    '''
+    Return the (train, test) indices of the stratified CV folds (see
+    @CVSplits). If groups are given (e.g: windows of the same patient), the
+    folds are also grouped, so that no patient contributes to both the train
+    and the test set. When a class has fewer patients than folds, grouping
+    is not possible and the folds are only stratified.
+    '''
+    y = np.ravel(y, order='C')
+    if groups is not None and min(len(np.unique(groups[y == label]))
+                                  for label in (0, 1)) >= n_splits:
+        cv = StratifiedGroupKFold(n_splits=n_splits, shuffle=True,
+                                  random_state=c.random_state)
+        splits = cv.split(X=X, y=y, groups=groups)
+    else:
+        if groups is not None:
+            c.logging.warning('Too few patients to group the CV folds')
+        cv = StratifiedKFold(n_splits=n_splits, shuffle=True,
+                             random_state=c.random_state)
+        splits = cv.split(X=X, y=y)
+    # the test fold of each sample (the splits are generated one at a time)
+    folds = np.empty(len(y), dtype=np.int8)
+    for fold, (_, test) in enumerate(splits):
+        folds[test] = fold
+
+    return CVSplits(folds, n_splits)
+
+def plot_target_distribution(y, class_1, class_2):
     '''
     Plots the distribution of the target values. This is used to select the
-    appropriate evaluation metric.
+    appropriate evaluation metric. Returns the figure, to be saved with
+    @rendering.render, e.g:
+        rendering.render([rendering.figure(
+            f'target_distribution_{snake_case(class_1)}_vs_'
+            f'{snake_case(class_2)}', plot_target_distribution, y, class_1,
+            class_2)], path)
 
     '''
-    fig=plt.figure(dpi=100, facecolor='w', edgecolor='w')
-    #fig.set_size_inches(20, 10)
-    sns.displot(y)
+    # imported here, so that the workers of the models do not load them
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+    # displot draws its own figure
+    fig = sns.displot(y).figure
+    fig.set_dpi(100)
+    fig.set_facecolor('w')
     plt.ylabel('# counts ')
     plt.xlabel('target')
     plt.xticks([0,1])
     plt.title(f'Distribution of target values. \n {class_1} VS {class_2}',
               style='oblique', fontweight='bold', y=1.05)
 
+    return fig
     
-    
-    fig.savefig(fname=os.path.join(path.to_images(),
-                                   f'target_distribution_{snake_case(class_1)}_vs_{snake_case(class_2)}.png'),
-                bbox_inches='tight')
-    plt.show()
-    
 
 
-def cross_val_hyperparam_tuning(RUN_RANDOMSEARCH,model, X,y, path):
+def params_fname(path, key):
+    '''
+    Returns the filename of the best params of a given model
+    (e.g: key = 'healthy_control_vs_palpitation_ii').
+    '''
+    return c.join(path.to_params(), f'{key}.pkl')
+
+
+def find_params(path, key):
+    '''
+    Returns the file of the stored params of a given model, or the params
+    shared by all models (best_params.pkl, previous versions) if the model
+    has none. If neither exists, the file of the model is returned (and
+    loading it raises an error).
+    '''
+    fname = params_fname(path, key)
+    shared_fname = params_fname(path, 'best_params')
+    if not os.path.isfile(fname) and os.path.isfile(shared_fname):
+        return shared_fname
+
+    return fname
+
+
+def make_search(model, cv, n_jobs):
+    '''
+    Returns the search of the hyperparameters of "param_test" @config.py
+    (see the variable "search_method" @config.py). In the successive halving,
+    the budget of each candidate is the number of rows of the training folds.
+    The best candidate is not refitted (only its params are used).
+    '''
+    if c.search_method == 'halving':
+        return HalvingRandomSearchCV(model, param_distributions=c.param_test,
+                                     n_candidates=c.search_n_candidates,
+                                     factor=c.search_factor,
+                                     resource='n_samples',
+                                     min_resources='exhaust', cv=cv,
+                                     refit=False, random_state=c.random_state,
+                                     n_jobs=n_jobs)
+
+    return RandomizedSearchCV(model, param_distributions=c.param_test,
+                              n_iter=c.search_n_iter, cv=cv, refit=False,
+                              random_state=c.random_state, n_jobs=n_jobs)
+
+
+def cross_val_hyperparam_tuning(RUN_RANDOMSEARCH,model, X,y, path, n_jobs=-1,
+                                cv=None, key='best_params', settings=None,
+                                dataset=None):
     '''
-    Perform Randomized search on hyper parameters. 
+    Perform Randomized search on hyper parameters (successive halving or a
+    full randomized search, see @make_search). The best params of each model
+    are stored in the params dir.
 
     Parameters
     ----------
@@ -139,6 +352,20 @@ def cross_val_hyperparam_tuning(RUN_RANDOMSEARCH,model, X,y, path):
         Target.
     path : Class
         Used to save the best params if RUN_RANDOMSEARCH=False.
+    n_jobs : Int
+        The number of CV fits that run in parallel (see @allocate_cores).
+    cv : List, optional
+        The CV splits (see @make_cv_splits). If None, 5 stratified folds.
+    key : String, optional
+        The model the params belong to (e.g:
+        'healthy_control_vs_palpitation_ii'), see @params_fname.
+    settings : Dict, optional
+        The data (e.g: the preprocessing digests of the patients) and the
+        settings of the search. The params of a previous search are reused
+        if they did not change (see @incremental.py).
+    dataset : lgb.Dataset, optional
+        The binned dataset of the native backend ("lgbm_backend" @config.py,
+        see @lgbm_native.py). If None, the search uses the sklearn API.
 
     Returns
     -------
@@ -149,32 +376,45 @@ def cross_val_hyperparam_tuning(RUN_RANDOMSEARCH,model, X,y, path):
 
     '''
 
-  
-
+    fname = params_fname(path, key)
     if RUN_RANDOMSEARCH:
+        # skip the search if the data and the settings did not change
+        manifest = Manifest(path, 'tuning', key)
+        if settings is not None and manifest.is_up_to_date([], settings,
+                                                           [fname]):
+            with open(fname, 'rb') as f:
+                best_params = pickle.load(f)
+            print(f'{key}: params up to date')
+            return best_params
+
         print('Hyper-param tuning')        
         start_time = time.time()
-        gkf = StratifiedKFold(n_splits=5, shuffle=True,
-                              random_state=c.random_state).split(X=X, y=y)
-        rsearch = RandomizedSearchCV(model, 
-                                     param_distributions=c.param_test,
-                                     cv=gkf, n_jobs=-1)
-        lgb_model_random = rsearch.fit(X=X, y=np.ravel(y,order='C'))
-        
-        best_params = lgb_model_random.best_params_
+        gkf = make_cv_splits(X, y) if cv is None else cv
+        if dataset is not None:
+            # the fits share the binned dataset (see @lgbm_native.py)
+            best_params, best_score = lgbm_native.search(
+                model, dataset, X, y, gkf, num_threads=n_jobs * model.n_jobs)
+        else:
+            rsearch = make_search(model, gkf, n_jobs)
+            lgb_model_random = rsearch.fit(X=X, y=np.ravel(y,order='C'))
+            best_params = lgb_model_random.best_params_
+            best_score = lgb_model_random.best_score_
         best_params["objective"] = "binary"
         
-        print(lgb_model_random.best_params_, lgb_model_random.best_score_)
+        print(best_params, best_score)
         print("--- %s seconds ---" % (time.time() - start_time))
-        # save the parameters
+        # save the parameters (one file per model)
         if not c.exists(path.to_params()):
-            c.make(path.to_params())
-        with open(c.join(path.to_params() ,'best_params.pkl'), 'wb') as f:
-            pickle.dump(lgb_model_random.best_params_, f)
-        
-        best_params = lgb_model_random.best_params_ 
+            c.make(path.to_params(), exist_ok=True)
+        with open(fname, 'wb') as f:
+            pickle.dump(best_params, f)
+        if settings is not None:
+            manifest.save([fname])
     else:
-        with open(c.join(path.to_params() ,'best_params.pkl'), 'rb') as f:
+        # the params of the model, or the ones shared by all models
+        # (previous versions)
+        fname = find_params(path, key)
+        with open(fname, 'rb') as f:
             best_params = pickle.load(f)
 
         
@@ -185,7 +425,40 @@ def cross_val_hyperparam_tuning(RUN_RANDOMSEARCH,model, X,y, path):
 # MAIN MODELLING FUNCTION ##
 ############################
 
-def modeling(class_1, class_2, electrode, path):
+def allocate_cores(n_models, n_folds=5):
+    '''
+    Split the core budget ("n_jobs" @config.py) between the (class, electrode)
+    models that run in parallel, the CV folds of each model and the LightGBM
+    threads of each fit, so that the cores are not oversubscribed.
+
+    Parameters
+    ----------
+    n_models : Int
+        The number of (class, electrode) models to fit.
+    n_folds : Int
+        The number of CV folds of each model.
+
+    Returns
+    -------
+    n_outer : Int
+        The number of models fitted in parallel.
+    n_cv : Int
+        The number of CV fits that run in parallel within each model.
+    n_threads : Int
+        The number of LightGBM threads of each fit.
+
+    '''
+    n_cores = os.cpu_count() if c.n_jobs < 0 else c.n_jobs
+    n_outer = n_models if c.n_jobs_models < 0 else c.n_jobs_models
+    n_outer = max(1, min(n_outer, n_models, n_cores))
+    n_cv = max(1, min(n_folds, n_cores // n_outer))
+    n_threads = max(1, n_cores // (n_outer * n_cv))
+
+    return n_outer, n_cv, n_threads
+
+
+def modeling(class_1, class_2, electrode, path, cohort_classes,
+             RUN_RANDOMSEARCH, n_cv=-1, n_threads=-1):
     '''
     1. Given a set of two classes and a selected electrode, perform 
     classification using the LightGBM classifier. 
@@ -203,6 +476,14 @@ def modeling(class_1, class_2, electrode, path):
         e.g: 'ii'.
     path : Class
         The path constructor.
+    cohort_classes : Dict
+        Maps the classes to patients (see @load_the_cohort_class_info).
+    RUN_RANDOMSEARCH : Bool
+        Whether to run the randomized search or load previous best params.
+    n_cv : Int
+        The number of CV fits that run in parallel.
+    n_threads : Int
+        The number of LightGBM threads of each fit.
 
     Returns
     -------
@@ -211,57 +492,126 @@ def modeling(class_1, class_2, electrode, path):
 
     '''
 
-    # load data for each class
-    class_1_data = collect_data(cohort_classes[class_1], path, electrode)
-    # concatenate all data per channel type and tranform into a np array
-    class_1_concat = np.concatenate([np.array(i) for i in class_1_data])
-    del class_1_data
-    class_2_data = collect_data(cohort_classes[class_2], path, electrode)
-    # concatenate all data per channel type and tranform into a np array
-    class_2_concat = np.concatenate([np.array(i) for i in class_2_data])    
-    del class_2_data
-    # make data sklearn compatible
-    X, y = make_sklearn_compatible(class_1_concat, class_2_concat)
-    # reshape given that we work with 1D data
-    X = X.reshape(-1, 1)
-    y = y.reshape(-1, 1)
-    del class_1_concat, class_2_concat
-
-    ########################        
-    # Set up the model
-    ########################
-    # CLASSIFICATION USING LightGBM
-    clf = LGBMClassifier(
-        boosting_type="gbdt", objective="binary", learning_rate=0.01,
-        metric="auc")
-    #######################################        
-    # Hyperparam tuning using randomsearch
-    #######################################        
-    best_params = cross_val_hyperparam_tuning(RUN_RANDOMSEARCH, clf,
-                                          X,y, path)
-    
-    skf = StratifiedKFold(n_splits=5, shuffle=True,random_state=c.random_state)
-    model = LGBMClassifier(**best_params)
-    
-    # Gather the scores across the folds
-    scores = cross_val_score(model, X, y=np.ravel(y,order='C'),
-                              cv=skf, scoring='roc_auc', n_jobs=-1) 
-    results = np.mean(scores)
-    
-    
     # construct the fname
-    class_1 = snake_case(class_1)
-    class_2 = snake_case(class_2)
-    class_name = class_1+'_vs_'+class_2
-
-    
+    class_name = snake_case(class_1)+'_vs_'+snake_case(class_2)
     path2results = c.join(path.to_results(),class_name,
                           f'electrode_{electrode}')
+    fname = c.join(path2results, f'{class_name}_{electrode}.npy')
+
+    # skip the model if the preprocessed data of both classes and the
+    # settings did not change since the previous run (see @incremental.py)
+    patients = cohort_classes[class_1] + cohort_classes[class_2]
+    key = f'{class_name}_{electrode}'
+    # the params of the model (or the ones shared by all models)
+    fname_params = find_params(path, key)
+    inputs = [] if RUN_RANDOMSEARCH else [fname_params]
+    # the data of the model and the settings of the search (the params are
+    # reused if they did not change, see @cross_val_hyperparam_tuning)
+    search_settings = {'class_1': cohort_classes[class_1],
+                       'class_2': cohort_classes[class_2],
+                       'preprocessing': [load_digest(path, 'preprocessing',
+                                                     patient)
+                                         for patient in patients],
+                       'modelling_input': c.modelling_input,
+                       'window': [c.window_length_sec, c.window_step_sec],
+                       'record_aggregation': c.record_aggregation,
+                       'out_of_core': [c.out_of_core, c.out_of_core_dtype],
+                       'lgbm_backend': c.lgbm_backend,
+                       'param_test': c.param_test,
+                       'random_state': c.random_state,
+                       'search': [c.search_method, c.search_n_candidates,
+                                  c.search_factor, c.search_n_iter]}
+    settings = {**search_settings, 'run_randomsearch': RUN_RANDOMSEARCH}
+    manifest = Manifest(path, 'modelling', key)
+    if manifest.is_up_to_date(inputs, settings, [fname]):
+        results = np.load(fname)
+        print(f'{class_name}_{electrode}. AUC: {results} (up to date)')
+        return results
+
+    # the feature matrix and the groups of the out-of-core mode (removed once
+    # the model is evaluated, or if it fails)
+    design_fnames = []
+    if c.out_of_core and c.modelling_input != 'windowed':
+        if c.lgbm_backend != 'native':
+            raise ValueError("out_of_core requires lgbm_backend='native' (the "
+                             "sklearn API copies the training rows of each "
+                             "fold into memory)")
+        design_fnames = [c.join(path2results, f'{key}_X.npy'),
+                         c.join(path2results, f'{key}_groups.npy')]
+
+    try:
+        # load data for each class
+        class_1_data = collect_data(cohort_classes[class_1], path, electrode)
+        class_2_data = collect_data(cohort_classes[class_2], path, electrode)
+        if c.modelling_input == 'windowed':
+            # one row per window (compact feature vector)
+            X, y, groups = make_windowed_dataset(class_1_data, class_2_data)
+            y = y.reshape(-1, 1)
+        else:
+            # one row per sample: all data per channel type (see
+            # @make_sample_dataset), in files in the out-of-core mode
+            if design_fnames and not c.exists(path2results):
+                c.make(path2results, exist_ok=True)
+            X, y, groups = make_sample_dataset(class_1_data, class_2_data,
+                                               *design_fnames)
+            y = y.reshape(-1, 1)
+        del class_1_data, class_2_data
+        # the CV folds (grouped by patient in the windowed mode and when the
+        # records are kept separate)
+        cv_splits = make_cv_splits(X, y, groups)
+
+        ########################        
+        # Set up the model
+        ########################
+        # CLASSIFICATION USING LightGBM
+        clf = LGBMClassifier(
+            boosting_type="gbdt", objective="binary", learning_rate=0.01,
+            metric="auc", n_jobs=n_threads)
+        #######################################        
+        # Hyperparam tuning (see "search_method" @config.py)
+        #######################################        
+        dataset = None
+        if c.lgbm_backend == 'native':
+            # bin the data once for all fits (see @lgbm_native.py)
+            if not c.exists(path2results):
+                c.make(path2results, exist_ok=True)
+            dataset = lgbm_native.build_dataset(
+                X, y, c.join(path2results, f'{key}_dataset.bin'),
+                Manifest(path, 'lgbm_dataset', key),
+                {setting: search_settings[setting] for setting in
+                 ('class_1', 'class_2', 'preprocessing', 'modelling_input',
+                  'window', 'record_aggregation', 'out_of_core')})
+        best_params = cross_val_hyperparam_tuning(RUN_RANDOMSEARCH, clf,
+                                              X,y, path, n_jobs=n_cv,
+                                              cv=cv_splits, key=key,
+                                              settings=search_settings,
+                                              dataset=dataset)
+        
+        model = LGBMClassifier(**best_params, n_jobs=n_threads)
+        
+        # Gather the scores across the folds
+        if c.lgbm_backend == 'native':
+            # the folds run one after the other, with all the threads
+            results = lgbm_native.cross_val_auc(model, dataset, X, y,
+                                                cv_splits,
+                                                num_threads=n_cv * n_threads)
+        else:
+            scores = cross_val_score(model, X, y=np.ravel(y,order='C'),
+                                      cv=cv_splits, scoring='roc_auc',
+                                      n_jobs=n_cv)
+            results = np.mean(scores)
+    finally:
+        # release the memory maps before removing their files
+        X = y = groups = dataset = None
+        for design_fname in design_fnames:
+            if os.path.exists(design_fname):
+                os.remove(design_fname)
+
+    # save the results
     if not c.exists(path2results):
         c.make(path2results)
-    
-    fname = c.join(path2results, f'{class_name}_{electrode}.npy')
     np.save(fname, results)
+    manifest.save([fname])
     
     
     # log and print
@@ -271,34 +621,73 @@ def modeling(class_1, class_2, electrode, path):
     
     # return the mean AUC across folds
     return results
+
+
+def run_model_job(class_1, class_2, electrode, path, cohort_classes,
+                  RUN_RANDOMSEARCH, n_cv, n_threads):
+    '''
+    Wrapper of @modeling that runs in the workers of the process pool and
+    returns the wall time of the job alongside the results. The resources
+    used by the job are recorded in the run report (see @profiling.py).
+    '''
+    # set up the logging of the worker (see @config.init)
+    c.init(worker=True)
+    start_time = time.time()
+    with profile('04_modelling', path, class_name=snake_case(class_2),
+                 electrode=electrode):
+        results = modeling(class_1, class_2, electrode, path, cohort_classes,
+                           RUN_RANDOMSEARCH, n_cv=n_cv, n_threads=n_threads)
+
+    return class_2, electrode, results, time.time() - start_time
 # %%
 # =============================================================================
 # EXECUTE AND RUN FOR ALL POSSIBLE CLASSES AND GIVEN ELECTRODES
 # =============================================================================
-# * This step can be parallelized at a selected level (e.g classes or elecs)
-# I did not do it because I ran the analysis at my laptop.
+# The (class, electrode) models run in parallel on a process pool. The cores
+# are split between the models, the CV folds and the LightGBM threads
+# (see @allocate_cores and the variables "n_jobs", "n_jobs_models" @config.py).
 
 if __name__=='__main__':
     
     # set to false in order to not relaunch the RandomSearch and
     # use the best hyperparameters that already calculated
     RUN_RANDOMSEARCH = True
+    # make the dirs of the project and set up the logging (see @config.init)
+    c.init()
+    # accelerate scikit-learn in the main process only (e.g: roc_auc_score
+    # @lgbm_native.py), the workers do not import the extension
+    from sklearnex import patch_sklearn
+    patch_sklearn()
+    # do not log each call of the accelerated functions (e.g: roc_auc_score)
+    c.logging.getLogger('sklearnex').setLevel(c.logging.WARNING)
+    # the outer jobs only are dispatched from here (the workers do not need
+    # mne)
+    from mne.parallel import parallel_func
     # call the path constructor
     path = c.FetchPaths(c.PROJECTS_PATH, c.PROJECT_NAME)
-    # get the map of patients --> condition
-    cohort_classes = load_the_cohort_class_info(path)
-    
-    
-    class_1 = 'Healthy control'
-    # Loop through classes
-    for class_2 in c.classes:
-        if class_2==class_1:
-            continue
-        # Now loop through electrodes
-        for electrode in c.electrodes:
-            modeling(class_1, class_2, electrode, path)
-            
-        
-    
-    
-    
\ No newline at end of file
+    # record the resources used by the stage (see @profiling.py)
+    with profile('04_modelling', path):
+        # get the map of patients --> condition
+        cohort_classes = load_the_cohort_class_info(path)
+
+        class_1 = 'Healthy control'
+        # all (class, electrode) jobs
+        jobs = [(class_2, electrode) for class_2 in c.classes if class_2 != class_1
+                for electrode in c.electrodes]
+        n_outer, n_cv, n_threads = allocate_cores(len(jobs))
+        c.logging.info(f'{len(jobs)} models: {n_outer} in parallel, {n_cv} CV '
+                       f'fits per model, {n_threads} LightGBM threads per fit')
+
+        start_time = time.time()
+        parallel, run_func, _ = parallel_func(run_model_job, n_jobs=n_outer)
+        timings = parallel(run_func(class_1, class_2, electrode, path,
+                                    cohort_classes, RUN_RANDOMSEARCH, n_cv,
+                                    n_threads)
+                           for class_2, electrode in jobs)
+        wall_time = time.time() - start_time
+
+        # report the wall time of each job
+        for class_2, electrode, results, job_time in timings:
+            c.logging.info(f'{snake_case(class_2)}_{electrode}: {job_time:.1f} sec')
+        c.logging.info(f'Modelling done in {wall_time:.1f} sec (sum of the jobs: '
+                       f'{sum(t[-1] for t in timings):.1f} sec)')
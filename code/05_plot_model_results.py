@@ -2,7 +2,8 @@
 # -*- coding: utf-8 -*-
 """
 Plot the results of the classification analysis as a heatmap. 
-Results saved @the "images" dir.
+Results saved @the "images" dir (headless, and only if the results changed,
+see @rendering.py).
 
 @author: Christos
 """
@@ -11,12 +12,11 @@ Results saved @the "images" dir.
 # =============================================================================
 
 import numpy as np
-import os
 import pandas as pd
-import matplotlib.pyplot as plt
-import seaborn as sns
 import config as c
+import rendering
 from utils import snake_case
+from profiling import profile
 
 
 
@@ -53,37 +53,23 @@ def load_results(class_name, electrode, path):
     return np.round(results,2)
 
 
-# %%
-# =============================================================================
-# EXECUTE AND PLOT THE HEATMAP WITH THE CLASSIFICATION RESULTS
-# =============================================================================
+def plot_scores(scores):
+    '''
+    Plot the mean AUC of each model as a heatmap.
 
-if __name__=='__main__':
-    # call the path constructor
-    path = c.FetchPaths(c.PROJECTS_PATH, c.PROJECT_NAME)
-    
-    collector={}
-    class_1 = 'Healthy control'
-    # Loop through classes
-    for class_2 in c.classes:
-        # construct the fname
-        class_1 = snake_case(class_1)
-        class_2 = snake_case(class_2)
-        class_name = class_1+'_vs_'+class_2
-        if class_name=='healthy_control_vs_healthy_control':
-            continue
-        collector[class_name]={}
-        # Now loop through electrodes
-        for electrode in c.electrodes:
-            collector[class_name][electrode] = load_results(class_name, electrode, path)
-            
-    scores = pd.DataFrame(collector).T
-    
-    # sort by best overall prediction
-    scores=scores.reindex(scores.mean(axis=1).sort_values(ascending=False,
-                                                          na_position='first').index, axis=0)
-    
+    Parameters
+    ----------
+    scores : Pandas Dataframe
+        #class pairs X #electrodes, the mean AUC of each model.
 
+    Returns
+    -------
+    fig : Figure
+        The figure (saved @rendering.py).
+
+    '''
+    import matplotlib.pyplot as plt
+    import seaborn as sns
     fig=plt.figure(dpi=100, facecolor='w', edgecolor='w')
     fig.set_size_inches(18.5, 10.5)
 
@@ -95,7 +81,44 @@ if __name__=='__main__':
                     labelsize=10, labelbottom = False, 
                     bottom=False, top = False, labeltop=True,)
     plt.title('Inference based on time-series alone', y=1.05)
-    fig.savefig(fname=os.path.join(path.to_images(),'auc_results_time_series_only.png'),
-                bbox_inches='tight')
-    plt.show()
-    
+
+    return fig
+
+
+# %%
+# =============================================================================
+# EXECUTE AND PLOT THE HEATMAP WITH THE CLASSIFICATION RESULTS
+# =============================================================================
+
+if __name__=='__main__':
+    # make the dirs of the project and set up the logging (see @config.init)
+    c.init()
+    # call the path constructor
+    path = c.FetchPaths(c.PROJECTS_PATH, c.PROJECT_NAME)
+    # record the resources used by the stage (see @profiling.py)
+    with profile('05_plot_model_results', path):
+        collector={}
+        class_1 = 'Healthy control'
+        # Loop through classes
+        for class_2 in c.classes:
+            # construct the fname
+            class_1 = snake_case(class_1)
+            class_2 = snake_case(class_2)
+            class_name = class_1+'_vs_'+class_2
+            if class_name=='healthy_control_vs_healthy_control':
+                continue
+            collector[class_name]={}
+            # Now loop through electrodes
+            for electrode in c.electrodes:
+                collector[class_name][electrode] = load_results(class_name, electrode, path)
+
+        scores = pd.DataFrame(collector).T
+
+        # sort by best overall prediction
+        scores=scores.reindex(scores.mean(axis=1).sort_values(ascending=False,
+                                                              na_position='first').index, axis=0)
+
+
+        # draw the heatmap headless (see @rendering.py)
+        rendering.render([rendering.figure('auc_results_time_series_only',
+                                           plot_scores, scores)], path)
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Background writer of the per-record artifacts (e.g: the header metadata
+.csv files @00_get_patient_info.py and the preprocessed .npy files
+@03_data_preprocessing.py).
+
+The workers hand each artifact to a small pool of threads and move on to the
+next record, so that writing to (slow, shared) storage overlaps with the
+reading and the processing of the next record. Specifically:
+    1. At most "writer_queue_size" artifacts are pending at any time (the
+       worker waits for a slot), which bounds the extra memory.
+    2. Each directory is created once per writer.
+    3. Each artifact is written to a temporary file that is renamed to its
+       final name, so that an interrupted run never leaves a partial
+       artifact.
+    4. All pending artifacts are written when the writer is closed (at the
+       end of the "with" block of each worker) and any error of the
+       background threads is raised there.
+
+Set the variable "async_writer" @config.py to False to write the artifacts
+synchronously (still atomically). A single artifact written without a writer
+is written on the calling thread (see @write_atomic).
+
+@author: Christos
+"""
+
+# =============================================================================
+# IMPORT MODULES
+# =============================================================================
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import config as c
+
+
+# =============================================================================
+# WRITE FUNCTIONS
+# =============================================================================
+def write_npy(array, f):
+    '''
+    Write an array as .npy (C-contiguous, e.g: the lead-major layout of
+    @signal_io.save_preprocessed).
+    '''
+    np.save(f, np.ascontiguousarray(array))
+
+
+def write_csv(dataframe, f):
+    '''
+    Write a pandas dataframe as .csv.
+    '''
+    dataframe.to_csv(f)
+
+
+def write_atomic(fname, write, obj, makedirs=True):
+    '''
+    Write an artifact on the calling thread, atomically (a temporary file
+    that is renamed to its final name), e.g:
+        write_atomic(fname, write_npy, array)
+    Used when no writer is given (a single artifact does not need a pool of
+    threads) and by the threads of @ArtifactWriter.
+    '''
+    if makedirs:
+        os.makedirs(os.path.dirname(fname), exist_ok=True)
+    tmp_fname = f'{fname}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        with open(tmp_fname, 'wb') as f:
+            write(obj, f)
+        os.replace(tmp_fname, fname)
+    except BaseException:
+        if os.path.exists(tmp_fname):
+            os.remove(tmp_fname)
+        raise
+
+
+# =============================================================================
+# WRITER
+# =============================================================================
+class ArtifactWriter():
+    '''
+    Writes the artifacts in background threads (see the module docstring).
+    Use it as a context manager, e.g:
+        with ArtifactWriter() as writer:
+            writer.save_npy(fname, data)
+    Attributes:
+        1. n_threads
+        2. max_pending (the maximum number of pending artifacts)
+    '''
+
+    def __init__(self, n_threads=None, max_pending=None):
+        self.n_threads = c.writer_threads if n_threads is None else n_threads
+        self.max_pending = (c.writer_queue_size if max_pending is None else
+                            max_pending)
+        self._pool = None
+        if c.async_writer:
+            self._pool = ThreadPoolExecutor(max_workers=self.n_threads)
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+        self._dirs = set()
+        self._dirs_lock = threading.Lock()
+        self._futures = []
+
+    def makedirs(self, dirname):
+        '''
+        Create a directory (once per writer).
+        '''
+        with self._dirs_lock:
+            if dirname in self._dirs:
+                return
+            os.makedirs(dirname, exist_ok=True)
+            self._dirs.add(dirname)
+
+    def _write(self, fname, write, obj):
+        '''
+        Write an artifact atomically (temporary file and rename).
+        '''
+        try:
+            self.makedirs(os.path.dirname(fname))
+            write_atomic(fname, write, obj, makedirs=False)
+        finally:
+            self._slots.release()
+
+    def submit(self, fname, write, obj):
+        '''
+        Write "obj" to "fname" with a given write function (e.g: @write_npy).
+        The object must not be modified by the caller afterwards. Blocks if
+        "max_pending" artifacts are already pending.
+        '''
+        self._slots.acquire()
+        if self._pool is None:
+            self._write(fname, write, obj)
+            return
+        self._futures.append(self._pool.submit(self._write, fname, write,
+                                               obj))
+
+    def save_npy(self, fname, array):
+        '''
+        Write an array as .npy (see @write_npy).
+        '''
+        self.submit(fname, write_npy, array)
+
+    def save_csv(self, fname, dataframe):
+        '''
+        Write a pandas dataframe as .csv (see @write_csv).
+        '''
+        self.submit(fname, write_csv, dataframe)
+
+    def flush(self):
+        '''
+        Wait until all pending artifacts are written. Raises the first error
+        of the background threads.
+        '''
+        futures, self._futures = self._futures, []
+        errors = [future.exception() for future in futures]
+        errors = [error for error in errors if error is not None]
+        if errors:
+            raise errors[0]
+
+    def close(self):
+        '''
+        Write the pending artifacts and stop the threads.
+        '''
+        try:
+            self.flush()
+        finally:
+            if self._pool is not None:
+                self._pool.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+            return
+        # do not hide the error of the worker behind the errors of the writes
+        try:
+            self.close()
+        except Exception:
+            pass
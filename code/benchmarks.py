@@ -0,0 +1,516 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of the hot paths of the pipeline.
+
+1. Kernels: each benchmark compares the current implementation against the
+   reference (previous) one on the PTB records found in the "raw" dir and
+   stores the results in the logs dir:
+       python benchmarks.py
+
+2. Pipeline: the hot paths of all stages (signal metadata, cohort dataframe,
+   EDA collection, preprocessing, data collection and one model) are timed
+   on synthetic PTB-like cohorts of increasing size (see @synthetic.py). The
+   throughput and the peak memory of each step are stored as a .json per run
+   in logs/benchmarks and compared with the previous run:
+       python benchmarks.py --patients 10 100 1000
+
+@author: Christos
+"""
+
+# =============================================================================
+# IMPORT MODULES
+# =============================================================================
+import os
+import sys
+import glob
+import json
+import time
+import socket
+import argparse
+import importlib
+import tempfile
+import shutil
+import tracemalloc
+import numpy as np
+import pandas as pd
+from scipy import signal
+from scipy.ndimage import gaussian_filter1d
+from sklearn.preprocessing import StandardScaler
+import wfdb
+import config as c
+from features import compute_signal_features
+from preprocessing import smooth_and_standardize
+from profiling import peak_rss_mb
+import feature_store
+import synthetic
+from ingest import build_index
+
+
+# =============================================================================
+# REFERENCE IMPLEMENTATIONS
+# =============================================================================
+def reference_signal_features(data):
+    '''
+    The signal metadata as computed by previous versions of
+    @00_get_patient_info.extract_signal_metadata (one lead at a time).
+    '''
+    channel_variance = np.var(data, axis=0)
+    mean_amplitude = np.mean(data, axis=0)
+    median_amplitude = np.median(data, axis=0)
+    mean_der_value = np.mean(np.gradient(data, 1, axis=0), axis=0)
+    median_der_value = np.median(np.gradient(data, 1, axis=0), axis=0)
+    peaks = [np.max(signal.welch(data[:, sig], 1000, 'flattop', 1024,
+                                 scaling='spectrum')[1] * 1e3)
+             for sig in range(0, data.shape[1])]
+
+    return np.column_stack((channel_variance, mean_amplitude,
+                            median_amplitude, mean_der_value,
+                            median_der_value, peaks))
+
+
+def reference_preprocessing(data, sigma):
+    '''
+    The preprocessing of previous versions of
+    @03_data_preprocessing.preprocess_signal (one lead at a time, then the
+    StandardScaler).
+    '''
+    for ch in range(data.shape[1]):
+        data[:, ch] = gaussian_filter1d(data[:, ch], sigma)
+
+    return StandardScaler().fit_transform(data)
+
+
+# =============================================================================
+# UTILITY FUNCTIONS
+# =============================================================================
+def best_of(func, *args, repeat=5):
+    '''
+    Return the output and the best wall time (in sec) of "repeat" calls.
+    '''
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        output = func(*args)
+        timings.append(time.perf_counter() - start)
+
+    return output, min(timings)
+
+
+def peak_allocation(func, *args):
+    '''
+    Return the output and the peak memory (in MB) allocated by a call
+    (numpy allocations are traced by tracemalloc).
+    '''
+    tracemalloc.start()
+    output = func(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return output, peak / 2**20
+
+
+def list_raw_records(path, n_records):
+    '''
+    Return the paths (without extension) of the first "n_records" records
+    found in the "raw" dir.
+    '''
+    collector = []
+    for patient in sorted(os.listdir(path.to_data_raw())):
+        curr_patient = c.join(path.to_data_raw(), patient)
+        if not os.path.isdir(curr_patient):
+            continue
+        for f in sorted(os.listdir(curr_patient)):
+            if f.endswith('.dat'):
+                collector.append(c.join(curr_patient, f.split('.dat')[0]))
+            if len(collector) == n_records:
+                return collector
+
+    return collector
+
+
+# =============================================================================
+# BENCHMARKS
+# =============================================================================
+def benchmark_signal_features(records, repeat=5):
+    '''
+    Compare @features.compute_signal_features against the reference
+    implementation.
+
+    Parameters
+    ----------
+    records : List
+        The paths of the records (see @list_raw_records).
+    repeat : Int
+        The best of "repeat" calls is reported.
+
+    Returns
+    -------
+    results : Pandas Dataframe
+        One row per record (timings in sec, speedup and the maximum
+        relative difference between the two implementations).
+
+    '''
+    collector = []
+    for record in records:
+        data = wfdb.rdrecord(record).p_signal
+        reference, t_reference = best_of(reference_signal_features, data,
+                                         repeat=repeat)
+        features, t_kernel = best_of(compute_signal_features, data,
+                                     repeat=repeat)
+        difference = np.max(np.abs(features - reference) /
+                            np.maximum(np.abs(reference), 1e-12))
+        collector.append([os.path.basename(record), data.shape[0],
+                          t_reference, t_kernel, t_reference / t_kernel,
+                          difference])
+
+    return pd.DataFrame(collector, columns=['record', 'n_samples',
+                                            'reference_sec', 'kernel_sec',
+                                            'speedup', 'max_rel_difference'])
+
+
+def benchmark_preprocessing(records, repeat=5):
+    '''
+    Compare @preprocessing.smooth_and_standardize (direct and FFT filtering,
+    float64 and float32 output) against the reference implementation. Each
+    call gets its own copy of the record (included in the time and the
+    allocation of all methods).
+
+    Parameters
+    ----------
+    records : List
+        The paths of the records (see @list_raw_records).
+    repeat : Int
+        The best of "repeat" calls is reported.
+
+    Returns
+    -------
+    results : Pandas Dataframe
+        One row per record and method (time in sec, peak allocation in MB
+        and the maximum absolute difference from the reference).
+
+    '''
+    sigma = c.kernel_width_sec * c.sampling_rate
+    methods = {'reference': lambda data: reference_preprocessing(data.copy(),
+                                                                 sigma)}
+    for method in ['direct', 'fft']:
+        for dtype in ['float64', 'float32']:
+            methods[f'{method}_{dtype}'] = (
+                lambda data, method=method, dtype=dtype:
+                smooth_and_standardize(data.astype(dtype), sigma, method,
+                                       dtype))
+    collector = []
+    for record in records:
+        data = wfdb.rdrecord(record).p_signal
+        reference = None
+        for name, func in methods.items():
+            output, t_method = best_of(func, data, repeat=repeat)
+            _, allocated = peak_allocation(func, data)
+            if reference is None:
+                reference = output
+            collector.append([os.path.basename(record), data.shape[0], name,
+                              t_method, allocated, data.nbytes / 2**20,
+                              np.max(np.abs(output - reference))])
+
+    return pd.DataFrame(collector, columns=['record', 'n_samples', 'method',
+                                            'sec', 'peak_alloc_mb',
+                                            'record_mb', 'max_abs_difference'])
+
+
+# =============================================================================
+# PIPELINE BENCHMARKS
+# =============================================================================
+def measure(step, func, n_patients, n_bytes):
+    '''
+    Run a step of the pipeline once and return its measurements: wall time,
+    throughput (patients and MB of raw data per sec), the peak memory
+    allocated during the step (tracemalloc) and the peak RSS of the process.
+    '''
+    tracemalloc.start()
+    start = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {'step': step, 'n_patients': n_patients, 'sec': elapsed,
+            'patients_per_sec': n_patients / elapsed,
+            'mb_per_sec': n_bytes / 2**20 / elapsed,
+            'peak_alloc_mb': peak / 2**20, 'peak_rss_mb': peak_rss_mb()}
+
+
+def raw_size(path, patients):
+    '''
+    Returns the size (in bytes) of the raw data of the given patients.
+    '''
+    return sum(os.path.getsize(fname) for patient in patients for fname in
+               glob.glob(c.join(path.to_data_raw(), patient, '*.dat')))
+
+
+def benchmark_pipeline(path, patients, electrode='ii', max_model_patients=20):
+    '''
+    Time the hot paths of the pipeline on the given patients of a (synthetic)
+    project. The steps run in the order of the pipeline, each one on the
+    artifacts of the previous ones:
+        1. extract_signal_metadata (@00_, including the reading of the records)
+        2. build_cohort_dataframe (@01_)
+        3. collect_signal_metadata (@02_)
+        4. preprocess_signal (@03_)
+        5. collect_data (@04_)
+        6. modeling (@04_, one model, at most "max_model_patients" per class)
+
+    Parameters
+    ----------
+    path : Class
+        The path constructor of the project.
+    patients : List
+        The patients to process.
+    electrode : String, optional
+        The lead of the EDA, the data collection and the model.
+    max_model_patients : Int, optional
+        The number of patients per class of the model (the cost of the model
+        grows with the size of the cohort). The default is 20.
+
+    Returns
+    -------
+    results : List
+        One dict per step (see @measure).
+
+    '''
+    get_patient_info = importlib.import_module('00_get_patient_info')
+    cohort_statistics = importlib.import_module('01_get_cohort_statistics')
+    eda = importlib.import_module('02_eda')
+    data_preprocessing = importlib.import_module('03_data_preprocessing')
+    modelling = importlib.import_module('04_modelling')
+
+    n_patients = len(patients)
+    n_bytes = raw_size(path, patients)
+    results = []
+
+    def extract():
+        rows = []
+        for patient in patients:
+            curr_patient = c.join(path.to_data_raw(), patient)
+            for fname in sorted(glob.glob(c.join(curr_patient, '*.dat'))):
+                record = os.path.basename(fname).split('.dat')[0]
+                info = wfdb.rdrecord(c.join(curr_patient, record))
+                get_patient_info.tranform_metadata_to_dataframe(
+                    info.comments, patient, record, path)
+                rows.append(get_patient_info.extract_signal_metadata(
+                    info.p_signal, patient, record, info))
+        feature_store.save_store(rows, path)
+        build_index(path, patients)
+    results.append(measure('extract_signal_metadata', extract, n_patients,
+                           n_bytes))
+
+    results.append(measure(
+        'build_cohort_dataframe',
+        lambda: cohort_statistics.build_cohort_dataframe(path, patients),
+        n_patients, n_bytes))
+    cohort_classes = modelling.load_the_cohort_class_info(path)
+
+    results.append(measure(
+        'collect_signal_metadata',
+        lambda: eda.collect_signal_metadata(patients, electrode, path),
+        n_patients, n_bytes))
+
+    def preprocess():
+        for patient in patients:
+            data_preprocessing.preprocess_signal(
+                patient, path,
+                data_preprocessing.collect_recordings(patient, path))
+    results.append(measure('preprocess_signal', preprocess, n_patients,
+                           n_bytes))
+
+    results.append(measure(
+        'collect_data',
+        lambda: [np.asarray(data) for records in
+                 modelling.collect_data(patients, path, electrode) for data
+                 in records],
+        n_patients, n_bytes))
+
+    # the modelled class with the most patients against the healthy controls
+    class_1 = 'Healthy control'
+    class_2 = max(c.classes, key=lambda class_: len(
+        cohort_classes.get(class_, [])))
+    model_classes = {class_: cohort_classes.get(class_, [])
+                     [:max_model_patients] for class_ in (class_1, class_2)}
+    if all(model_classes.values()):
+        incremental, c.incremental = c.incremental, False
+        try:
+            results.append(measure(
+                'modeling',
+                lambda: modelling.modeling(class_1, class_2, electrode, path,
+                                           model_classes, True, 1, 1),
+                sum(map(len, model_classes.values())),
+                raw_size(path, sum(model_classes.values(), []))))
+        finally:
+            c.incremental = incremental
+
+    return results
+
+
+def run_pipeline_benchmarks(sizes, root=None, duration_sec=30,
+                            electrode='ii'):
+    '''
+    Generate a synthetic cohort (@synthetic.generate_cohort) of the largest
+    size and benchmark the pipeline on its first "size" patients, for each
+    size.
+
+    Parameters
+    ----------
+    sizes : List
+        The numbers of patients, e.g: [10, 100, 1000].
+    root : String, optional
+        Where the synthetic project is created. If None, a temporary dir that
+        is removed at the end.
+    duration_sec : Float, optional
+        The mean duration of the records. The default is 30.
+    electrode : String, optional
+        See @benchmark_pipeline
+
+    Returns
+    -------
+    run : Dict
+        The settings of the run and the results (one dict per size and step).
+
+    '''
+    remove = root is None
+    if remove:
+        root = tempfile.mkdtemp(prefix='ptb_benchmark_')
+    path = c.FetchPaths(root, c.PROJECT_NAME)
+    for fetch in (path.to_data_raw, path.to_data_preprocessed, path.to_info,
+                  path.to_images, path.to_logs):
+        c.make(fetch(), exist_ok=True)
+    try:
+        cohort = synthetic.generate_cohort(path, max(sizes), duration_sec)
+        results = []
+        for size in sorted(sizes):
+            results.extend(benchmark_pipeline(path, cohort[:size], electrode))
+    finally:
+        if remove:
+            shutil.rmtree(root, ignore_errors=True)
+
+    settings = {name: getattr(c, name) for name in
+                ('raw_reader', 'raw_dtype', 'streaming', 'smoothing_method',
+                 'preprocessed_dtype', 'preprocessed_layout',
+                 'modelling_input')}
+
+    return {'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'host': socket.gethostname(),
+            'python': sys.version.split()[0], 'numpy': np.__version__,
+            'duration_sec': duration_sec, 'settings': settings,
+            'results': results}
+
+
+def save_run(run, path):
+    '''
+    Store a benchmark run (see @run_pipeline_benchmarks) in logs/benchmarks.
+    '''
+    path2benchmarks = c.join(path.to_logs(), 'benchmarks')
+    if not c.exists(path2benchmarks):
+        c.make(path2benchmarks)
+    fname = c.join(path2benchmarks,
+                   f"pipeline_{run['timestamp'].replace(':', '')}.json")
+    with open(fname, 'w') as f:
+        json.dump(run, f, indent=1)
+
+    return fname
+
+
+def load_runs(path):
+    '''
+    Load all the stored benchmark runs (oldest first).
+    '''
+    runs = []
+    for fname in sorted(glob.glob(c.join(path.to_logs(), 'benchmarks',
+                                         'pipeline_*.json'))):
+        with open(fname, 'r') as f:
+            runs.append(json.load(f))
+
+    return runs
+
+
+def compare_runs(current, previous, tolerance=1.2):
+    '''
+    Compare the time and the peak memory of each step and cohort size with
+    a previous run. A step is flagged as a regression if it got slower (or
+    allocated more) than "tolerance" X the previous run.
+
+    Returns
+    -------
+    comparison : Pandas Dataframe
+        One row per step and cohort size.
+
+    '''
+    keys = ['step', 'n_patients']
+    columns = keys + ['sec', 'peak_alloc_mb']
+    comparison = pd.merge(pd.DataFrame(current['results'])[columns],
+                          pd.DataFrame(previous['results'])[columns],
+                          on=keys, suffixes=('', '_previous'))
+    comparison['time_ratio'] = comparison.sec / comparison.sec_previous
+    comparison['memory_ratio'] = (comparison.peak_alloc_mb /
+                                  comparison.peak_alloc_mb_previous)
+    comparison['regression'] = ((comparison.time_ratio > tolerance) |
+                                (comparison.memory_ratio > tolerance))
+
+    return comparison
+
+
+# %%
+# =============================================================================
+
+def run_kernel_benchmarks(path):
+    '''
+    Run the benchmarks of the kernels on the records of the "raw" dir.
+    '''
+    records = list_raw_records(path, n_records=20)
+
+    results = benchmark_signal_features(records)
+    print(results.to_string())
+    fname = c.join(path.to_logs(), 'benchmark_signal_features.tsv')
+    results.to_csv(fname, sep='\t', index=False)
+    c.logging.info(f'Signal features: median speedup '
+                   f'{results.speedup.median():.2f}X over {len(results)} records')
+
+    results = benchmark_preprocessing(records)
+    print(results.to_string())
+    fname = c.join(path.to_logs(), 'benchmark_preprocessing.tsv')
+    results.to_csv(fname, sep='\t', index=False)
+    summary = results.groupby('method')[['sec', 'peak_alloc_mb']].median()
+    c.logging.info(f'Preprocessing (median per record):\n{summary}')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Benchmarks of the pipeline')
+    parser.add_argument('--patients', type=int, nargs='+', default=None,
+                        help='benchmark the pipeline on synthetic cohorts '
+                        'of these sizes (e.g: 10 100 1000)')
+    parser.add_argument('--duration', type=float, default=30,
+                        help='mean duration of the synthetic records [sec]')
+    parser.add_argument('--root', default=None,
+                        help='keep the synthetic project in this dir')
+    args = parser.parse_args()
+    # make the dirs of the project and set up the logging (see @config.init)
+    c.init()
+    # call the path constructor
+    path = c.FetchPaths(c.PROJECTS_PATH, c.PROJECT_NAME)
+
+    if args.patients is None:
+        run_kernel_benchmarks(path)
+        sys.exit()
+
+    previous = load_runs(path)
+    run = run_pipeline_benchmarks(args.patients, args.root, args.duration)
+    results = pd.DataFrame(run['results'])
+    print(results.to_string())
+    fname = save_run(run, path)
+    c.logging.info(f'Pipeline benchmark saved @{fname}')
+    if previous:
+        comparison = compare_runs(run, previous[-1])
+        print(comparison.to_string())
+        for _, row in comparison[comparison.regression].iterrows():
+            c.logging.info(f'{c.error} Regression of {row.step} '
+                           f'({row.n_patients} patients): '
+                           f'{row.time_ratio:.2f}X time, '
+                           f'{row.memory_ratio:.2f}X memory')
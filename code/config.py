@@ -5,15 +5,18 @@ Configuration module that includes:
     1. generic, re-usable functions/classes (i.e: class to create dirs)
     2. hyperparameters (i.e: the random seed)
     3. The logging configuration
+
+Importing this module has no side effects (it is imported by every worker):
+the dirs of the project are made and the logging is configured by an
+explicit call to @init, at the start of each stage and of each worker.
 @author: Christos
 """
 # =============================================================================
 # MODULES & ALLIASES
 # =============================================================================
 import os
+import json
 import logging
-from scipy.stats import randint as sp_randint
-from scipy.stats import uniform as sp_uniform
 
 # alliases
 join = os.path.join
@@ -81,32 +84,79 @@ class FetchPaths():
         '''
         return join(self.projects_path, self.project_name, 'info')
 
+    def to_index(self):
+        '''
+        Returns the filename of the index of the patients, their records and
+        their artifacts (built @00_get_patient_info).
+        '''
+        return join(self.to_info(), 'index.json')
+
+    def index(self):
+        '''
+        Returns the index (see @to_index). It is read once per process and
+        read again only if the file changed.
+        '''
+        fname = self.to_index()
+        try:
+            mtime = os.stat(fname).st_mtime_ns
+        except FileNotFoundError:
+            raise FileNotFoundError(f'No index @{fname}. Run '
+                                    f'00_get_patient_info.py first.')
+        cached = _index_cache.get(fname)
+        if cached is None or cached[0] != mtime:
+            with open(fname, 'r') as f:
+                cached = _index_cache[fname] = (mtime, json.load(f))
+
+        return cached[1]
+
+    def patients(self):
+        '''
+        Returns the sorted list of patients (e.g: patient001,...).
+        '''
+        return list(self.index()['patients'])
+
+    def records(self, patient):
+        '''
+        Returns the sorted list of records of a given patient.
+        '''
+        return self.index()['patients'][patient]['records']
+
+    def first_record(self, patient):
+        '''
+        Returns the first record of a given patient (the one used when a
+        single record per patient is analyzed).
+        '''
+        return self.records(patient)[0]
+
+    def to_artifact(self, patient, record, artifact):
+        '''
+        Returns the path of an artifact of a given patient and record:
+            1. 'raw' (the raw record, without extension)
+            2. 'header_metadata' (the .csv @00_get_patient_info)
+            3. 'preprocessed' (the .npy @03_data_preprocessing)
+        '''
+        relative = self.index()['patients'][patient]['artifacts'][record]
+
+        return join(self.to_project(), relative[artifact])
+
     def __str__(self):
         return f'Project: {self.project_name}'
 
 
+# the indices loaded by @FetchPaths.index (filename --> (mtime, index))
+_index_cache = {}
+
+
 # =============================================================================
 # PROJECT ATTRIBUTES
 # =============================================================================
-# The PROJECTS_PATH is where the code for all running projects are stored
-PROJECTS_PATH = '/Users/christoszacharopoulos/projects/'
+# The PROJECTS_PATH is where the code for all running projects are stored.
+# It can be overridden with the environment variable ECG_PROJECTS_PATH (e.g:
+# to run the pipeline or the benchmarks on another machine).
+PROJECTS_PATH = os.environ.get('ECG_PROJECTS_PATH',
+                               '/Users/christoszacharopoulos/projects/')
 PROJECT_NAME = 'idoven_assignment'
 
-# =============================================================================
-# MAKE DIRS
-# =============================================================================
-# Assuming that the original data are stored in the "raw" folder, make the 
-# following dirs.
-
-# logs 
-if not exists(join(FetchPaths(PROJECTS_PATH,PROJECT_NAME).to_logs())):
-      make(join(FetchPaths(PROJECTS_PATH,PROJECT_NAME).to_logs()))        
-# images
-if not exists(join(FetchPaths(PROJECTS_PATH,PROJECT_NAME).to_images())):
-      make(join(FetchPaths(PROJECTS_PATH,PROJECT_NAME).to_images()))  
-# preprocessed data
-if not exists(join(FetchPaths(PROJECTS_PATH,PROJECT_NAME).to_data_preprocessed())):
-      make(join(FetchPaths(PROJECTS_PATH,PROJECT_NAME).to_data_preprocessed()))  
 # =============================================================================
 # SET UP THE LOGGING CONFIGURATION
 # =============================================================================
@@ -114,13 +164,48 @@ if not exists(join(FetchPaths(PROJECTS_PATH,PROJECT_NAME).to_data_preprocessed()
 log_filename=join(FetchPaths(PROJECTS_PATH,PROJECT_NAME).to_logs(),
                   'results.log')
 
-# set up the logging file
-logging.basicConfig(
-    filename=log_filename,
-    level=logging.INFO,
-    filemode='w',
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    datefmt='%m-%d-%Y %H:%M:%S')
+# 'a' (append) or 'w' (the log is truncated at the start of each stage). The
+# workers always append, so that they never truncate the log of the stage.
+log_filemode = 'a'
+
+
+# =============================================================================
+# INITIALIZATION
+# =============================================================================
+# the processes that are already initialized (see @init)
+_initialized = set()
+
+
+def init(worker=False):
+    '''
+    Initialize the current process (once, the next calls do nothing):
+        1. make the dirs of the project (logs, images, preprocessed data),
+           assuming that the original data are stored in the "raw" folder
+        2. set up the logging file (see "log_filemode")
+    Call it at the start of each stage (@__main__) and of each worker.
+
+    Parameters
+    ----------
+    worker : Bool
+        True in the workers of the process pools, whose logs are always
+        appended to the log of the stage.
+
+    '''
+    if os.getpid() in _initialized:
+        return
+    path = FetchPaths(PROJECTS_PATH, PROJECT_NAME)
+    for dirname in (path.to_logs(), path.to_images(),
+                    path.to_data_preprocessed()):
+        make(dirname, exist_ok=True)
+    # set up the logging file
+    logging.basicConfig(
+        filename=log_filename,
+        level=logging.INFO,
+        filemode='a' if worker else log_filemode,
+        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+        datefmt='%m-%d-%Y %H:%M:%S')
+    _initialized.add(os.getpid())
+
 
 # unicode characters to log success and errors
 error = 4 * '\u274C'
@@ -131,6 +216,50 @@ success = 4 * '\u2705'
 # =============================================================================
 n_jobs = -1
 
+# execution of the per-patient jobs @00_get_patient_info and
+# @03_data_preprocessing (see @executors.py):
+#   'mne' (mne.parallel.parallel_func, as in previous versions)
+#   'process' (a process pool, each job is handed to the next free worker)
+#   'dask' (a dask.distributed cluster: a local one with "n_jobs" workers,
+#       or the one of the scheduler at "dask_scheduler", e.g:
+#       'tcp://10.0.0.1:8786')
+# The patients can also be split between machines with "--shard i/N".
+executor = 'mne'
+dask_scheduler = None
+# a failed job is run again up to "executor_retries" times
+executor_retries = 2
+
+# (class, electrode) models fitted in parallel @04_modelling (-1: as many as
+# possible). The "n_jobs" cores are split between these models, the CV folds
+# and the LightGBM threads of each fit.
+n_jobs_models = -1
+
+# skip the work (patients, models) whose inputs and settings did not change
+# since the previous run (see @incremental.py). Set to False to re-run all.
+incremental = True
+
+# record the wall time, CPU time, peak memory and I/O of each stage, patient
+# and model in logs/"run_report_fname" (one JSON line each, see @profiling.py)
+profiling = True
+run_report_fname = 'run_report.jsonl'
+
+# maximum number of patients whose signal metadata are kept in memory
+# @02_eda (least recently used are dropped first)
+eda_cache_size = 4096
+
+# correction of the Mann-Whitney U tests @02_eda for multiple comparisons,
+# across all class pairs, leads and features (see @eda_stats.py):
+# 'fdr_bh' (Benjamini-Hochberg), 'bonferroni' or None
+stats_correction = 'fdr_bh'
+
+# figures @02_eda, @05_plot_model_results (see @rendering.py): drawn headless
+# (Agg backend) by "render_n_jobs" workers (-1: as many as possible) and saved
+# in each of "figure_formats" (e.g: ['png', 'pdf', 'svg']) at "figure_dpi".
+# A figure whose data did not change since the previous run is skipped.
+figure_formats = ['png']
+figure_dpi = 100
+render_n_jobs = -1
+
 electrodes=[
      'i',
      'ii',
@@ -169,13 +298,125 @@ classes =[
 
 random_state = 42
 
-# LightGBM hyperparameters
-param_test = {
-    "num_leaves": sp_randint(6, 50),
-    "min_child_samples": sp_randint(100, 500),
+# stream the raw records @00_get_patient_info and @03_data_preprocessing in
+# blocks of "chunk_size" samples: the memory of each worker then depends on
+# the block size and not on the length of the records
+streaming = False
+chunk_size = 2**16 # [samples]
+
+# write the per-record artifacts (header metadata, preprocessed data) in
+# background threads @00_get_patient_info and @03_data_preprocessing, while
+# the next record is processed (see @artifact_writer.py). At most
+# "writer_queue_size" artifacts are pending per worker.
+async_writer = True
+writer_threads = 2
+writer_queue_size = 4
+
+# fused ingest: read each raw record once @00_get_patient_info to extract the
+# metadata AND write the preprocessed data (see @ingest.py). The stage
+# @03_data_preprocessing then has nothing left to do.
+fused_ingest = False
+
+# reader of the raw records @00_get_patient_info and @03_data_preprocessing:
+# 'wfdb' (wfdb.rdrecord, float64 physical units) or 'memmap' (the .dat file
+# is memory-mapped as 16-bit digital samples, see @signal_io.RawRecord).
+# With 'memmap' the physical units are computed in "raw_dtype" ('float64' or
+# 'float32') and only for the samples that are needed.
+raw_reader = 'wfdb'
+raw_dtype = 'float64'
+
+# preprocessing @03_data_preprocessing
+sampling_rate = 1000 # [Hz]
+kernel_width_sec = 0.01 # Gaussian-kernel width in [sec]
+# 'direct' (gaussian_filter1d) or 'fft' (FFT convolution, faster for wide
+# kernels), see @preprocessing.smooth_and_standardize
+smoothing_method = 'direct'
+# dtype of the preprocessed data ('float64' or 'float32', half the size)
+preprocessed_dtype = 'float64'
+
+# storage of the preprocessed data @03_data_preprocessing:
+# 'lead_major' (#leads X #samples, each lead is contiguous on disk) or
+# 'sample_major' (#samples X #leads, the format of previous versions)
+preprocessed_layout = 'lead_major'
+
+# input of the models @04_modelling:
+# 'raw' (one row per sample of each record) or 'windowed' (one row per window
+# of each record, described by the WINDOW_FEATURES @features.py). In the
+# 'windowed' mode the CV folds are grouped by patient.
+modelling_input = 'raw'
+window_length_sec = 2 # [sec]
+window_step_sec = 1 # [sec]
+
+# records used per patient @01_get_cohort_statistics, @02_eda and
+# @04_modelling:
+#   'first' (only the first record, as in previous versions)
+#   'concatenate' (all records, joined into one recording per patient)
+#   'mean' / 'median' (the features of all records are reduced per patient:
+#       the signal metadata @02_eda and the window features @04_modelling,
+#       requires modelling_input='windowed')
+#   'separate' (all records, as separate recordings; the CV folds are
+#       grouped by patient)
+# @02_eda always tests one sample per patient: with 'separate' and
+# 'concatenate' the signal metadata of the records are averaged.
+record_aggregation = 'first'
+
+# LightGBM hyperparameters: (scipy.stats distribution, args, kwds) or a list
+# of values. The distributions are frozen at the first use of "param_test"
+# (see @__getattr__), so that importing config does not import scipy.
+param_space = {
+    "num_leaves": ('randint', (6, 50), {}),
+    "min_child_samples": ('randint', (100, 500), {}),
     "min_child_weight": [1e-5, 1e-3, 1e-2, 1e-1, 1, 1e1, 1e2, 1e3, 1e4],
-    "subsample": sp_uniform(loc=0.2, scale=0.8),
-    "colsample_bytree": sp_uniform(loc=0.4, scale=0.6),
+    "subsample": ('uniform', (), {'loc': 0.2, 'scale': 0.8}),
+    "colsample_bytree": ('uniform', (), {'loc': 0.4, 'scale': 0.6}),
     "reg_alpha": [0, 1e-1, 1, 2, 5, 7, 10, 50, 100],
     "reg_lambda": [0, 1e-1, 1, 5, 10, 20, 50, 100],
-}
\ No newline at end of file
+}
+
+
+def __getattr__(name):
+    '''
+    Returns the attributes of the module that are built at their first use:
+        1. param_test (the distributions of "param_space", e.g:
+           {"num_leaves": sp_randint(6, 50), ...})
+    '''
+    if name == 'param_test':
+        from scipy import stats
+        param_test = {}
+        for key, value in param_space.items():
+            if isinstance(value, tuple):
+                distribution, args, kwds = value
+                value = getattr(stats, distribution)(*args, **kwds)
+            param_test[key] = value
+        globals()['param_test'] = param_test
+        return param_test
+    raise AttributeError(f"module '{__name__}' has no attribute '{name}'")
+
+# search of the hyperparameters @04_modelling:
+#   'halving' (successive halving: many candidates are fitted on a random
+#       subset of the rows and only the best 1/search_factor of them move on
+#       to a "search_factor" times larger subset, until all rows are used)
+#   'random' (all candidates are fitted on all rows, as in previous versions)
+search_method = 'halving'
+search_n_candidates = 27 # 'halving': #candidates of the first iteration
+search_factor = 3 # 'halving'
+search_n_iter = 10 # 'random': #candidates
+
+# LightGBM backend @04_modelling:
+#   'native' (the binned dataset of each model is built once, shared by all
+#       the fits of the search and of the CV, and stored in the results dir
+#       in the LightGBM binary format, see @lgbm_native.py)
+#   'sklearn' (LGBMClassifier: the data are binned again at each fit)
+lgbm_backend = 'native'
+
+# out-of-core modelling (modelling_input='raw'): the feature matrix of each
+# model is a memory-mapped .npy file in the results dir (removed once the
+# model is evaluated), filled from the preprocessed data without copies. With
+# the native LightGBM backend the fits train on the binned dataset and only
+# blocks of the test rows are read back (see @lgbm_native.py). The targets
+# (int8) and the CV folds (the fold of each sample, int8) stay in memory and
+# the train/test indices are generated one fold at a time. Requires
+# lgbm_backend='native': the sklearn API copies the training rows of each
+# fold into memory.
+out_of_core = False
+out_of_core_dtype = 'float32'
@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Statistics of the signal metadata @02_eda.py: two-sided Mann-Whitney U tests
+of every pair of classes, lead and feature, corrected for multiple
+comparisons (see the variable "stats_correction" @config.py).
+
+The tests of a pair of classes are computed at once, on the arrays
+(#patients X #leads X #features) of the two classes, instead of one test per
+subplot. The results are stored as a table (one row per class pair, lead and
+feature) in the info directory, and the figures @02_eda.py only annotate the
+precomputed p-values.
+
+The p-values are the ones of scipy.stats.mannwhitneyu on each (lead, feature)
+alone (as computed by statannot): the exact test for small samples without
+ties, otherwise the normal approximation with continuity correction.
+
+@author: Christos
+"""
+
+# =============================================================================
+# IMPORT MODULES
+# =============================================================================
+import itertools
+import numpy as np
+import pandas as pd
+from scipy import stats
+import config as c
+
+
+# =============================================================================
+# GLOBALS
+# =============================================================================
+STATS_FNAME = 'eda_statistics.tsv'
+
+
+# =============================================================================
+# FUNCTIONS
+# =============================================================================
+def mannwhitney(x, y):
+    '''
+    Two-sided Mann-Whitney U tests of all columns at once.
+
+    Parameters
+    ----------
+    x : Array (#samples_1 X ...)
+        The samples of the first class (e.g: #patients X #leads X #features).
+    y : Array (#samples_2 X ...)
+        The samples of the second class, same trailing shape.
+
+    Returns
+    -------
+    u_stat, pvalue : Arrays (same shape as the trailing dims)
+        The U statistic (of x) and the p-value of each column (NaN values
+        are omitted).
+
+    '''
+    x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+    shape = x.shape[1:]
+    x, y = x.reshape(len(x), -1), y.reshape(len(y), -1)
+    u_stat = np.full(x.shape[1], np.nan)
+    pvalue = np.full(x.shape[1], np.nan)
+    if len(x) == 0 or len(y) == 0:
+        return u_stat.reshape(shape), pvalue.reshape(shape)
+    # scipy picks the exact test or the normal approximation once for all
+    # columns, depending on ties: the columns with and without ties are
+    # tested apart, so that each p-value is the one of its column alone
+    ordered = np.sort(np.concatenate([x, y]), axis=0)
+    ties = (np.diff(ordered, axis=0) == 0).any(axis=0)
+    for columns in (~ties, ties):
+        if columns.any():
+            result = stats.mannwhitneyu(x[:, columns], y[:, columns], axis=0,
+                                        alternative='two-sided',
+                                        nan_policy='omit')
+            u_stat[columns] = result.statistic
+            pvalue[columns] = result.pvalue
+
+    return u_stat.reshape(shape), pvalue.reshape(shape)
+
+
+def correct_pvalues(pvalues, method=None):
+    '''
+    Correct the p-values for multiple comparisons (NaN p-values are not
+    counted as tests).
+
+    Parameters
+    ----------
+    pvalues : Array
+    method : String or None, optional
+        'fdr_bh' (Benjamini-Hochberg), 'bonferroni' or None (no correction).
+        The default is "stats_correction" @config.py.
+
+    Returns
+    -------
+    Array
+        The corrected p-values (same shape).
+
+    '''
+    method = c.stats_correction if method is None else method
+    pvalues = np.asarray(pvalues, dtype=float)
+    corrected = pvalues.copy()
+    if method in (None, 'none'):
+        return corrected
+    valid = ~np.isnan(pvalues)
+    n_tests = valid.sum()
+    if method == 'bonferroni':
+        corrected[valid] = np.minimum(pvalues[valid] * n_tests, 1)
+    elif method == 'fdr_bh':
+        order = np.argsort(pvalues[valid])
+        ranked = pvalues[valid][order] * n_tests / np.arange(1, n_tests + 1)
+        # the step-up: each p-value is at most the ones of the larger ranks
+        ranked = np.minimum.accumulate(ranked[::-1])[::-1]
+        adjusted = np.empty(n_tests)
+        adjusted[order] = np.minimum(ranked, 1)
+        corrected[valid] = adjusted
+    else:
+        raise ValueError(f'Unknown correction "{method}" (fdr_bh, '
+                         f'bonferroni or None)')
+
+    return corrected
+
+
+def test_class_pairs(data, leads, features, pairs=None):
+    '''
+    Mann-Whitney U tests of all pairs of classes, leads and features.
+
+    Parameters
+    ----------
+    data : Dict
+        class --> Array (#patients X #leads X #features), e.g: built with
+        @02_eda.CohortSignalMetadata.class_array.
+    leads : List
+        The leads (2nd axis of the arrays), e.g: "electrodes" @config.py.
+    features : List
+        The features (3rd axis of the arrays).
+    pairs : List, optional
+        The (class_1, class_2) to test. The default is all pairs of classes
+        of "data".
+
+    Returns
+    -------
+    statistics : Pandas Dataframe
+        One row per class pair, lead and feature: the number of samples of
+        each class, the U statistic, the p-value and the corrected p-value
+        (across all rows, see @correct_pvalues).
+
+    '''
+    if pairs is None:
+        pairs = list(itertools.combinations(data, 2))
+    tables = []
+    for class_1, class_2 in pairs:
+        u_stat, pvalue = mannwhitney(data[class_1], data[class_2])
+        lead, feature = np.meshgrid(leads, features, indexing='ij')
+        tables.append(pd.DataFrame({
+            'class_1': class_1, 'class_2': class_2,
+            'lead': lead.ravel(), 'feature': feature.ravel(),
+            'n_1': len(data[class_1]), 'n_2': len(data[class_2]),
+            'u_stat': u_stat.ravel(), 'pvalue': pvalue.ravel()}))
+    statistics = pd.concat(tables, ignore_index=True)
+    statistics['pvalue_corrected'] = correct_pvalues(statistics['pvalue'])
+
+    return statistics
+
+
+def stats_fname(path):
+    '''
+    Returns the filename of the table of the statistics.
+    '''
+    return c.join(path.to_info(), STATS_FNAME)
+
+
+def save_statistics(statistics, path):
+    '''
+    Store the table of the statistics in the info directory.
+    '''
+    fname = stats_fname(path)
+    statistics.to_csv(fname, sep='\t', index=False)
+
+    return fname
+
+
+def load_statistics(path):
+    '''
+    Returns the table of the statistics stored @save_statistics.
+    '''
+    return pd.read_csv(stats_fname(path), sep='\t')
+
+
+def pair_pvalues(statistics, class_1, class_2, column='pvalue_corrected'):
+    '''
+    Returns the p-values of a given class pair (in either order of the
+    classes), as a dict (lead, feature) --> p-value.
+    '''
+    rows = statistics[((statistics['class_1'] == class_1) &
+                       (statistics['class_2'] == class_2)) |
+                      ((statistics['class_1'] == class_2) &
+                       (statistics['class_2'] == class_1))]
+    if rows.empty:
+        raise KeyError(f'No tests of {class_1} VS {class_2}')
+
+    return dict(zip(zip(rows['lead'], rows['feature']), rows[column]))
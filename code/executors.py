@@ -0,0 +1,291 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Execution of the per-patient jobs of @00_get_patient_info.py and
+@03_data_preprocessing.py (see the variable "executor" @config.py):
+    1. 'mne': mne.parallel.parallel_func on this machine (as in previous
+       versions)
+    2. 'process': a process pool on this machine, each job is handed to the
+       next free worker
+    3. 'dask': a dask.distributed cluster, either a local one (several
+       processes on this machine) or the scheduler at "dask_scheduler"
+       @config.py (the workers then need the code and the project on a
+       shared file system). Requires dask.distributed.
+
+The jobs are handed out one at a time: a worker takes the next job as soon
+as it is free (no static batches). If the costs of the jobs are known (e.g:
+the length of each record, see @signal_io.record_cost), the most expensive
+jobs are handed out first, so that the last jobs of the run are short ones
+and all workers finish at about the same time.
+
+A job that fails (an error, or a worker that died) is run again, up to
+"executor_retries" times @config.py, and the stage fails if it still fails.
+Since the stages are incremental (see @incremental.py), the jobs that
+succeeded are not run again by the next run.
+
+The patients can also be split between several machines (static shards):
+each machine runs the stage with "--shard i/N" on the i-th of N shards of the
+patient list (every N-th patient, starting from the i-th) and stores its
+outputs next to the ones of the full cohort (see @shard_fname). The outputs
+are then merged by a last run with "--merge" (see @find_shards), e.g:
+    python 00_get_patient_info.py --shard 0/2   # machine 1
+    python 00_get_patient_info.py --shard 1/2   # machine 2
+    python 00_get_patient_info.py --merge
+    python 03_data_preprocessing.py --shard 0/2 # (nothing to merge)
+
+@author: Christos
+"""
+
+# =============================================================================
+# IMPORT MODULES
+# =============================================================================
+import os
+import re
+import glob
+import argparse
+import traceback
+import config as c
+from profiling import RUN_ID_ENV, current_run_id
+
+
+# =============================================================================
+# SHARDS
+# =============================================================================
+def parse_shard(text):
+    '''
+    Parse a shard given as "i/N" (the i-th of N shards, i = 0,...,N-1).
+    Used as the type of the "--shard" argument of the stages.
+    '''
+    match = re.fullmatch(r'(\d+)/(\d+)', text.strip())
+    if match is None:
+        raise argparse.ArgumentTypeError(f'Shard "{text}" is not i/N')
+    index, n_shards = int(match.group(1)), int(match.group(2))
+    if not 0 <= index < n_shards:
+        raise argparse.ArgumentTypeError(f'Shard "{text}": i must be in '
+                                         f'[0, {n_shards - 1}]')
+
+    return index, n_shards
+
+
+def add_arguments(parser, merge=False):
+    '''
+    Add the arguments of the execution to the parser of a stage:
+        1. --shard i/N
+        2. --merge (only if the stage has outputs to merge)
+    '''
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('--shard', type=parse_shard, default=None,
+                       help='run the i-th of N shards of the patients '
+                       '(e.g: 0/4)')
+    if merge:
+        group.add_argument('--merge', action='store_true',
+                           help='merge the outputs of the shards')
+
+
+def select_shard(items, shard=None):
+    '''
+    Returns the items (e.g: the sorted patients) of a shard (index, n_shards):
+    every n_shards-th item, starting from the index-th. All items if None.
+    '''
+    if shard is None:
+        return list(items)
+    index, n_shards = shard
+
+    return list(items)[index::n_shards]
+
+
+def shard_fname(fname, shard):
+    '''
+    Returns the filename of the output of a shard (e.g:
+    signal_metadata.npy --> signal_metadata.shard_0_of_4.npy).
+    '''
+    root, ext = os.path.splitext(fname)
+
+    return f'{root}.shard_{shard[0]}_of_{shard[1]}{ext}'
+
+
+def find_shards(fname):
+    '''
+    Returns the sorted filenames of the outputs of all shards of a given
+    output (see @shard_fname). Raises an error if a shard is missing or if
+    the outputs of runs with different numbers of shards are mixed.
+    '''
+    root, ext = os.path.splitext(fname)
+    shards = {}
+    for shard in glob.glob(f'{glob.escape(root)}.shard_*_of_*{ext}'):
+        match = re.search(r'\.shard_(\d+)_of_(\d+)' + re.escape(ext) + '$',
+                          shard)
+        if match is not None:
+            shards[int(match.group(1)), int(match.group(2))] = shard
+    if not shards:
+        raise FileNotFoundError(f'No shards of {fname} to merge')
+    n_shards = {n for _, n in shards}
+    if len(n_shards) > 1:
+        raise ValueError(f'Shards of different runs ({sorted(n_shards)} '
+                         f'shards) @{os.path.dirname(fname)}')
+    n_shards = n_shards.pop()
+    missing = [index for index in range(n_shards) if
+               (index, n_shards) not in shards]
+    if missing:
+        raise FileNotFoundError(f'Missing shards {missing} of {n_shards} '
+                                f'of {fname}')
+
+    return [shards[index, n_shards] for index in range(n_shards)]
+
+
+# =============================================================================
+# BACKENDS
+# =============================================================================
+def call(func, args, run_id=None):
+    '''
+    Run a job in a worker and return (True, result), or (False, the
+    traceback) if it failed, so that one failed job does not stop the others.
+    The job reports to the run of the stage (see @profiling.py), also in the
+    workers that were not started by the stage (e.g: a dask scheduler).
+    '''
+    if run_id is not None:
+        os.environ[RUN_ID_ENV] = run_id
+    try:
+        return True, func(*args)
+    except Exception:
+        return False, traceback.format_exc()
+
+
+def result(future):
+    '''
+    Returns the result of a future of @call, or (False, the error) if its
+    worker died.
+    '''
+    try:
+        return future.result()
+    except Exception:
+        return False, traceback.format_exc()
+
+
+def run_mne(func, jobs, n_jobs, run_id=None):
+    '''
+    Run the jobs with mne.parallel.parallel_func.
+    '''
+    from mne.parallel import parallel_func
+    parallel, run_func, _ = parallel_func(call, n_jobs=n_jobs)
+    if hasattr(parallel, 'batch_size'):
+        # one job per dispatch (joblib batches fast jobs by default)
+        parallel.batch_size = 1
+    try:
+        return parallel(run_func(func, args, run_id) for args in jobs)
+    except Exception:
+        # the pool broke (e.g: a worker died): all jobs are run again
+        return [(False, traceback.format_exc())] * len(jobs)
+
+
+def run_process(func, jobs, n_jobs, run_id=None):
+    '''
+    Run the jobs on a process pool (one task per job).
+    '''
+    from joblib import effective_n_jobs
+    from joblib.externals.loky import get_reusable_executor
+    executor = get_reusable_executor(max_workers=effective_n_jobs(n_jobs))
+    futures = [executor.submit(call, func, args, run_id) for args in jobs]
+
+    return [result(future) for future in futures]
+
+
+def run_dask(func, jobs, n_jobs, run_id=None):
+    '''
+    Run the jobs on a dask.distributed cluster (see "dask_scheduler"
+    @config.py).
+    '''
+    try:
+        from dask.distributed import Client, LocalCluster
+    except ImportError:
+        raise ImportError("The executor 'dask' requires dask.distributed "
+                          "(pip install 'dask[distributed]')")
+    cluster = None
+    if c.dask_scheduler is None:
+        from joblib import effective_n_jobs
+        cluster = LocalCluster(n_workers=effective_n_jobs(n_jobs),
+                               threads_per_worker=1, processes=True)
+    try:
+        with Client(c.dask_scheduler if cluster is None else
+                    cluster) as client:
+            # the scheduler runs the jobs with the highest priority first
+            futures = [client.submit(call, func, args, run_id, pure=False,
+                                     priority=len(jobs) - idx)
+                       for idx, args in enumerate(jobs)]
+            return [result(future) for future in futures]
+    finally:
+        if cluster is not None:
+            cluster.close()
+
+
+BACKENDS = {'mne': run_mne, 'process': run_process, 'dask': run_dask}
+
+
+# =============================================================================
+# RUN
+# =============================================================================
+def run(func, jobs, costs=None, n_jobs=None, backend=None, retries=None):
+    '''
+    Run func(*args) for the arguments of each job, in parallel.
+
+    Parameters
+    ----------
+    func : Function
+        The worker, e.g: @ingest.plan_patient.
+    jobs : List
+        The arguments of each job, e.g: [('patient001',), ...].
+    costs : List, optional
+        The estimated cost of each job. The jobs are handed out the most
+        expensive first (in the given order if None).
+    n_jobs : Int, optional
+        The number of workers. The default is "n_jobs" @config.py.
+    backend : String, optional
+        'mne', 'process' or 'dask'. The default is "executor" @config.py.
+    retries : Int, optional
+        The number of times a failed job is run again. The default is
+        "executor_retries" @config.py.
+
+    Returns
+    -------
+    results : List
+        The result of each job (in the order of the jobs).
+
+    '''
+    n_jobs = c.n_jobs if n_jobs is None else n_jobs
+    backend = c.executor if backend is None else backend
+    retries = c.executor_retries if retries is None else retries
+    if backend not in BACKENDS:
+        raise ValueError(f'Unknown executor "{backend}" (one of '
+                         f'{list(BACKENDS)})')
+
+    results = [None] * len(jobs)
+    errors = {}
+    pending = list(range(len(jobs)))
+    if costs is not None:
+        # longest first (stable for equal costs)
+        pending.sort(key=lambda idx: -costs[idx])
+    for attempt in range(retries + 1):
+        outputs = BACKENDS[backend](func, [jobs[idx] for idx in pending],
+                                    n_jobs, current_run_id())
+        errors = {}
+        for idx, (success, output) in zip(pending, outputs):
+            if success:
+                results[idx] = output
+            else:
+                errors[idx] = output
+        if not errors:
+            break
+        c.logging.warning(f'{c.error} {len(errors)} of {len(jobs)} jobs of '
+                          f'{func.__name__} failed (attempt {attempt + 1} of '
+                          f'{retries + 1})')
+        pending = [idx for idx in pending if idx in errors]
+
+    if errors:
+        for idx, error in errors.items():
+            c.logging.error(f'{func.__name__}{tuple(jobs[idx])}:\n{error}')
+        failed = [jobs[idx] for idx in sorted(errors)]
+        raise RuntimeError(f'{len(failed)} jobs of {func.__name__} failed '
+                           f'after {retries + 1} attempts: {failed} (see '
+                           f'{c.log_filename})')
+
+    return results
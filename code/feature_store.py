@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Consolidated store of the signal metadata extracted @00_get_patient_info.py
+
+Instead of one small .csv per patient and record, the metadata of ALL
+patients, records and leads are kept in a single NumPy structured array
+(one row per patient X record X lead, one column per feature). The array
+is saved as a single .npy file in the info directory and is memory-mapped
+when loaded, so reading the metadata of the full cohort is one read.
+
+To convert the per-record .csv files of a previous run into the store,
+simply run this module:
+    python feature_store.py
+
+@author: Christos
+"""
+
+# =============================================================================
+# IMPORT MODULES
+# =============================================================================
+import os
+import itertools
+import numpy as np
+import pandas as pd
+import config as c
+from features import SIGNAL_FEATURES
+
+
+# =============================================================================
+# GLOBALS
+# =============================================================================
+# one row per patient X record X lead
+STORE_DTYPE = np.dtype([('patient', 'U16'), ('record', 'U16'),
+                        ('lead', 'U8')] +
+                       [(feature, 'f8') for feature in SIGNAL_FEATURES])
+
+STORE_FNAME = 'signal_metadata.npy'
+
+
+# =============================================================================
+# FUNCTIONS
+# =============================================================================
+def to_store_rows(signal_metadata, patient, record):
+    '''
+    Convert the signal metadata of a given patient and record into rows
+    of the store.
+
+    Parameters
+    ----------
+    signal_metadata : Pandas Dataframe (#leads X #features)
+        Indexed by the lead names, the columns are the SIGNAL_FEATURES.
+    patient : String
+        The current patient.
+    record : String
+        The corresponfing record of the current patient.
+
+    Returns
+    -------
+    rows : Numpy structured array (len = #leads)
+        The rows of the store (dtype = STORE_DTYPE).
+
+    '''
+    rows = np.zeros(len(signal_metadata), dtype=STORE_DTYPE)
+    rows['patient'] = patient
+    rows['record'] = record
+    rows['lead'] = signal_metadata.index.values
+    for feature in SIGNAL_FEATURES:
+        rows[feature] = signal_metadata[feature].values
+
+    return rows
+
+
+def save_store(rows, path, fname=None):
+    '''
+    Concatenate the rows of all patients and save them as a single .npy
+    file in the info directory. The rows are grouped by patient, while the
+    order of the records within each patient is preserved (the first record
+    remains the first).
+
+    Parameters
+    ----------
+    rows : List
+        Structured arrays created @to_store_rows.
+    path : Class
+        The path constructor.
+    fname : String, optional
+        The filename of the store. The default is STORE_FNAME in the info
+        directory (e.g: the store of a shard is saved elsewhere, see
+        @executors.shard_fname).
+
+    Returns
+    -------
+    fname : String
+        The filename of the store.
+
+    '''
+    table = np.concatenate(rows) if rows else np.zeros(0, dtype=STORE_DTYPE)
+    table = table[np.argsort(table['patient'], kind='stable')]
+
+    if fname is None:
+        fname = c.join(path.to_info(), STORE_FNAME)
+    np.save(fname, table)
+
+    return fname
+
+
+def merge_stores(fnames, path):
+    '''
+    Merge the stores of the shards of @00_get_patient_info.py (see
+    @executors.py) into the store of the full cohort.
+
+    Parameters
+    ----------
+    fnames : List
+        The filenames of the stores of the shards.
+    path : Class
+        The path constructor.
+
+    Returns
+    -------
+    fname : String
+        The filename of the store.
+
+    '''
+    return save_store([np.load(fname) for fname in fnames], path)
+
+
+def build_store_from_csvs(path, patients):
+    '''
+    Build the store from the per-record signal metadata .csv files that
+    were written by previous versions of @00_get_patient_info.py
+
+    Parameters
+    ----------
+    path : Class
+        The path constructor.
+    patients : List
+        The sorted list of patients (e.g: patient001,...).
+
+    Returns
+    -------
+    fname : String
+        The filename of the store.
+
+    '''
+    rows = []
+    for patient in patients:
+        # get the available records per patient
+        records = sorted(f for f in os.listdir(c.join(path.to_info(), patient))
+                         if not f.startswith('.'))
+        for record in records:
+            fname = c.join(path.to_info(), patient, record, 'signal_metadata',
+                           f'{patient}_{record}_signal_metadata.csv')
+            if not os.path.isfile(fname):
+                continue
+            signal_metadata = pd.read_csv(fname, index_col=0)
+            rows.append(to_store_rows(signal_metadata, patient, record))
+
+    return save_store(rows, path)
+
+
+# =============================================================================
+# LOADER
+# =============================================================================
+class SignalMetadataStore():
+    '''
+    Memory-mapped access to the signal metadata of the full cohort.
+    Rows can be selected by patient, record and lead.
+    Attributes:
+        1. table (the structured array, see STORE_DTYPE)
+    '''
+
+    def __init__(self, path, mmap_mode='r'):
+        fname = c.join(path.to_info(), STORE_FNAME)
+        self.table = np.load(fname, mmap_mode=mmap_mode)
+        # the rows are grouped by patient: keep the offset of each patient
+        patients, start, counts = np.unique(self.table['patient'],
+                                            return_index=True,
+                                            return_counts=True)
+        self._offsets = {patient: (first, first + count) for
+                         patient, first, count in zip(patients, start, counts)}
+
+    def patients(self):
+        '''
+        Returns the sorted list of patients in the store.
+        '''
+        return list(self._offsets.keys())
+
+    def records(self, patient):
+        '''
+        Returns the records of a given patient in the order they were stored.
+        '''
+        rows = self.select(patient=patient)
+        records, first = np.unique(rows['record'], return_index=True)
+        return records[np.argsort(first)].tolist()
+
+    def select(self, patient=None, record=None, lead=None):
+        '''
+        Returns the rows that correspond to the selected patient, record and
+        lead. Any of the three can be omitted (None) to select all.
+        '''
+        if patient is None:
+            rows = self.table
+        else:
+            start, stop = self._offsets[patient]
+            rows = self.table[start:stop]
+        if record is not None:
+            rows = rows[rows['record'] == record]
+        if lead is not None:
+            rows = rows[rows['lead'] == lead]
+
+        return rows
+
+    def to_dataframe(self, patient=None, record=None, lead=None):
+        '''
+        Returns the selected rows as a pandas dataframe.
+        '''
+        return pd.DataFrame(np.asarray(self.select(patient, record, lead)))
+
+    def __len__(self):
+        return len(self.table)
+
+    def __str__(self):
+        return f'Signal metadata store: {len(self._offsets)} patients'
+
+
+# %%
+# =============================================================================
+# EXECUTE (convert the .csv files of a previous run into the store)
+# =============================================================================
+
+if __name__ == "__main__":
+    # make the dirs of the project and set up the logging (see @config.init)
+    c.init()
+    # call the path constructor
+    path = c.FetchPaths(c.PROJECTS_PATH, c.PROJECT_NAME)
+    # available patients
+    patient_list = pd.read_csv(
+        c.join(
+            path.to_info(),
+            'patients.tsv'),
+        header=None).values.tolist()
+    # unpack the list of lists
+    patients = list(itertools.chain(*patient_list))
+
+    fname = build_store_from_csvs(path, patients)
+    c.logging.info(f'Signal metadata store saved @{fname}')
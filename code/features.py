@@ -0,0 +1,300 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Feature kernels applied to the recorded signals.
+
+The kernel @compute_signal_features derives the signal metadata of
+@00_get_patient_info.py for all leads of a recording in one pass. It can be
+applied to the raw (physical units) or to the preprocessed data.
+
+The class @StreamingSignalFeatures computes the same features block by block
+(e.g: while streaming a raw record), with a memory footprint that does not
+depend on the length of the record.
+
+The kernel @compute_window_features segments a (preprocessed) time series
+into fixed-length windows and describes each window with a compact feature
+vector. It is used by the 'windowed' modelling input @04_modelling.py
+
+@author: Christos
+"""
+
+# =============================================================================
+# IMPORT MODULES
+# =============================================================================
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+from scipy import signal
+
+
+# =============================================================================
+# GLOBALS
+# =============================================================================
+# The output schema of @compute_signal_features (one column per feature)
+SIGNAL_FEATURES = ['channel_variance', 'mean_amplitude', 'median_amplitude',
+                   'mean_derivative_value', 'median_derivative_value',
+                   'power_spectral_density_max']
+
+# The output schema of @compute_window_features
+WINDOW_FEATURES = ['mean', 'std', 'min', 'max', 'median',
+                   'mean_abs_derivative', 'dominant_frequency']
+
+
+# =============================================================================
+# FUNCTIONS
+# =============================================================================
+def compute_signal_features(data, sfreq=1000):
+    '''
+    Extract the signal metadata of all leads in a single pass over the
+    data. The 1st derivative is computed once, the medians of the amplitude
+    and of the derivative share one partition and the power spectrum of all
+    leads is estimated with a single (multi-channel) Welch call.
+
+    Parameters
+    ----------
+    data : Numpy Array (#samples X #leads)
+        The recorded data for all leads.
+    sfreq : Int, optional
+        The sampling frequency in Hz. The default is 1000.
+
+    Returns
+    -------
+    features : Numpy Array (#leads X #features)
+        The columns follow SIGNAL_FEATURES:
+            0. channel_variance: the variance of each lead.
+            1. mean_amplitude: the mean amplitude of each lead.
+            2. median_amplitude: the median amplitude of each lead.
+            3. mean_derivative_value: the mean of the 1st derivative
+               (same as np.gradient).
+            4. median_derivative_value: the median of the 1st derivative.
+            5. power_spectral_density_max: the peak of the power-spectrum
+               (flattop window, 1024 samples per segment, X 1e3).
+
+    '''
+    data = np.asarray(data, dtype=float)
+    n_samples, n_leads = data.shape
+    features = np.empty((n_leads, len(SIGNAL_FEATURES)))
+
+    # the data and their 1st derivative share a single buffer, so that both
+    # medians are computed with one partition
+    buffer = np.empty((2, n_samples, n_leads))
+    buffer[0] = data
+    # 1st derivative: central differences inside, one-sided at the edges
+    np.subtract(data[2:], data[:-2], out=buffer[1, 1:-1])
+    buffer[1, 1:-1] *= 0.5
+    buffer[1, 0] = data[1] - data[0]
+    buffer[1, -1] = data[-1] - data[-2]
+
+    features[:, 0] = np.var(data, axis=0)
+    features[:, 1] = np.mean(data, axis=0)
+    features[:, 3] = np.mean(buffer[1], axis=0)
+    # both medians (the buffer is partitioned in place)
+    medians = np.median(buffer, axis=1, overwrite_input=True)
+    features[:, 2] = medians[0]
+    features[:, 4] = medians[1]
+    # peak of the power-spectrum of all leads
+    _, spectrum = signal.welch(data, sfreq, 'flattop', 1024,
+                               scaling='spectrum', axis=0)
+    features[:, 5] = np.max(spectrum, axis=0) * 1e3
+
+    return features
+
+
+class StreamingSignalFeatures():
+    '''
+    Accumulate the SIGNAL_FEATURES of a record over consecutive blocks of
+    DIGITAL (ADC) samples, e.g: from @signal_io.iter_record_chunks(...,
+    physical=False). The result matches @compute_signal_features applied to
+    the whole record in physical units:
+        1. mean and variance: from exact integer sums of the samples.
+        2. medians: from histograms of the (integer) samples and of twice the
+           1st derivative, so they are exact.
+        3. mean of the derivative: telescoping sum (only the first and the last
+           two samples are needed).
+        4. power spectrum: the Welch segments (1024 samples, 50% overlap) are
+           carried over between blocks and their periodograms are summed.
+    The state (histograms, sums and the carried samples) does not depend on the
+    length of the record.
+    Attributes:
+        1. gain (ADC gain of each lead)
+        2. baseline (ADC baseline of each lead)
+        3. sfreq
+    '''
+
+    # the range of the digital samples (16-bit). Twice the derivative spans
+    # four times this range.
+    _offset = 2**15
+    _n_bins = 2**16
+    # Welch parameters (see @compute_signal_features)
+    _nperseg = 1024
+    _step = 512
+
+    def __init__(self, gain, baseline, sfreq=1000):
+        self.gain = np.asarray(gain, dtype=float)
+        self.baseline = np.asarray(baseline, dtype=float)
+        self.sfreq = sfreq
+        n_leads = len(self.gain)
+        self._n_samples = 0
+        self._sum = np.zeros(n_leads, dtype=np.int64)
+        self._sum_squares = np.zeros(n_leads, dtype=np.int64)
+        self._hist = np.zeros((n_leads, self._n_bins), dtype=np.int64)
+        self._hist_derivative = np.zeros((n_leads, 4 * self._n_bins),
+                                         dtype=np.int64)
+        self._first = None
+        self._last = None
+        self._spectrum = 0
+        self._n_segments = 0
+        self._carry = np.zeros((0, n_leads))
+
+    def _bincount(self, values, n_bins):
+        '''
+        Histogram of each lead (column) of an integer block with a single
+        bincount call.
+        '''
+        n_leads = values.shape[1]
+        flat = (values + n_bins // 2 + n_bins * np.arange(n_leads)).T.ravel()
+        return np.bincount(flat, minlength=n_leads * n_bins).reshape(
+            n_leads, n_bins)
+
+    def update(self, digital):
+        '''
+        Add a block of digital samples (#samples X #leads).
+        '''
+        digital = np.asarray(digital, dtype=np.int64)
+        if len(digital) == 0:
+            return
+        self._n_samples += len(digital)
+        self._sum += digital.sum(axis=0)
+        self._sum_squares += (digital ** 2).sum(axis=0)
+        self._hist += self._bincount(digital, self._n_bins)
+
+        # 2 X the 1st derivative: the central differences need the last two
+        # samples of the previous block
+        if self._first is None:
+            self._first = digital[:2].copy()
+            extended = digital
+            self._hist_derivative += self._bincount(
+                2 * (digital[1:2] - digital[:1]), 4 * self._n_bins)
+        else:
+            extended = np.concatenate((self._last, digital))
+        self._hist_derivative += self._bincount(extended[2:] - extended[:-2],
+                                                4 * self._n_bins)
+        self._last = extended[-2:].copy()
+
+        # Welch segments: keep the samples of the incomplete segments
+        block = np.concatenate((self._carry, self._to_physical(digital)))
+        if len(block) >= self._nperseg:
+            n_segments = (len(block) - self._nperseg) // self._step + 1
+            _, spectrum = signal.welch(block, self.sfreq, 'flattop',
+                                       self._nperseg, scaling='spectrum',
+                                       axis=0)
+            self._spectrum = self._spectrum + spectrum * n_segments
+            self._n_segments += n_segments
+            block = block[n_segments * self._step:]
+        self._carry = block
+
+    def _to_physical(self, digital):
+        return (digital - self.baseline) / self.gain
+
+    def _median(self, hist):
+        '''
+        The median (bin index) of each lead from its histogram.
+        '''
+        cumulative = np.cumsum(hist, axis=1)
+        n = cumulative[:, -1]
+        lower = np.array([np.searchsorted(cum, k, side='right') for cum, k in
+                          zip(cumulative, (n - 1) // 2)])
+        upper = np.array([np.searchsorted(cum, k, side='right') for cum, k in
+                          zip(cumulative, n // 2)])
+        return (lower + upper) / 2
+
+    def result(self):
+        '''
+        Returns the features (#leads X #features, see SIGNAL_FEATURES).
+        '''
+        n = self._n_samples
+        features = np.empty((len(self.gain), len(SIGNAL_FEATURES)))
+        # exact integer moments (python integers avoid any overflow)
+        sums = [int(v) for v in self._sum]
+        sums_squares = [int(v) for v in self._sum_squares]
+        features[:, 0] = [(n * s2 - s * s) / n ** 2 for s, s2 in
+                          zip(sums, sums_squares)] / self.gain ** 2
+        features[:, 1] = (np.array(sums) / n - self.baseline) / self.gain
+        features[:, 2] = ((self._median(self._hist) - self._offset -
+                           self.baseline) / self.gain)
+        # add the last edge of the derivative
+        hist_derivative = self._hist_derivative + self._bincount(
+            2 * (self._last[1:] - self._last[:1]), 4 * self._n_bins)
+        features[:, 4] = ((self._median(hist_derivative) - 2 * self._n_bins) /
+                          (2 * self.gain))
+        # telescoping sum of the derivative
+        first, last = self._first.astype(float), self._last.astype(float)
+        total = ((first[1] - first[0]) + (last[1] - last[0]) +
+                 (last[1] + last[0] - first[1] - first[0]) / 2)
+        features[:, 3] = total / n / self.gain
+        # peak of the power-spectrum
+        if self._n_segments == 0:
+            # shorter than a Welch segment: the whole record is carried
+            _, spectrum = signal.welch(self._carry, self.sfreq, 'flattop',
+                                       self._nperseg, scaling='spectrum',
+                                       axis=0)
+        else:
+            spectrum = self._spectrum / self._n_segments
+        features[:, 5] = np.max(spectrum, axis=0) * 1e3
+
+        return features
+
+
+def compute_window_features(time_series, window_size, step, sfreq=1000):
+    '''
+    Segment a time series into fixed-length windows and compute a feature
+    vector per window. The windows are strided views of the data (no copy).
+
+    Parameters
+    ----------
+    time_series : Numpy Array (#samples,)
+        e.g: the preprocessed data of a single lead.
+    window_size : Int
+        The length of each window (in samples).
+    step : Int
+        The distance between the onsets of two consecutive windows (in
+        samples). Windows overlap if step < window_size.
+    sfreq : Int, optional
+        The sampling frequency in Hz. The default is 1000.
+
+    Returns
+    -------
+    features : Numpy Array (#windows X #features)
+        The columns follow WINDOW_FEATURES:
+            0. mean: the mean amplitude.
+            1. std: the standard deviation.
+            2. min: the minimum amplitude.
+            3. max: the maximum amplitude.
+            4. median: the median amplitude.
+            5. mean_abs_derivative: the mean absolute 1st difference.
+            6. dominant_frequency: the peak of the amplitude spectrum in Hz
+               (DC excluded).
+        Samples after the last full window are dropped.
+
+    '''
+    time_series = np.asarray(time_series, dtype=float)
+    n_windows = max(0, (len(time_series) - window_size) // step + 1)
+    features = np.empty((n_windows, len(WINDOW_FEATURES)))
+    if n_windows == 0:
+        return features
+
+    windows = sliding_window_view(time_series, window_size)[::step]
+    features[:, 0] = np.mean(windows, axis=1)
+    features[:, 1] = np.std(windows, axis=1)
+    features[:, 2] = np.min(windows, axis=1)
+    features[:, 3] = np.max(windows, axis=1)
+    features[:, 4] = np.median(windows, axis=1)
+    # the derivative is computed once over the whole series
+    derivative = np.abs(np.diff(time_series))
+    features[:, 5] = np.mean(sliding_window_view(derivative, window_size - 1)
+                             [::step], axis=1)
+    # dominant frequency of each (de-meaned) window
+    spectrum = np.abs(np.fft.rfft(windows - features[:, :1], axis=1))
+    frequencies = np.fft.rfftfreq(window_size, 1 / sfreq)
+    features[:, 6] = frequencies[np.argmax(spectrum[:, 1:], axis=1) + 1]
+
+    return features
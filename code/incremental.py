@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Dependency tracking for the incremental re-execution of the pipeline.
+
+For each unit of work of a stage (e.g: a patient @03_data_preprocessing.py)
+a manifest stores the content hash of its inputs (e.g: the raw .dat/.hea
+files) and of the relevant settings @config.py, together with the list of
+the produced artifacts. When the inputs, the settings and the artifacts
+are unchanged, the work is skipped.
+
+The manifests are stored in the info dir (info/manifests/<stage>/<key>.json).
+To re-run everything, set the variable "incremental" @config.py to False.
+
+@author: Christos
+"""
+
+# =============================================================================
+# IMPORT MODULES
+# =============================================================================
+import os
+import json
+import hashlib
+import config as c
+
+
+# =============================================================================
+# UTILITY FUNCTIONS
+# =============================================================================
+def hash_file(fname, chunk_size=2**20):
+    '''
+    Return the content hash (blake2b, hex) of a given file.
+    '''
+    digest = hashlib.blake2b(digest_size=16)
+    with open(fname, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+
+    return digest.hexdigest()
+
+
+def describe(value):
+    '''
+    Return a JSON-serializable and stable description of a setting.
+    Frozen scipy distributions (e.g: the "param_test" @config.py) are
+    described by their name and parameters.
+    '''
+    if hasattr(value, 'dist') and hasattr(value, 'args'):
+        return {'distribution': value.dist.name,
+                'args': describe(list(value.args)),
+                'kwds': describe(value.kwds)}
+    if isinstance(value, dict):
+        return {str(k): describe(v) for k, v in sorted(value.items())}
+    if isinstance(value, (list, tuple)):
+        return [describe(v) for v in value]
+    if isinstance(value, (str, int, float, bool)) or value is None:
+        return value
+
+    return repr(value)
+
+
+def load_digest(path, stage, key):
+    '''
+    Return the digest recorded for a given stage and key (None if the work
+    was never recorded). Used to chain the stages, e.g: the modelling depends
+    on the digests of the preprocessing of each patient.
+    '''
+    return Manifest(path, stage, key).previous.get('digest')
+
+
+# =============================================================================
+# MANIFEST
+# =============================================================================
+class Manifest():
+    '''
+    The manifest of a unit of work (e.g: a patient) of a given stage.
+    Attributes:
+        1. fname (the .json file of the manifest)
+        2. previous (the manifest recorded by the previous run)
+        3. digest (the digest of the current inputs and settings)
+    '''
+
+    def __init__(self, path, stage, key):
+        self.fname = c.join(path.to_info(), 'manifests', stage, f'{key}.json')
+        self.previous = {}
+        if os.path.isfile(self.fname):
+            with open(self.fname, 'r') as f:
+                self.previous = json.load(f)
+        self.digest = None
+        self._files = {}
+
+    def compute_digest(self, inputs, settings):
+        '''
+        Hash the content of the input files and the settings. The hash of a
+        file whose size and modification time did not change since the
+        previous run is reused (the file is not read again).
+        '''
+        digest = hashlib.blake2b(digest_size=16)
+        previous_files = self.previous.get('files', {})
+        self._files = {}
+        for fname in sorted(inputs):
+            stat = os.stat(fname)
+            previous = previous_files.get(fname, {})
+            if (previous.get('size') == stat.st_size and
+                    previous.get('mtime_ns') == stat.st_mtime_ns):
+                file_hash = previous['hash']
+            else:
+                file_hash = hash_file(fname)
+            self._files[fname] = {'size': stat.st_size,
+                                  'mtime_ns': stat.st_mtime_ns,
+                                  'hash': file_hash}
+            digest.update(f'{os.path.basename(fname)}:{file_hash}'.encode())
+        digest.update(json.dumps(describe(settings), sort_keys=True).encode())
+        self.digest = digest.hexdigest()
+
+        return self.digest
+
+    def is_up_to_date(self, inputs, settings, outputs):
+        '''
+        Returns True if the inputs and the settings did not change since the
+        previous run and all the outputs exist.
+
+        Parameters
+        ----------
+        inputs : List
+            The input files (their content is hashed).
+        settings : Dict
+            The relevant settings (e.g: the kernel width) and any upstream
+            digests.
+        outputs : List
+            The artifacts produced by the work.
+
+        '''
+        digest = self.compute_digest(inputs, settings)
+        if not c.incremental:
+            return False
+
+        return (digest == self.previous.get('digest') and
+                all(os.path.exists(fname) for fname in outputs))
+
+    def save(self, outputs):
+        '''
+        Record the manifest once the work is done (call @is_up_to_date first).
+        '''
+        path2manifest = os.path.dirname(self.fname)
+        if not c.exists(path2manifest):
+            c.make(path2manifest, exist_ok=True)
+        manifest = {'digest': self.digest, 'files': self._files,
+                    'outputs': list(outputs)}
+        # write atomically, so that an interrupted run is never up to date
+        tmp_fname = f'{self.fname}.{os.getpid()}.tmp'
+        with open(tmp_fname, 'w') as f:
+            json.dump(manifest, f, indent=1)
+        os.replace(tmp_fname, self.fname)
+        self.previous = manifest
@@ -0,0 +1,414 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Fused ingest of the raw records: each record is read ONCE and, in the same
+worker, the header metadata and the signal metadata (@00_get_patient_info.py)
+are extracted and the preprocessed array (@03_data_preprocessing.py) is
+written. Enable it with the variable "fused_ingest" @config.py: the ingest
+then runs @00_get_patient_info.py and @03_data_preprocessing.py has nothing
+left to do.
+
+The manifests of both stages (see @incremental.py) are defined here, so that
+the fused and the separate runs skip the same work.
+
+@author: Christos
+"""
+
+# =============================================================================
+# IMPORT MODULES
+# =============================================================================
+import os
+import json
+import numpy as np
+import pandas as pd
+import wfdb
+import config as c
+import feature_store
+from features import compute_signal_features, SIGNAL_FEATURES
+from features import StreamingSignalFeatures
+from signal_io import RawRecord, iter_record_chunks, save_preprocessed
+from signal_io import preprocessed_fname, record_cost
+from preprocessing import smooth_and_standardize, StreamingPreprocessor
+from incremental import Manifest
+from profiling import profile
+from artifact_writer import ArtifactWriter, write_atomic, write_csv
+
+
+# =============================================================================
+# UTILITY FUNCTIONS
+# =============================================================================
+def list_raw_records(path, patient):
+    '''
+    Returns the sorted records of a patient, i.e: the distinct prefices of
+    the .dat files in the "raw" dir (e.g: ['s0010_re',...]).
+    '''
+    files = os.listdir(c.join(path.to_data_raw(), patient))
+
+    return sorted(f.split('.dat')[0] for f in files if '.dat' in f)
+
+
+def raw_inputs(path, patient, records):
+    '''
+    Returns the raw files (.hea and .dat) of the given records.
+    '''
+    return [c.join(path.to_data_raw(), patient, f'{record}{ext}') for record
+            in records for ext in ('.hea', '.dat')]
+
+
+def header_metadata_fname(path, patient, record):
+    '''
+    Returns the filename of the header metadata of a given patient and record.
+    '''
+    return c.join(path.to_info(), patient, record, 'patient_metadata',
+                  f'{patient}_{record}_header_metadata.csv')
+
+
+def patient_info_manifest(path, patient, records):
+    '''
+    Returns the manifest of @00_get_patient_info for a given patient, with
+    its inputs, settings and outputs (see @incremental.Manifest).
+    '''
+    outputs = [header_metadata_fname(path, patient, record) for record in
+               records]
+    settings = {'features': SIGNAL_FEATURES}
+
+    return (Manifest(path, 'patient_info', patient),
+            raw_inputs(path, patient, records), settings, outputs)
+
+
+def preprocessing_manifest(path, patient, records):
+    '''
+    Returns the manifest of @03_data_preprocessing for a given patient, with
+    its inputs, settings and outputs (see @incremental.Manifest).
+    '''
+    outputs = [preprocessed_fname(path, patient, record) for record in
+               records]
+    settings = {'kernel_width_sec': c.kernel_width_sec,
+                'sampling_rate': c.sampling_rate,
+                'preprocessed_layout': c.preprocessed_layout,
+                'preprocessed_dtype': c.preprocessed_dtype,
+                'smoothing_method': c.smoothing_method,
+                'raw_dtype': c.raw_dtype if c.raw_reader == 'memmap' else
+                'float64'}
+
+    return (Manifest(path, 'preprocessing', patient),
+            raw_inputs(path, patient, records), settings, outputs)
+
+
+def build_index(path, patients):
+    '''
+    Build the index of the patients, their (sorted) records and the paths of
+    their artifacts (relative to the project dir) and store it in the info
+    dir. The later stages look up the records with @config.FetchPaths
+    instead of listing the directories.
+
+    Parameters
+    ----------
+    path : Class
+        The path constructor.
+    patients : List
+        The sorted list of patients (e.g: patient001,...).
+
+    Returns
+    -------
+    fname : String
+        The filename of the index.
+
+    '''
+    def relative(fname):
+        return os.path.relpath(fname, path.to_project())
+
+    index = {'patients': {}}
+    for patient in patients:
+        records = list_raw_records(path, patient)
+        artifacts = {record: {
+            'raw': relative(c.join(path.to_data_raw(), patient, record)),
+            'header_metadata': relative(header_metadata_fname(path, patient,
+                                                              record)),
+            'preprocessed': relative(preprocessed_fname(path, patient,
+                                                        record))}
+            for record in records}
+        index['patients'][patient] = {'records': records,
+                                      'artifacts': artifacts}
+    # write atomically (the index is read by the other stages)
+    fname = path.to_index()
+    tmp_fname = f'{fname}.{os.getpid()}.tmp'
+    with open(tmp_fname, 'w') as f:
+        json.dump(index, f, indent=1)
+    os.replace(tmp_fname, fname)
+
+    return fname
+
+
+def read_header_comments(fname):
+    '''
+    Returns the comments of a .hea file (the lines that start with '#',
+    without the '#'), without parsing the specification of the signals.
+    '''
+    with open(fname, 'r') as f:
+        lines = f.read().splitlines()
+
+    return [line[1:] for line in lines if line.startswith('#')]
+
+
+def parse_header_comments(comments):
+    '''
+    Parse the header comments ("feature: value", e.g: "age: 81") in a single
+    pass: each comment is split once, at its first ':'. The whitespace of
+    each entry is stripped and the empty values are set to "no_entry".
+
+    Returns
+    -------
+    features : List
+        e.g: ['age', 'sex',...]
+    values : List
+        e.g: ['81', 'female',...]
+
+    '''
+    features, values = [], []
+    for comment in comments:
+        feature, _, value = comment.partition(':')
+        features.append(feature.strip())
+        values.append(value.strip() or 'no_entry')
+
+    return features, values
+
+
+def tranform_metadata_to_dataframe(metadata, patient, record, path,
+                                   writer=None):
+    '''
+    Transform the metadata extracted from the header into a pandas dataframe
+    and store this information in the info derivative. Each metadata file
+    corresponds to a record of a given patient.
+
+    Additionally, strip the whitespace of each entry and set the empty
+    to the string "empty_value"
+
+    Parameters
+    ----------
+    metadata : List
+        The original metadata file extracted from the header for a given
+        patient and record.
+    record : String
+        The corresponfing record of the current patient.
+    patient: String
+        The current patient.
+    path : Class
+        The path constructor.
+    writer : ArtifactWriter, optional
+        Write the dataframe in the background (see @artifact_writer.py). If
+        None, the dataframe is written before returning.
+
+    Returns
+    -------
+    None
+    '''
+    # get the features (e.g age) and the values
+    columns, values = parse_header_comments(metadata)
+    # transform into a dataframe
+    metadata_df = pd.DataFrame(list(zip(columns, values)), columns=['feature', 'value'])
+    # store into the info derivative dir
+    fname = header_metadata_fname(path, patient, record)
+    if writer is None:
+        write_atomic(fname, write_csv, metadata_df)
+        return
+    writer.save_csv(fname, metadata_df)
+
+
+# =============================================================================
+# FUSED INGEST
+# =============================================================================
+def ingest_record(record_path, patient, record, path, extract, preprocess,
+                  writer=None):
+    '''
+    Read a record once and extract its signal metadata and/or preprocess it.
+
+    Parameters
+    ----------
+    record_path : String
+        The path of the raw record (without extension).
+    patient : String
+        e.g 'patient001'
+    record : String
+        e.g 's0010_re'
+    path : Class
+        The path constructor.
+    extract : Bool
+        Store the header metadata and return the signal metadata.
+    preprocess : Bool
+        Smooth, standardize and save the recording.
+    writer : ArtifactWriter, optional
+        Write the artifacts in the background (see @artifact_writer.py).
+
+    Returns
+    -------
+    rows : Numpy structured array (len = #leads)
+        The signal metadata as rows of the consolidated store (None if
+        "extract" is False).
+
+    '''
+    sigma = c.kernel_width_sec * c.sampling_rate
+    if c.streaming:
+        # a single stream of digital blocks feeds both the features and the
+        # preprocessing
+        info = (RawRecord(record_path) if c.raw_reader == 'memmap' else
+                wfdb.rdheader(record_path))
+        gain = np.asarray(info.adc_gain, dtype=float)
+        baseline = np.asarray(info.baseline, dtype=float)
+        if extract:
+            accumulator = StreamingSignalFeatures(gain, baseline, info.fs)
+        if preprocess:
+            preprocessor = StreamingPreprocessor(path, patient, record,
+                                                 info.sig_len, info.n_sig)
+        try:
+            for _, digital in iter_record_chunks(record_path,
+                                                 physical=False):
+                if extract:
+                    accumulator.update(digital)
+                if preprocess:
+                    preprocessor.update((digital - baseline) / gain)
+            if preprocess:
+                preprocessor.finalize()
+        except BaseException:
+            if preprocess:
+                preprocessor.abort()
+            raise
+        features = accumulator.result() if extract else None
+    else:
+        if c.raw_reader == 'memmap':
+            info = RawRecord(record_path)
+            data = info.physical()
+        else:
+            info = wfdb.rdrecord(record_path)
+            data = info.p_signal
+        # the features first, the preprocessing overwrites the data
+        features = compute_signal_features(data, info.fs) if extract else None
+        if preprocess:
+            save_preprocessed(smooth_and_standardize(data, sigma), path,
+                              patient, record, writer=writer)
+
+    if not extract:
+        return None
+    tranform_metadata_to_dataframe(info.comments, patient, record, path,
+                                   writer)
+    signal_metadata = pd.DataFrame(features, index=info.sig_name,
+                                   columns=SIGNAL_FEATURES)
+
+    return feature_store.to_store_rows(signal_metadata, patient, record)
+
+
+def ingest_record_job(patient, record, extract, preprocess):
+    '''
+    The worker of the fused ingest: read a record once, store its header
+    metadata, extract its signal metadata and save the preprocessed
+    recording (see @ingest_record). The work left for each patient is found
+    by @plan_patient.
+
+    Returns
+    -------
+    Numpy structured array
+        The signal metadata of all leads of the record (None if "extract" is
+        False).
+
+    '''
+    # set up the logging of the worker (see @config.init)
+    c.init(worker=True)
+    path = c.FetchPaths(c.PROJECTS_PATH, c.PROJECT_NAME)
+    with profile('ingest', path, patient=patient, record=record,
+                 extract=extract, preprocess=preprocess):
+        # the artifacts are written while the record is processed
+        with ArtifactWriter() as writer:
+            return ingest_record(c.join(path.to_data_raw(), patient, record),
+                                 patient, record, path, extract, preprocess,
+                                 writer)
+
+
+# =============================================================================
+# SCHEDULING
+# =============================================================================
+# The stages @00_get_patient_info.py and @03_data_preprocessing.py (and the
+# fused ingest) run one job per record instead of one per patient: the
+# patients have one or more records of different lengths. The work left for
+# each patient is found first (@plan_patient), then the records are run the
+# longest first (see @executors.py) and the manifests of the patients are
+# saved once all their records are done (@save_manifests).
+def plan_patient(patient, extract=False, preprocess=False, force=False,
+                 indexed=False):
+    '''
+    Returns the work left for a given patient. Runs in the workers, since the
+    manifests hash the raw files that changed (see @incremental.py).
+
+    Parameters
+    ----------
+    patient : String
+        e.g 'patient001'
+    extract : Bool
+        Check the header and signal metadata (@00_get_patient_info).
+    preprocess : Bool
+        Check the preprocessed recordings (@03_data_preprocessing).
+    force : Bool
+        Extract the metadata even if they are up to date (e.g: when they are
+        missing from the store).
+    indexed : Bool
+        Look up the records in the index (built @00_get_patient_info),
+        instead of listing the raw dir.
+
+    Returns
+    -------
+    plan : Dict (None if the patient is up to date)
+        1. patient
+        2. records, costs (the cost of each record, see
+           @signal_io.record_cost)
+        3. extract, preprocess (the work left)
+        4. manifests (the manifests to save once all records are done, with
+           their outputs)
+
+    '''
+    # set up the logging of the worker (see @config.init)
+    c.init(worker=True)
+    path = c.FetchPaths(c.PROJECTS_PATH, c.PROJECT_NAME)
+    records = (path.records(patient) if indexed else
+               list_raw_records(path, patient))
+    plan = {'patient': patient, 'records': records, 'extract': False,
+            'preprocess': False, 'manifests': []}
+    if extract:
+        manifest, inputs, settings, outputs = patient_info_manifest(
+            path, patient, records)
+        if not manifest.is_up_to_date(inputs, settings, outputs) or force:
+            plan['extract'] = True
+            plan['manifests'].append((manifest, outputs))
+    if preprocess:
+        manifest, inputs, settings, outputs = preprocessing_manifest(
+            path, patient, records)
+        if not manifest.is_up_to_date(inputs, settings, outputs):
+            plan['preprocess'] = True
+            plan['manifests'].append((manifest, outputs))
+    if not (plan['extract'] or plan['preprocess']):
+        return None
+    plan['costs'] = [record_cost(c.join(path.to_data_raw(), patient, record))
+                     for record in records]
+
+    return plan
+
+
+def record_jobs(plans):
+    '''
+    Returns the (patient, record) of each record of the plans (see
+    @plan_patient), in the order of the patients and of their records, and
+    the cost of each record.
+    '''
+    jobs = [(plan['patient'], record) for plan in plans for record in
+            plan['records']]
+    costs = [cost for plan in plans for cost in plan['costs']]
+
+    return jobs, costs
+
+
+def save_manifests(plans):
+    '''
+    Save the manifests of the plans (see @plan_patient), once all their
+    records are done.
+    '''
+    for plan in plans:
+        for manifest, outputs in plan['manifests']:
+            manifest.save(outputs)
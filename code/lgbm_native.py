@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Native LightGBM backend of @04_modelling.py (see the variable "lgbm_backend"
+@config.py).
+
+The sklearn API (LGBMClassifier) bins the features of the training fold
+again at every fit, i.e: for each fold of each candidate of the search and
+of the final cross-validation. Here, the binned dataset (lgb.Dataset) of a
+model is built ONCE and each fit trains on a subset of it (the training
+fold, or a random part of it in the successive halving), which shares its
+bins. The binned dataset is stored in the LightGBM binary format and loaded
+by the next runs as long as the data of the model did not change (see
+@incremental.py).
+
+The params are described with the names of the sklearn API (e.g:
+"min_child_samples"), which are aliases of the native ones, so that the
+best params of both backends are interchangeable.
+
+@author: Christos
+"""
+
+# =============================================================================
+# IMPORT MODULES
+# =============================================================================
+import warnings
+import numpy as np
+import lightgbm as lgb
+from sklearn.base import clone
+from sklearn import metrics
+from sklearn.model_selection import ParameterSampler
+from sklearn.utils import resample
+import config as c
+
+
+# =============================================================================
+# GLOBALS
+# =============================================================================
+# The params of the binned dataset. The features are not filtered with the
+# "min_child_samples" of the first fit, since each candidate sets its own.
+DATASET_PARAMS = {'verbose': -1, 'feature_pre_filter': False}
+
+# the subsets share the bins of the full dataset, whatever the params of the
+# fit (e.g: "min_child_samples")
+warnings.filterwarnings('ignore', 'Overriding the parameters from Reference')
+
+# params of the sklearn API that are not passed to the native API
+SKLEARN_ONLY_PARAMS = ('n_estimators', 'n_jobs', 'importance_type',
+                       'class_weight', 'random_state')
+
+# the minimum number of rows per class of the subsets of the folds in the
+# successive halving (see @search)
+MIN_ROWS_PER_CLASS = 2
+
+
+# =============================================================================
+# FUNCTIONS
+# =============================================================================
+def build_dataset(X, y, fname, manifest=None, settings=None):
+    '''
+    Returns the binned dataset of a model. The dataset is loaded from
+    "fname" if the data did not change since it was stored, otherwise it is
+    built from the feature matrix and stored.
+
+    Parameters
+    ----------
+    X : Array (#rows X #features)
+        The feature matrix.
+    y : Array
+        Target.
+    fname : String
+        The LightGBM binary file of the dataset.
+    manifest : Manifest, optional
+        The manifest of the dataset (see @incremental.py). If None, the
+        dataset is always built.
+    settings : Dict, optional
+        The description of the data (e.g: the preprocessing digests).
+
+    Returns
+    -------
+    dataset : lgb.Dataset
+        The constructed (binned) dataset.
+
+    '''
+    if manifest is not None and manifest.is_up_to_date([], settings, [fname]):
+        return lgb.Dataset(fname, params=DATASET_PARAMS).construct()
+
+    dataset = lgb.Dataset(X, label=np.ravel(y, order='C'),
+                          params=DATASET_PARAMS).construct()
+    dataset.save_binary(fname)
+    if manifest is not None:
+        manifest.save([fname])
+
+    return dataset
+
+
+def native_params(model, num_threads=None):
+    '''
+    Returns the native params and the number of boosting rounds of a model
+    of the sklearn API (e.g: LGBMClassifier(**best_params)).
+    '''
+    params = {key: value for key, value in model.get_params().items() if
+              value is not None and key not in SKLEARN_ONLY_PARAMS}
+    # the AUC is computed once per fold, not at each boosting round
+    params.update({'metric': 'None', 'verbose': -1,
+                   'num_threads': model.n_jobs if num_threads is None else
+                   num_threads})
+
+    return params, model.n_estimators
+
+
+def subsample(idx, y, fraction, random_state=None):
+    '''
+    Returns a stratified random subset of the rows of a fold (sorted), with
+    at least MIN_ROWS_PER_CLASS rows per class. All rows if the fraction
+    covers the fold or if no stratified subset has all the classes of the
+    fold (e.g: a class with a single row).
+
+    Parameters
+    ----------
+    idx : Array
+        The rows of the fold.
+    y : Array
+        Target (of all rows).
+    fraction : Float
+        The fraction of the rows of the fold.
+    random_state : Int, optional
+        The seed of the subset.
+
+    Returns
+    -------
+    Array
+
+    '''
+    classes = np.unique(y[idx])
+    n_samples = max(int(fraction * len(idx)),
+                    MIN_ROWS_PER_CLASS * len(classes))
+    if n_samples >= len(idx):
+        return idx
+    try:
+        subset = resample(idx, replace=False, n_samples=n_samples,
+                          stratify=y[idx], random_state=random_state)
+    except ValueError:
+        return idx
+    if len(np.unique(y[subset])) < len(classes):
+        return idx
+
+    return np.sort(subset)
+
+
+def n_halving_iterations(n_candidates, cv, y):
+    '''
+    Returns the number of iterations of the successive halving: until a
+    single candidate is left, but no more than the smallest fold allows, so
+    that the subsets of the first iteration keep at least MIN_ROWS_PER_CLASS
+    rows per class (as the min_resources='exhaust' of sklearn).
+    '''
+    n_iterations = 1
+    while c.search_factor ** n_iterations <= n_candidates:
+        n_iterations += 1
+    n_classes = len(np.unique(y))
+    smallest = min(min(len(train), len(test)) for train, test in cv)
+    while (n_iterations > 1 and
+           smallest * c.search_factor ** (1 - n_iterations) <
+           MIN_ROWS_PER_CLASS * n_classes):
+        n_iterations -= 1
+
+    return n_iterations
+
+
+def cross_val_auc(model, dataset, X, y, cv, fraction=1., random_state=None,
+                  num_threads=None):
+    '''
+    Returns the mean AUC of a model across the CV folds. Each fold trains on
+    a subset of the binned dataset and predicts the rows of the test fold.
+
+    Parameters
+    ----------
+    model : LGBMClassifier
+        The model (its params).
+    dataset : lgb.Dataset
+        The binned dataset (see @build_dataset).
+    X : Array (#rows X #features)
+        The feature matrix (in memory or memory-mapped).
+    y : Array
+        Target.
+    cv : List
+        The CV splits (see @04_modelling.make_cv_splits).
+    fraction : Float, optional
+        The fraction of the rows of each fold that is used (stratified random
+        subset, see @subsample and @search). The default is 1 (all rows).
+    random_state : Int, optional
+        The seed of the subsets (the same seed gives the same subsets, see
+        @search).
+    num_threads : Int, optional
+        The LightGBM threads (the folds run one after the other). If None,
+        the "n_jobs" of the model.
+
+    Returns
+    -------
+    Float
+        The mean AUC across the folds.
+
+    '''
+    y = np.ravel(y, order='C')
+    params, num_boost_round = native_params(model, num_threads)
+    scores = []
+    for train, test in cv:
+        if fraction < 1:
+            train, test = [subsample(idx, y, fraction, random_state) for idx
+                           in (train, test)]
+        booster = lgb.train(params, dataset.subset(train),
+                            num_boost_round=num_boost_round)
+        # predict the test rows in blocks (X can be a memory-mapped file)
+        prediction = np.concatenate([
+            booster.predict(X[test[start:start + c.chunk_size]]) for start in
+            range(0, len(test), c.chunk_size)])
+        # looked up at each call (patched @04_modelling.py, if accelerated)
+        scores.append(metrics.roc_auc_score(y[test], prediction))
+
+    return np.mean(scores)
+
+
+def search(model, dataset, X, y, cv, num_threads=None):
+    '''
+    Search the hyperparameters of "param_test" @config.py (see the variable
+    "search_method" @config.py). In the successive halving, the budget of the
+    candidates is the fraction of the rows of the folds: the first iteration
+    fits "search_n_candidates" on the smallest fraction and each iteration
+    keeps the best 1/"search_factor" of them on a "search_factor" times
+    larger fraction, until all rows are used. The number of iterations is
+    capped so that the smallest subsets keep MIN_ROWS_PER_CLASS rows per class
+    (see @n_halving_iterations). The candidates of an iteration are fitted
+    and scored on the same subsets of the folds. The candidates are ranked
+    by their AUC.
+
+    Returns
+    -------
+    best_params : Dict
+        The params of the best candidate.
+    best_score : Float
+        Its mean AUC across the folds (all rows).
+
+    '''
+    if c.search_method == 'halving':
+        candidates = list(ParameterSampler(c.param_test,
+                                           n_iter=c.search_n_candidates,
+                                           random_state=c.random_state))
+        # until a single candidate is left (or the folds are too small)
+        n_iterations = n_halving_iterations(len(candidates), cv,
+                                            np.ravel(y, order='C'))
+    else:
+        # the candidates of the randomized search (all rows)
+        candidates = list(ParameterSampler(c.param_test,
+                                           n_iter=c.search_n_iter,
+                                           random_state=c.random_state))
+        n_iterations = 1
+
+    for iteration in range(n_iterations):
+        fraction = c.search_factor ** (iteration - n_iterations + 1)
+        # all candidates of an iteration are fitted and scored on the same
+        # subsets of the folds (a new subset at each iteration)
+        seed = c.random_state + iteration
+        scores = [cross_val_auc(clone(model).set_params(**params), dataset,
+                                X, y, cv, fraction, seed, num_threads)
+                  for params in candidates]
+        print(f'Iteration {iteration}: {len(candidates)} candidates, '
+              f'{fraction:.3f} of the rows')
+        # keep the best candidates for the next iteration
+        n_keep = int(np.ceil(len(candidates) / c.search_factor))
+        if iteration == n_iterations - 1:
+            n_keep = 1
+        order = np.argsort(-np.asarray(scores), kind='stable')[:n_keep]
+        candidates = [candidates[idx] for idx in order]
+        best_score = scores[order[0]]
+
+    return dict(candidates[0]), best_score
@@ -0,0 +1,308 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+The preprocessing kernels of @03_data_preprocessing.py (smoothing with a
+Gaussian kernel and standardization).
+
+@smooth_and_standardize filters all leads of a record with a single call
+(direct or FFT convolution) and standardizes the result in place, so that no
+copy of the record is allocated. The output can be stored as float32 (see
+the variables "smoothing_method" and "preprocessed_dtype" @config.py).
+
+The streaming version (@preprocess_record_streaming) gives the same result
+for records that do not fit in memory.
+
+The raw record is read in blocks (see @signal_io.iter_record_chunks). The
+Gaussian filter keeps the samples it still needs (the kernel radius on each
+side) between blocks, so its output is identical to filtering the whole
+record at once. The smoothed blocks are written to the memory-mapped output
+file while their moments are accumulated; the standardization is then
+applied in place, block by block. The memory needed does not depend on the
+length of the record.
+
+@author: Christos
+"""
+
+# =============================================================================
+# IMPORT MODULES
+# =============================================================================
+import os
+import numpy as np
+import wfdb
+from scipy.ndimage import gaussian_filter1d
+from scipy.signal import fftconvolve
+import config as c
+from signal_io import iter_record_chunks, open_preprocessed
+
+
+# =============================================================================
+# KERNELS
+# =============================================================================
+def gaussian_kernel(sigma, truncate=4.0):
+    '''
+    Returns the normalized Gaussian kernel used by
+    scipy.ndimage.gaussian_filter1d.
+    '''
+    radius = int(truncate * float(sigma) + 0.5)
+    x = np.arange(-radius, radius + 1)
+    kernel = np.exp(-0.5 / sigma ** 2 * x ** 2)
+
+    return kernel / kernel.sum()
+
+
+def fft_gaussian_filter(data, sigma, truncate=4.0):
+    '''
+    Same as gaussian_filter1d(data, sigma, axis=0) (mode 'reflect'), computed
+    with an FFT convolution of all leads. Faster for wide kernels.
+    '''
+    kernel = gaussian_kernel(sigma, truncate)
+    radius = len(kernel) // 2
+    # 'reflect' of scipy.ndimage is the 'symmetric' padding of numpy
+    padded = np.pad(data, ((radius, radius), (0, 0)), mode='symmetric')
+
+    return fftconvolve(padded, kernel[:, np.newaxis], mode='valid', axes=0)
+
+
+def standardize(data):
+    '''
+    Z-transform each lead (column) in place, as the StandardScaler of
+    sklearn (population std, leads with zero variance are only centered).
+    '''
+    data -= data.mean(axis=0)
+    # sum of squares without a temporary copy of the data
+    scale = np.sqrt(np.einsum('ij,ij->j', data, data) / len(data))
+    scale[scale == 0] = 1
+    data /= scale
+
+    return data
+
+
+def smooth_and_standardize(data, sigma, method=None, dtype=None):
+    '''
+    Smooth all leads of a record with a Gaussian kernel and standardize them.
+    The data are overwritten when they already have the requested dtype.
+
+    Parameters
+    ----------
+    data : Numpy Array (#samples X #leads)
+        The recording in physical units.
+    sigma : Float
+        The std of the Gaussian kernel in samples.
+    method : String, optional
+        'direct' (one gaussian_filter1d call along the samples) or 'fft'
+        (FFT convolution). Defaults to the "smoothing_method" @config.py
+    dtype : String, optional
+        'float64' or 'float32'. Defaults to the "preprocessed_dtype"
+        @config.py
+
+    Returns
+    -------
+    data : Numpy Array (#samples X #leads)
+        The preprocessed recording.
+
+    '''
+    if method is None:
+        method = c.smoothing_method
+    if dtype is None:
+        dtype = c.preprocessed_dtype
+    data = np.require(data, dtype=dtype, requirements=['W'])
+    if method == 'direct':
+        gaussian_filter1d(data, sigma, axis=0, output=data)
+    elif method == 'fft':
+        data[:] = fft_gaussian_filter(data, sigma)
+    else:
+        raise ValueError(f'Unknown smoothing method: {method}')
+
+    return standardize(data)
+
+
+# =============================================================================
+# STREAMING KERNELS
+# =============================================================================
+class StreamingGaussianFilter():
+    '''
+    Gaussian smoothing (along the samples) of a signal that arrives in
+    consecutive blocks. The output of each block is delayed by the kernel
+    radius; call @flush after the last block to get the remaining samples.
+    Attributes:
+        1. sigma (the std of the kernel in samples)
+        2. radius (the half-width of the truncated kernel in samples)
+    '''
+
+    def __init__(self, sigma, truncate=4.0):
+        self.sigma = sigma
+        # same as scipy.ndimage.gaussian_filter1d
+        self.radius = int(truncate * float(sigma) + 0.5)
+        self.truncate = truncate
+        self._buffer = None
+        # the number of samples at the start of the buffer that have been
+        # returned already (kept as left context)
+        self._n_done = 0
+
+    def _smooth(self, data):
+        return gaussian_filter1d(data, self.sigma, axis=0,
+                                 truncate=self.truncate)
+
+    def update(self, block):
+        '''
+        Add a block (#samples X #leads) and return the smoothed samples
+        whose neighbourhood is complete.
+        '''
+        if self._buffer is None:
+            buffer = block
+        else:
+            buffer = np.concatenate((self._buffer, block))
+        # the samples whose right context (radius) is available
+        n_ready = len(buffer) - self._n_done - self.radius
+        if n_ready <= 0:
+            self._buffer = buffer
+            return buffer[:0]
+
+        smoothed = self._smooth(buffer)[self._n_done:self._n_done + n_ready]
+        # keep the left context and the pending samples
+        keep_from = max(0, len(buffer) - 2 * self.radius)
+        self._n_done = self._n_done + n_ready - keep_from
+        self._buffer = buffer[keep_from:]
+
+        return smoothed
+
+    def flush(self):
+        '''
+        Returns the last (pending) smoothed samples.
+        '''
+        if self._buffer is None:
+            return np.zeros((0, 0))
+        smoothed = self._smooth(self._buffer)[self._n_done:]
+        self._buffer = None
+        self._n_done = 0
+
+        return smoothed
+
+
+class RunningMoments():
+    '''
+    Mean and variance (per column) of data that arrive in blocks. The
+    moments of the blocks are merged with the pairwise update of Chan et al.,
+    which is numerically stable.
+    '''
+
+    def __init__(self):
+        self.n = 0
+        self.mean = 0.
+        self._m2 = 0.
+
+    def update(self, block):
+        n_block = len(block)
+        if n_block == 0:
+            return
+        mean_block = block.mean(axis=0)
+        m2_block = ((block - mean_block) ** 2).sum(axis=0)
+        n = self.n + n_block
+        delta = mean_block - self.mean
+        self.mean = self.mean + delta * n_block / n
+        self._m2 = self._m2 + m2_block + delta ** 2 * self.n * n_block / n
+        self.n = n
+
+    @property
+    def var(self):
+        return self._m2 / self.n
+
+
+class StreamingPreprocessor():
+    '''
+    Smooth and standardize a record that arrives in consecutive blocks
+    (physical units, #samples X #leads) and write it in the preprocessed dir:
+        1. @update: the blocks are smoothed, written to the memory-mapped
+           temporary file and their moments are accumulated.
+        2. @finalize: the output is standardized in place, block by block,
+           flushed and moved to the preprocessed file.
+    An interrupted record must be discarded with @abort.
+    '''
+
+    def __init__(self, path, patient, record, n_samples, n_leads):
+        self.n_samples = n_samples
+        self.output, self.tmp_fname, self.fname = open_preprocessed(
+            path, patient, record, n_samples, n_leads)
+        self.smoothing = StreamingGaussianFilter(c.kernel_width_sec *
+                                                 c.sampling_rate)
+        self.moments = RunningMoments()
+        self.position = 0
+
+    def _write(self, smoothed):
+        self.output[:, self.position:self.position + len(smoothed)] = \
+            smoothed.T
+        self.moments.update(smoothed)
+        self.position += len(smoothed)
+
+    def update(self, block):
+        '''
+        Smooth a block and write the samples whose neighbourhood is complete.
+        '''
+        self._write(self.smoothing.update(block))
+
+    def finalize(self, chunk_size=None):
+        '''
+        Write the last samples (right edge of the record), standardize the
+        output in place (z-transform, as the StandardScaler) and move it to
+        the preprocessed file.
+        '''
+        self._write(self.smoothing.flush())
+        scale = np.sqrt(self.moments.var)
+        scale[scale == 0] = 1
+        if chunk_size is None:
+            chunk_size = c.chunk_size
+        for start in range(0, self.n_samples, chunk_size):
+            block = self.output[:, start:start + chunk_size]
+            block -= self.moments.mean[:, np.newaxis]
+            block /= scale[:, np.newaxis]
+        self.output.flush()
+        del self.output
+        os.replace(self.tmp_fname, self.fname)
+
+    def abort(self):
+        '''
+        Discard the temporary file of an interrupted record.
+        '''
+        self.output = None
+        if os.path.exists(self.tmp_fname):
+            os.remove(self.tmp_fname)
+
+
+# =============================================================================
+# FUNCTIONS
+# =============================================================================
+def preprocess_record_streaming(record_path, patient, record, path,
+                                chunk_size=None):
+    '''
+    Smooth (Gaussian kernel) and standardize a raw record block by block and
+    save it in the preprocessed dir. The result is the same as the one of
+    @03_data_preprocessing.preprocess_signal.
+
+    Parameters
+    ----------
+    record_path : String
+        The path of the raw record (without extension).
+    patient : String
+        e.g 'patient001'
+    record : String
+        e.g 's0010_re'
+    path : Class
+        The path constructor.
+    chunk_size : Int, optional
+        The number of samples per block. Defaults to "chunk_size" @config.py
+
+    Returns
+    -------
+    None.
+
+    '''
+    header = wfdb.rdheader(record_path)
+    preprocessor = StreamingPreprocessor(path, patient, record, header.sig_len,
+                                         header.n_sig)
+    try:
+        for _, block in iter_record_chunks(record_path, chunk_size):
+            preprocessor.update(block)
+        preprocessor.finalize(chunk_size)
+    except BaseException:
+        preprocessor.abort()
+        raise
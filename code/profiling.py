@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Instrumentation of the pipeline: the resources used by each stage, each
+patient job and each (class, electrode) model are appended as one JSON line
+to the run report (logs/run_report.jsonl, next to results.log):
+    1. wall_sec: the elapsed (wall-clock) time
+    2. cpu_sec: the CPU time (user + system) of the process
+    3. peak_rss_mb: the peak resident memory of the process so far
+    4. read_bytes, write_bytes: the bytes read from/written to the storage
+       (Linux only, from /proc/self/io, None elsewhere)
+The work that runs in the workers of a process pool is reported by the
+workers themselves (one line per patient/model, see the "pid"). The CPU time
+of a stage therefore only covers its main process.
+
+Each line carries the "run_id" of the stage invocation it belongs to: the
+outermost block of a stage creates the id and exports it to the environment
+variable ECG_RUN_ID, so that the workers started by the stage (and the jobs
+of @executors.py) report under the same id. Set ECG_RUN_ID beforehand to
+report several stages under one id (e.g: a full run of the Makefile). The
+report can then be compared run by run (see @load_run_report).
+
+To turn the instrumentation off, set the variable "profiling" @config.py to
+False.
+
+@author: Christos
+"""
+
+# =============================================================================
+# IMPORT MODULES
+# =============================================================================
+import os
+import sys
+import json
+import time
+import uuid
+import socket
+import resource
+from contextlib import contextmanager
+import pandas as pd
+import config as c
+
+
+# =============================================================================
+# GLOBALS
+# =============================================================================
+# the environment variable of the id of the current run (see the docstring)
+RUN_ID_ENV = 'ECG_RUN_ID'
+
+
+# =============================================================================
+# UTILITY FUNCTIONS
+# =============================================================================
+def new_run_id():
+    '''
+    Returns a new run id: the start time and a random suffix (e.g:
+    '20261018T101500_3f2a9c1e'), so that the ids sort by time.
+    '''
+    return f'{time.strftime("%Y%m%dT%H%M%S")}_{uuid.uuid4().hex[:8]}'
+
+
+def current_run_id():
+    '''
+    Returns the id of the current run (None outside of a run).
+    '''
+    return os.environ.get(RUN_ID_ENV)
+
+
+def report_fname(path):
+    '''
+    Returns the filename of the run report.
+    '''
+    return c.join(path.to_logs(), c.run_report_fname)
+
+
+def read_io_counters():
+    '''
+    Returns the bytes read from and written to the storage by the current
+    process (None if not available on this platform).
+    '''
+    try:
+        with open('/proc/self/io', 'r') as f:
+            counters = dict(line.split(':') for line in f)
+    except OSError:
+        return None, None
+
+    return int(counters['read_bytes']), int(counters['write_bytes'])
+
+
+def peak_rss_mb():
+    '''
+    Returns the peak resident memory of the current process in MB.
+    '''
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes on Linux
+    if sys.platform == 'darwin':
+        return peak / 2**20
+
+    return peak / 2**10
+
+
+def write_report(record, path):
+    '''
+    Append a record (one JSON line) to the run report. The line is written
+    with a single call, so that the workers can share the file.
+    '''
+    line = json.dumps(record, default=str) + '\n'
+    with open(report_fname(path), 'a') as f:
+        f.write(line)
+
+
+def load_run_report(path, run_id=None):
+    '''
+    Load the run report as a dataframe (one row per stage, patient or
+    model), e.g: to compare the runs or size the nodes.
+
+    Parameters
+    ----------
+    path : Class
+        The path constructor.
+    run_id : String, optional
+        Only the rows of a given run, or of the latest run if 'last'. The
+        default is all runs (e.g: to group them by "run_id").
+
+    Returns
+    -------
+    report : Pandas Dataframe
+
+    '''
+    fname = report_fname(path)
+    if not os.path.isfile(fname):
+        return pd.DataFrame()
+    report = pd.read_json(fname, lines=True)
+    if run_id is None:
+        return report
+    if 'run_id' not in report:
+        return report.iloc[:0]
+    if run_id == 'last':
+        # the ids sort by the start time of the runs (see @new_run_id)
+        run_id = report['run_id'].dropna().max()
+
+    return report[report['run_id'] == run_id]
+
+
+# =============================================================================
+# CONTEXT MANAGER
+# =============================================================================
+@contextmanager
+def profile(stage, path=None, **labels):
+    '''
+    Measure the resources used by the enclosed block and append them to the
+    run report.
+
+    Parameters
+    ----------
+    stage : String
+        e.g: '03_data_preprocessing'
+    path : Class, optional
+        The path constructor. Defaults to the project @config.py
+    **labels :
+        The unit of work, e.g: patient='patient001'.
+
+    Yields
+    ------
+    record : Dict
+        The record of the block; extra fields can be added by the block
+        (e.g: record['skipped'] = True).
+
+    '''
+    if not c.profiling:
+        yield {'stage': stage, **labels}
+        return
+    # the outermost block of a stage starts the run (inherited by the
+    # workers it starts, see the module docstring)
+    run_id = current_run_id()
+    new_run = run_id is None
+    if new_run:
+        run_id = os.environ[RUN_ID_ENV] = new_run_id()
+    record = {'run_id': run_id, 'stage': stage, **labels}
+    if path is None:
+        path = c.FetchPaths(c.PROJECTS_PATH, c.PROJECT_NAME)
+    start_wall, start_cpu = time.time(), time.process_time()
+    start_read, start_write = read_io_counters()
+    try:
+        yield record
+    except BaseException:
+        record['failed'] = True
+        raise
+    finally:
+        if new_run:
+            os.environ.pop(RUN_ID_ENV, None)
+        end_read, end_write = read_io_counters()
+        record.update({
+            'start': time.strftime('%Y-%m-%dT%H:%M:%S',
+                                   time.localtime(start_wall)),
+            'wall_sec': round(time.time() - start_wall, 4),
+            'cpu_sec': round(time.process_time() - start_cpu, 4),
+            'peak_rss_mb': round(peak_rss_mb(), 1),
+            'read_bytes': None if end_read is None else
+            end_read - start_read,
+            'write_bytes': None if end_write is None else
+            end_write - start_write,
+            'host': socket.gethostname(),
+            'pid': os.getpid()})
+        write_report(record, path)
@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Headless rendering of the figures of the pipeline (e.g: the EDA figures
+@02_eda.py and the heatmap @05_plot_model_results.py).
+
+Each figure is described by a plot function and the (precomputed) data it
+draws, e.g: the signal metadata of two classes and their p-values. The
+figures are then:
+    1. drawn with the non-interactive Agg backend (no display is needed and
+       nothing is shown on the screen)
+    2. drawn in parallel, one figure per job (see @executors.py and the
+       variables "render_n_jobs" and "executor" @config.py)
+    3. saved in each of the "figure_formats" @config.py, at "figure_dpi"
+       (written atomically, as the artifacts @artifact_writer.py)
+    4. skipped if the data, the plot function and the settings of the figure
+       did not change since the previous run and its files exist (see
+       @incremental.py)
+
+A plot function takes the data of the figure and returns the matplotlib
+figure it has drawn, e.g:
+    def plot_scores(scores):
+        import matplotlib.pyplot as plt
+        fig = plt.figure()
+        ...
+        return fig
+
+@author: Christos
+"""
+
+# =============================================================================
+# IMPORT MODULES
+# =============================================================================
+import os
+import pickle
+import hashlib
+import inspect
+import config as c
+import executors
+from incremental import Manifest
+
+
+# =============================================================================
+# FIGURES
+# =============================================================================
+def use_agg():
+    '''
+    Switch matplotlib to the non-interactive Agg backend (before pyplot is
+    used by the process).
+    '''
+    import matplotlib
+    if matplotlib.get_backend().lower() != 'agg':
+        matplotlib.use('Agg', force=True)
+
+
+def figure(name, plot, *args, **savefig_kwargs):
+    '''
+    Describe a figure to render (see @render).
+
+    Parameters
+    ----------
+    name : String
+        The filename of the figure in the images dir, without the extension
+        (e.g: 'healthy_control_myocardial_infarction').
+    plot : Function
+        The plot function: plot(*args) draws and returns the figure.
+    *args :
+        The data of the figure (precomputed: they are sent to the worker
+        and hashed).
+    **savefig_kwargs :
+        Passed to fig.savefig (e.g: orientation='landscape').
+
+    Returns
+    -------
+    Dict
+
+    '''
+    return {'name': name, 'plot': plot, 'args': args,
+            'savefig_kwargs': savefig_kwargs}
+
+
+def figure_fnames(path, name, formats=None):
+    '''
+    Returns the files of a figure, one per format (e.g: images/name.png).
+    '''
+    formats = c.figure_formats if formats is None else formats
+
+    return [c.join(path.to_images(), f'{name}.{fmt}') for fmt in formats]
+
+
+def hash_figure(figure_):
+    '''
+    Returns the content hash of the data of a figure and of the source code
+    of its plot function (a change of either draws the figure again).
+    '''
+    digest = hashlib.blake2b(digest_size=16)
+    plot = figure_['plot']
+    digest.update(f'{plot.__module__}.{plot.__qualname__}'.encode())
+    try:
+        digest.update(inspect.getsource(plot).encode())
+    except (OSError, TypeError):
+        # no source available (e.g: an interactive session)
+        pass
+    digest.update(pickle.dumps((figure_['args'], figure_['savefig_kwargs']),
+                               protocol=4))
+
+    return digest.hexdigest()
+
+
+def render_figure(plot, args, fnames, dpi, savefig_kwargs):
+    '''
+    Draw a figure with the Agg backend and save it to each of its files
+    (the worker of @render).
+
+    Returns
+    -------
+    fnames : List
+        The saved files.
+
+    '''
+    use_agg()
+    import matplotlib.pyplot as plt
+    fig = plot(*args)
+    try:
+        for fname in fnames:
+            # write atomically, so that an interrupted run never leaves a
+            # partial figure
+            tmp_fname = f'{fname}.{os.getpid()}.tmp'
+            try:
+                fig.savefig(tmp_fname, format=os.path.splitext(fname)[1][1:],
+                            dpi=dpi, bbox_inches='tight', **savefig_kwargs)
+                os.replace(tmp_fname, fname)
+            except BaseException:
+                if os.path.exists(tmp_fname):
+                    os.remove(tmp_fname)
+                raise
+    finally:
+        plt.close(fig)
+
+    return fnames
+
+
+# =============================================================================
+# RENDER
+# =============================================================================
+def render(figures, path, formats=None, dpi=None, n_jobs=None, backend=None):
+    '''
+    Render the figures in parallel and save them in the images dir. The
+    figures whose data and settings did not change since the previous run
+    are skipped.
+
+    Parameters
+    ----------
+    figures : List
+        The figures to render (see @figure).
+    path : Class
+        The path constructor.
+    formats : List, optional
+        The formats of the files (e.g: ['png', 'pdf']). The default is
+        "figure_formats" @config.py.
+    dpi : Int, optional
+        The resolution of the raster formats. The default is "figure_dpi"
+        @config.py.
+    n_jobs : Int, optional
+        The number of workers. The default is "render_n_jobs" @config.py.
+    backend : String, optional
+        The executor (see @executors.py). The default is "executor"
+        @config.py.
+
+    Returns
+    -------
+    fnames : List
+        The files of all figures (rendered or up to date).
+
+    '''
+    formats = c.figure_formats if formats is None else formats
+    dpi = c.figure_dpi if dpi is None else dpi
+    n_jobs = c.render_n_jobs if n_jobs is None else n_jobs
+    # the figures are never shown, also when drawn by this process
+    use_agg()
+
+    fnames, jobs, manifests = [], [], []
+    for figure_ in figures:
+        figure_fnames_ = figure_fnames(path, figure_['name'], formats)
+        fnames.extend(figure_fnames_)
+        manifest = Manifest(path, 'figures', figure_['name'])
+        settings = {'data': hash_figure(figure_), 'formats': formats,
+                    'dpi': dpi}
+        if manifest.is_up_to_date([], settings, figure_fnames_):
+            c.logging.info(f'Figure {figure_["name"]} is up to date: skipped')
+            continue
+        jobs.append((figure_['plot'], figure_['args'], figure_fnames_, dpi,
+                     figure_['savefig_kwargs']))
+        manifests.append(manifest)
+
+    if jobs:
+        from joblib import effective_n_jobs
+        # no more workers than figures (a single figure is drawn here)
+        n_jobs = min(effective_n_jobs(n_jobs), len(jobs))
+        outputs = executors.run(render_figure, jobs, n_jobs=n_jobs,
+                                backend=backend)
+        for manifest, output in zip(manifests, outputs):
+            manifest.save(output)
+    c.logging.info(f'{len(jobs)} of {len(figures)} figures rendered @'
+                   f'{path.to_images()}')
+
+    return fnames
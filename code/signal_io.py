@@ -0,0 +1,358 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+This module contains the functions that read and write the signals
+(e.g: the raw WFDB records and the preprocessed time series created
+@03_data_preprocessing.py).
+
+The raw records can be streamed in fixed-size blocks of samples
+(@iter_record_chunks), so that the memory needed to process a record depends
+on the block size and not on the length of the record.
+
+The class @RawRecord memory-maps the .dat file of a record and exposes the
+digital (16-bit) samples as they are stored on disk. The conversion to
+physical units is only applied to the samples that are requested, and can be
+done in float32. Select the reader with the variable "raw_reader" @config.py
+
+The preprocessed recordings are stored LEAD-MAJOR: one .npy per patient and
+record with shape (#leads X #samples), so that the samples of each lead are
+contiguous on disk. A single lead can then be memory-mapped and returned as
+a zero-copy view, without reading the rest of the recording.
+
+@author: Christos
+"""
+
+# =============================================================================
+# IMPORT MODULES
+# =============================================================================
+import os
+import numpy as np
+import wfdb
+import config as c
+from artifact_writer import write_atomic, write_npy
+
+
+# =============================================================================
+# RAW DATA
+# =============================================================================
+class RawRecord():
+    '''
+    Direct access to a raw WFDB record. Only the header is parsed, the samples
+    of the .dat file are memory-mapped (format 16) or decoded once to int16
+    (format 212). Records with other formats, multiple .dat files or
+    multiple samples per frame are read with wfdb.rdrecord (digital values).
+    Attributes (as the wfdb Record):
+        1. sig_name, comments, fs, sig_len, n_sig
+        2. adc_gain, baseline (the ADC gain and baseline of each lead)
+        3. digital (Numpy Array (#samples X #leads), int16)
+    '''
+
+    def __init__(self, record_path):
+        header = wfdb.rdheader(record_path)
+        self.record_path = record_path
+        self.sig_name = header.sig_name
+        self.comments = header.comments
+        self.fs = header.fs
+        self.sig_len = header.sig_len
+        self.n_sig = header.n_sig
+        self.adc_gain = np.asarray(header.adc_gain, dtype=float)
+        self.baseline = np.asarray(header.baseline, dtype=float)
+        self.digital = self._map_samples(header)
+        # the digital value of the missing samples (NaN in physical units)
+        self._invalid = -2**11 if set(header.fmt) == {'212'} else -2**15
+
+    def _map_samples(self, header):
+        '''
+        Returns the digital samples (#samples X #leads) of the record.
+        '''
+        fmt = set(header.fmt)
+        single_file = len(set(header.file_name)) == 1
+        single_frame = set(header.samps_per_frame or [1]) == {1}
+        no_skew = not any(header.skew or [])
+        if single_file and single_frame and no_skew and fmt <= {'16', '212'}:
+            fname = c.join(os.path.dirname(self.record_path),
+                           header.file_name[0])
+            offset = header.byte_offset[0] or 0
+            n_values = self.sig_len * self.n_sig
+            if fmt == {'16'}:
+                return np.memmap(fname, dtype='<i2', mode='r', offset=offset,
+                                 shape=(self.sig_len, self.n_sig))
+            if fmt == {'212'}:
+                return decode_212(fname, n_values, offset).reshape(
+                    self.sig_len, self.n_sig)
+        # any other storage format
+        record = wfdb.rdrecord(self.record_path, physical=False,
+                               return_res=16)
+
+        return record.d_signal
+
+    def physical(self, sampfrom=0, sampto=None, dtype=None):
+        '''
+        Returns the samples [sampfrom, sampto) of all leads in physical units
+        (a new array, #samples X #leads). Missing samples are set to NaN, as
+        with wfdb.rdrecord.
+
+        Parameters
+        ----------
+        sampfrom : Int, optional
+            The first sample. The default is 0.
+        sampto : Int, optional
+            The end sample (exclusive). Defaults to the length of the record.
+        dtype : String, optional
+            'float64' (same values as wfdb.rdrecord) or 'float32'. Defaults
+            to the "raw_dtype" @config.py
+
+        '''
+        if dtype is None:
+            dtype = c.raw_dtype
+        digital = self.digital[sampfrom:sampto]
+        data = np.asarray(digital, dtype=dtype)
+        data -= self.baseline.astype(dtype)
+        data /= self.adc_gain.astype(dtype)
+        data[digital == self._invalid] = np.nan
+
+        return data
+
+
+def decode_212(fname, n_values, offset=0):
+    '''
+    Decode the samples of a .dat file in format 212 (two 12-bit samples,
+    two's complement, packed in three bytes) to int16.
+    '''
+    n_bytes = (n_values + 1) // 2 * 3
+    packed = np.fromfile(fname, dtype=np.uint8, count=n_bytes, offset=offset)
+    packed = np.pad(packed, (0, n_bytes - len(packed))).reshape(-1, 3)
+    packed = packed.astype(np.int16)
+    values = np.empty(2 * len(packed), dtype=np.int16)
+    values[0::2] = packed[:, 0] | ((packed[:, 1] & 0x0F) << 8)
+    values[1::2] = packed[:, 2] | ((packed[:, 1] & 0xF0) << 4)
+    # sign of the 12-bit values
+    values[values > 2047] -= 4096
+
+    return values[:n_values]
+
+
+def iter_record_chunks(record_path, chunk_size=None, physical=True):
+    '''
+    Stream a raw WFDB record in consecutive blocks of samples. Only the
+    requested samples are read from the .dat file.
+
+    Parameters
+    ----------
+    record_path : String
+        The path of the record (without extension).
+    chunk_size : Int, optional
+        The number of samples per block. Defaults to the "chunk_size"
+        @config.py
+    physical : Bool, optional
+        Return the data in physical units or as digital (ADC) values (int).
+        The default is True. With the 'memmap' reader (see "raw_reader"
+        @config.py) the physical units are in "raw_dtype".
+
+    Yields
+    ------
+    start : Int
+        The index of the first sample of the block.
+    data : Numpy Array (#samples X #leads)
+        The samples of the block.
+
+    '''
+    if chunk_size is None:
+        chunk_size = c.chunk_size
+    if c.raw_reader == 'memmap':
+        raw = RawRecord(record_path)
+        for start in range(0, raw.sig_len, chunk_size):
+            stop = min(start + chunk_size, raw.sig_len)
+            yield start, (raw.physical(start, stop) if physical else
+                          raw.digital[start:stop])
+        return
+    n_samples = wfdb.rdheader(record_path).sig_len
+    for start in range(0, n_samples, chunk_size):
+        stop = min(start + chunk_size, n_samples)
+        record = wfdb.rdrecord(record_path, sampfrom=start, sampto=stop,
+                               physical=physical)
+        yield start, record.p_signal if physical else record.d_signal
+
+
+def record_cost(record_path):
+    '''
+    Returns the estimated cost of processing a raw record: its #samples X
+    #leads, read from the first line of its header (.hea), without reading
+    the rest of the header. If the header does not give the length of the
+    record, the size of the .dat file is returned instead.
+    '''
+    with open(f'{record_path}.hea', 'r') as f:
+        # e.g: 's0010_re 15 1000 38400'
+        fields = f.readline().split()
+    if len(fields) > 3:
+        return int(fields[1]) * int(fields[3])
+
+    return os.path.getsize(f'{record_path}.dat')
+
+
+# =============================================================================
+# PREPROCESSED DATA
+# =============================================================================
+def preprocessed_fname(path, patient, record, layout=None):
+    '''
+    Return the filename of the preprocessed data of a given patient and record.
+
+    Parameters
+    ----------
+    path : Class
+        The path constructor.
+    patient : String
+        e.g 'patient001'
+    record : String
+        e.g 's0010_re'
+    layout : String, optional
+        'lead_major' or 'sample_major' (the format of previous versions).
+        Defaults to the "preprocessed_layout" @config.py
+
+    Returns
+    -------
+    fname : String
+
+    '''
+    if layout is None:
+        layout = c.preprocessed_layout
+    path2data = c.join(path.to_data_preprocessed(), patient, record)
+    if layout == 'lead_major':
+        return c.join(path2data, f'{patient}_{record}_lead_major.npy')
+    elif layout == 'sample_major':
+        return c.join(path2data, f'{patient}_{record}.npy')
+    raise ValueError(f'Unknown layout of the preprocessed data: {layout}')
+
+
+def save_preprocessed(data, path, patient, record, layout=None, writer=None):
+    '''
+    Save the preprocessed data of a given patient and record.
+
+    Parameters
+    ----------
+    data : Numpy Array (#samples X #leads)
+        The preprocessed recording.
+    path : Class
+        The path constructor.
+    patient : String
+        e.g 'patient001'
+    record : String
+        e.g 's0010_re'
+    layout : String, optional
+        See @preprocessed_fname
+    writer : ArtifactWriter, optional
+        Write the data in the background (see @artifact_writer.py). The data
+        must not be modified afterwards. If None, the data are written before
+        returning.
+
+    Returns
+    -------
+    fname : String
+
+    '''
+    if layout is None:
+        layout = c.preprocessed_layout
+    fname = preprocessed_fname(path, patient, record, layout)
+    if layout == 'lead_major':
+        # made contiguous by the writer
+        data = data.T
+    if writer is None:
+        write_atomic(fname, write_npy, data)
+        return fname
+    writer.save_npy(fname, data)
+
+    return fname
+
+
+def open_preprocessed(path, patient, record, n_samples, n_leads, layout=None,
+                      dtype=None):
+    '''
+    Create the (memory-mapped) .npy file of the preprocessed data of a given
+    patient and record, to be filled block by block. The data are written to
+    a temporary file, moved to the preprocessed file (os.replace) only once
+    complete, so that an interrupted run never leaves a partial or
+    unstandardized artifact.
+
+    Parameters
+    ----------
+    path : Class
+        The path constructor.
+    patient : String
+        e.g 'patient001'
+    record : String
+        e.g 's0010_re'
+    n_samples : Int
+        The length of the record.
+    n_leads : Int
+        The number of leads.
+    layout : String, optional
+        See @preprocessed_fname
+    dtype : String, optional
+        Defaults to the "preprocessed_dtype" @config.py
+
+    Returns
+    -------
+    data : Numpy memmap (#leads X #samples)
+        Writable view of the temporary file, independent of the layout on
+        disk.
+    tmp_fname : String
+        The temporary file.
+    fname : String
+        The preprocessed file, to replace with the temporary file once the
+        data are flushed.
+
+    '''
+    if layout is None:
+        layout = c.preprocessed_layout
+    if dtype is None:
+        dtype = c.preprocessed_dtype
+    path2data = c.join(path.to_data_preprocessed(), patient, record)
+    if not c.exists(path2data):
+        c.make(path2data)
+    fname = preprocessed_fname(path, patient, record, layout)
+    tmp_fname = f'{fname}.{os.getpid()}.tmp'
+    if layout == 'lead_major':
+        data = np.lib.format.open_memmap(tmp_fname, mode='w+', dtype=dtype,
+                                         shape=(n_leads, n_samples))
+    else:
+        data = np.lib.format.open_memmap(tmp_fname, mode='w+', dtype=dtype,
+                                         shape=(n_samples, n_leads)).T
+
+    return data, tmp_fname, fname
+
+
+def load_preprocessed(path, patient, record, electrode=None, layout=None):
+    '''
+    Memory-map the preprocessed data of a given patient and record. Nothing
+    is read from the disk until the returned array is accessed.
+
+    Parameters
+    ----------
+    path : Class
+        The path constructor.
+    patient : String
+        e.g 'patient001'
+    record : String
+        e.g 's0010_re'
+    electrode : String, optional
+        e.g 'avl'. If None, all leads are returned (#leads X #samples).
+    layout : String, optional
+        See @preprocessed_fname
+
+    Returns
+    -------
+    data : Numpy memmap
+        The time series of the selected lead (#samples,). For the lead-major
+        layout this is a contiguous, zero-copy view.
+
+    '''
+    if layout is None:
+        layout = c.preprocessed_layout
+    data = np.load(preprocessed_fname(path, patient, record, layout),
+                   mmap_mode='r')
+    if layout == 'sample_major':
+        data = data.T
+    if electrode is None:
+        return data
+
+    return data[c.electrodes.index(electrode)]
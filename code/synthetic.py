@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Generator of synthetic PTB-like WFDB records, used by @benchmarks.py to run
+the pipeline on cohorts of any size (from tens to thousands of patients)
+without access to the real data.
+
+Each patient gets one or more records with:
+    1. 15 leads (see "electrodes" @config.py) sampled at 1 kHz, stored in
+       format 16 (as the PTB database).
+    2. ECG-like signals: a train of QRS-like and T-like waves with a
+       patient-specific heart rate, lead-specific gains, baseline wander and
+       noise.
+    3. PTB-like header comments (the same fields as the PTB headers, e.g:
+       age, sex, "Reason for admission").
+
+The synthetic cohort follows the directory structure of the project (see
+@config.FetchPaths), e.g:
+    python synthetic.py <projects_path> <n_patients>
+
+@author: Christos
+"""
+
+# =============================================================================
+# IMPORT MODULES
+# =============================================================================
+import sys
+import numpy as np
+import wfdb
+import config as c
+
+
+# =============================================================================
+# GLOBALS
+# =============================================================================
+# The diagnostic classes ("Reason for admission") and their probability in the
+# synthetic cohort. The classes modelled @04_modelling are over-represented
+# so that each of them has enough patients.
+CLASS_WEIGHTS = {'Healthy control': 0.3,
+                 'Myocardial infarction': 0.3,
+                 **{class_: 0.4 / len(c.classes) for class_ in c.classes}}
+
+# The fields of the PTB headers (in the same order), with a generator of
+# their values. The empty fields are empty in the PTB headers as well.
+HEADER_FIELDS = [
+    ('age', lambda rng: str(rng.integers(20, 90))),
+    ('sex', lambda rng: rng.choice(['male', 'female'], p=[0.7, 0.3])),
+    ('ECG date', lambda rng: f'{rng.integers(1, 29):02d}/'
+     f'{rng.integers(1, 13):02d}/{rng.integers(1990, 1996)}'),
+    ('Diagnose', lambda rng: ''),
+    ('Reason for admission', None),
+    ('Acute infarction (localization)', lambda rng: 'n/a'),
+    ('Former infarction (localization)', lambda rng: 'no'),
+    ('Additional diagnoses', lambda rng: 'n/a'),
+    ('Smoker', lambda rng: rng.choice(['yes', 'no', 'unknown'])),
+    ('Number of coronary vessels involved',
+     lambda rng: str(rng.integers(0, 4))),
+    ('Infarction date (acute)', lambda rng: 'n/a'),
+    ('Previous infarction (1) date', lambda rng: 'n/a'),
+    ('Previous infarction (2) date', lambda rng: 'n/a'),
+    ('Hemodynamics', lambda rng: ''),
+    ('Catheterization date', lambda rng: 'n/a'),
+    ('Ventriculography', lambda rng: 'n/a'),
+    ('Chest X-ray', lambda rng: 'n/a'),
+    ('Peripheral blood Pressure (syst/diast)',
+     lambda rng: f'{rng.integers(100, 180)}/{rng.integers(60, 100)} mmHg'),
+    ('Pulmonary artery pressure (at rest) (syst/diast)', lambda rng: 'n/a'),
+    ('Pulmonary artery pressure (at rest) (mean)', lambda rng: 'n/a'),
+    ('Pulmonary capillary wedge pressure (at rest)', lambda rng: 'n/a'),
+    ('Cardiac output (at rest)', lambda rng: 'n/a'),
+    ('Cardiac index (at rest)', lambda rng: 'n/a'),
+    ('Stroke volume index (at rest)', lambda rng: 'n/a'),
+    ('Pulmonary artery pressure (laod) (syst/diast)', lambda rng: 'n/a'),
+    ('Pulmonary artery pressure (laod) (mean)', lambda rng: 'n/a'),
+    ('Pulmonary capillary wedge pressure (load)', lambda rng: 'n/a'),
+    ('Cardiac output (load)', lambda rng: 'n/a'),
+    ('Cardiac index (load)', lambda rng: 'n/a'),
+    ('Stroke volume index (load)', lambda rng: 'n/a'),
+    ('Aorta (at rest) (syst/diast)', lambda rng: 'n/a'),
+    ('Aorta (at rest) mean', lambda rng: 'n/a'),
+    ('Left ventricular enddiastolic pressure', lambda rng: 'n/a'),
+    ('Left coronary artery stenoses (RIVA)', lambda rng: 'n/a'),
+    ('Left coronary artery stenoses (RCX)', lambda rng: 'n/a'),
+    ('Right coronary artery stenoses (RCA)', lambda rng: 'n/a'),
+    ('Echocardiography', lambda rng: 'n/a'),
+    ('Therapy', lambda rng: ''),
+    ('Infarction date', lambda rng: 'n/a'),
+    ('Catheterization date', lambda rng: 'n/a'),
+    ('Admission date', lambda rng: 'n/a'),
+    ('Medication pre admission', lambda rng: 'n/a'),
+    ('Start lysis therapy (hh.mm)', lambda rng: 'n/a'),
+    ('Lytic agent', lambda rng: 'n/a'),
+    ('Dosage (lytic agent)', lambda rng: 'n/a'),
+    ('Additional medication', lambda rng: 'n/a'),
+    ('In hospital medication', lambda rng: 'n/a'),
+    ('Medication after discharge', lambda rng: 'n/a')]
+
+# ADC gain of the PTB records (adu/mV)
+ADC_GAIN = 2000.
+
+
+# =============================================================================
+# FUNCTIONS
+# =============================================================================
+def header_comments(rng, reason_for_admission):
+    '''
+    Returns the PTB-like header comments of a record (one "field: value"
+    string per field).
+    '''
+    return [f'{field}: {reason_for_admission if value is None else value(rng)}'
+            for field, value in HEADER_FIELDS]
+
+
+def synthetic_ecg(rng, n_samples, n_leads, sfreq=1000):
+    '''
+    Returns an ECG-like recording (#samples X #leads) in mV.
+    '''
+    t = np.arange(n_samples) / sfreq
+    heart_rate = rng.uniform(50, 100) / 60 # [beats/sec]
+    # phase within each beat
+    phase = (t * heart_rate) % 1
+    # QRS-like and T-like waves of each beat
+    beat = (np.exp(-0.5 * ((phase - 0.2) / 0.01) ** 2) +
+            0.3 * np.exp(-0.5 * ((phase - 0.5) / 0.05) ** 2))
+    gains = rng.uniform(-1.5, 1.5, n_leads)
+    wander = 0.1 * np.sin(2 * np.pi * rng.uniform(0.1, 0.5) * t)
+    data = (beat[:, np.newaxis] * gains + wander[:, np.newaxis] +
+            0.02 * rng.standard_normal((n_samples, n_leads)))
+
+    return data
+
+
+def generate_patient(path, patient, rng, duration_sec=30,
+                     records_per_patient=1, sfreq=1000):
+    '''
+    Write the synthetic records of a patient in the "raw" dir.
+
+    Parameters
+    ----------
+    path : Class
+        The path constructor of the (synthetic) project.
+    patient : String
+        e.g 'patient001'
+    rng : Numpy Generator
+        The random generator.
+    duration_sec : Float, optional
+        The mean duration of the records (+/- 20%). The default is 30.
+    records_per_patient : Int, optional
+        The default is 1.
+    sfreq : Int, optional
+        The sampling frequency in Hz. The default is 1000.
+
+    Returns
+    -------
+    n_samples : Int
+        The total number of samples written (all records).
+
+    '''
+    curr_patient = c.join(path.to_data_raw(), patient)
+    if not c.exists(curr_patient):
+        c.make(curr_patient)
+    classes = list(CLASS_WEIGHTS)
+    weights = np.array(list(CLASS_WEIGHTS.values()))
+    reason_for_admission = rng.choice(classes, p=weights / weights.sum())
+    n_total = 0
+    for idx in range(records_per_patient):
+        n_samples = int(duration_sec * sfreq * rng.uniform(0.8, 1.2))
+        data = synthetic_ecg(rng, n_samples, len(c.electrodes), sfreq)
+        digital = np.round(data * ADC_GAIN).astype(np.int16)
+        wfdb.wrsamp(f's{idx:04d}_re', fs=sfreq, units=['mV'] * len(c.electrodes),
+                    sig_name=c.electrodes, d_signal=digital,
+                    fmt=['16'] * len(c.electrodes),
+                    adc_gain=[ADC_GAIN] * len(c.electrodes),
+                    baseline=[0] * len(c.electrodes),
+                    comments=header_comments(rng, reason_for_admission),
+                    write_dir=curr_patient)
+        n_total += n_samples
+
+    return n_total
+
+
+def generate_cohort(path, n_patients, duration_sec=30, records_per_patient=1,
+                    seed=c.random_state):
+    '''
+    Write a synthetic cohort of "n_patients" (patient001,...) in the "raw"
+    dir of the given project. Existing patients are kept (the cohort can be
+    grown without re-generating it).
+
+    Returns
+    -------
+    patients : List
+        The sorted list of patients.
+
+    '''
+    patients = [f'patient{idx:03d}' for idx in range(1, n_patients + 1)]
+    for patient in patients:
+        if c.exists(c.join(path.to_data_raw(), patient)):
+            continue
+        # one generator per patient, so that the cohort does not depend on
+        # the patients generated previously
+        rng = np.random.default_rng([seed, int(patient[len('patient'):])])
+        generate_patient(path, patient, rng, duration_sec,
+                         records_per_patient)
+    c.logging.info(f'Synthetic cohort of {n_patients} patients @'
+                   f'{path.to_data_raw()}')
+
+    return patients
+
+
+# %%
+# =============================================================================
+# EXECUTE
+# =============================================================================
+
+if __name__ == "__main__":
+    c.init()
+    path = c.FetchPaths(sys.argv[1], c.PROJECT_NAME)
+    generate_cohort(path, int(sys.argv[2]))